@@ -1,23 +1,68 @@
-from fastapi import FastAPI, Depends, HTTPException, Query
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
-from sqlalchemy import desc, func
-from typing import List, Optional
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import desc, func, select
+from typing import Optional
 from datetime import datetime, timedelta
 import asyncio
-import uvicorn
+import logging
+from starlette.concurrency import run_in_threadpool
 
-from database import get_db, engine
-from models import Base, Item, Region, MarketData, OrderHistory
-from fetch_market import fetch_market_data
+from database import DB_UPGRADE_ON_STARTUP, get_async_db, engine, warm_pool
+from models import Region, MarketData, MarketLatest, OrderHistory
+from jobs import ingest_runner, ingest_schedule
+from migrations import upgrade
+from arbitrage import snapshot_pairs, select_top, resolve_names
+from hauling import (
+    DEFAULT_SALES_TAX, RANK_METRICS, find_hauls, hauling_columns, load_stored_books, missing_routes, resolve_haul_names
+)
+from cache import cached_json
+from export import FORMAT_PATTERN, export_response
+from indicators import INDICATORS
+from item_search import search_items
+from live import TOPICS as LIVE_TOPICS, LiveFeed, live_hub
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, MetricsMiddleware, render as render_metrics
+from order_book import depth_query
+from rollups import ohlc_series
+from shards import latest_run
+
+logger = logging.getLogger(__name__)
 
-# Create tables
-Base.metadata.create_all(bind=engine)
+live_feed = LiveFeed(live_hub, ingest_runner.latest)
+# Ingest jobs in this process push their commits to /live right away
+ingest_runner.on_write.append(live_feed.notify)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Configured here rather than at import, so importing app has no side effects
+    logging.basicConfig(level=logging.INFO)
+    if DB_UPGRADE_ON_STARTUP:
+        # Bring the schema up to date
+        await run_in_threadpool(upgrade, engine)
+    warmup = asyncio.ensure_future(warm_db_pool())
+    ingest_schedule.start()
+    live_feed.start()
+    yield
+    warmup.cancel()
+    await live_feed.stop()
+    ingest_schedule.stop()
+    ingest_runner.shutdown()
+
+async def warm_db_pool():
+    """Connect the API pool in the background; requests arriving meanwhile connect on demand"""
+    try:
+        connections = await warm_pool()
+        logger.info(f"Opened {connections} database connections")
+    except Exception as e:
+        logger.error(f"Error warming up the database pool: {e}")
 
 app = FastAPI(
     title="EVE Online Trading Tool API",
     description="API for EVE Online market data analysis",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Add CORS middleware
@@ -28,6 +73,19 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Outermost, so it times everything the other middleware does too
+app.add_middleware(MetricsMiddleware)
+
+# Longest window a JSON response may cover; streaming formats go further
+MAX_JSON_DAYS = 365
+MAX_EXPORT_DAYS = 3650
+
+def check_json_window(days):
+    if days > MAX_JSON_DAYS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"JSON responses cover at most {MAX_JSON_DAYS} days, use format=ndjson, csv, arrow or parquet"
+        )
 
 @app.get("/")
 async def root():
@@ -35,181 +93,279 @@ async def root():
 
 @app.get("/items")
 async def get_items(
-    skip: int = Query(0, ge=0),
+    request: Request,
     limit: int = Query(100, ge=1, le=1000),
-    search: Optional[str] = None,
-    db: Session = Depends(get_db)
+    cursor: Optional[str] = None,
+    search: Optional[str] = Query(None, max_length=100),
+    total: str = Query("approx", pattern="^(none|exact|approx)$"),
+    skip: int = Query(0, ge=0),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """Get all items with optional search"""
-    query = db.query(Item)
-    
-    if search:
-        query = query.filter(Item.name.ilike(f"%{search}%"))
+    """Get items with optional name search, paginated by cursor"""
+    async def compute():
+        try:
+            return await search_items(db, search.strip() if search else None, limit, cursor, skip, total)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
     
-    items = query.offset(skip).limit(limit).all()
-    total = query.count()
-    
-    return {
-        "items": items,
-        "total": total,
-        "skip": skip,
-        "limit": limit
-    }
+    return await cached_json(request, db, compute)
 
 @app.get("/regions")
-async def get_regions(db: Session = Depends(get_db)):
+async def get_regions(request: Request, db: AsyncSession = Depends(get_async_db)):
     """Get all regions"""
-    regions = db.query(Region).all()
-    return {"regions": regions}
+    async def compute():
+        return {"regions": (await db.scalars(select(Region))).all()}
+    
+    return await cached_json(request, db, compute)
 
 @app.get("/market-data/{type_id}")
 async def get_market_data(
     type_id: int,
     region_id: Optional[int] = None,
-    days: int = Query(7, ge=1, le=365),
-    db: Session = Depends(get_db)
+    days: int = Query(7, ge=1, le=MAX_EXPORT_DAYS),
+    format: str = Query("json", pattern=FORMAT_PATTERN),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Get market data for a specific item"""
-    query = db.query(MarketData).filter(MarketData.type_id == type_id)
+    conditions = [MarketData.type_id == type_id]
     
     if region_id:
-        query = query.filter(MarketData.region_id == region_id)
+        conditions.append(MarketData.region_id == region_id)
     
     # Get data from the last N days
     since_date = datetime.utcnow() - timedelta(days=days)
-    query = query.filter(MarketData.timestamp >= since_date)
+    conditions.append(MarketData.timestamp >= since_date)
+    
+    if format != "json":
+        return export_response(MarketData, conditions, [desc(MarketData.timestamp)], format, f"market-data-{type_id}")
+    check_json_window(days)
     
-    market_data = query.order_by(desc(MarketData.timestamp)).all()
+    market_data = (await db.scalars(select(MarketData).where(*conditions).order_by(desc(MarketData.timestamp)))).all()
     
     return {"market_data": market_data}
 
 @app.get("/arbitrage")
 async def get_arbitrage_opportunities(
+    request: Request,
     min_profit: float = Query(1000000, ge=0),
     limit: int = Query(50, ge=1, le=200),
-    db: Session = Depends(get_db)
+    per_type: int = Query(1, ge=1, le=10),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Find arbitrage opportunities between regions"""
-    # Get latest market data for each item/region combination
-    subquery = db.query(
-        MarketData.type_id,
-        MarketData.region_id,
-        func.max(MarketData.timestamp).label('latest_timestamp')
-    ).group_by(MarketData.type_id, MarketData.region_id).subquery()
-    
-    latest_data = db.query(MarketData).join(
-        subquery,
-        (MarketData.type_id == subquery.c.type_id) &
-        (MarketData.region_id == subquery.c.region_id) &
-        (MarketData.timestamp == subquery.c.latest_timestamp)
-    ).all()
-    
-    # Calculate arbitrage opportunities
-    arbitrage_ops = []
-    
-    # Group by type_id
-    data_by_type = {}
-    for data in latest_data:
-        if data.type_id not in data_by_type:
-            data_by_type[data.type_id] = []
-        data_by_type[data.type_id].append(data)
-    
-    for type_id, type_data in data_by_type.items():
-        if len(type_data) < 2:
-            continue
-        
-        # Find best buy and sell opportunities
-        for buy_data in type_data:
-            for sell_data in type_data:
-                if buy_data.region_id == sell_data.region_id:
-                    continue
-                
-                if buy_data.buy_max and sell_data.sell_min:
-                    profit = buy_data.buy_max - sell_data.sell_min
-                    if profit >= min_profit:
-                        item = db.query(Item).filter(Item.type_id == type_id).first()
-                        buy_region = db.query(Region).filter(Region.region_id == buy_data.region_id).first()
-                        sell_region = db.query(Region).filter(Region.region_id == sell_data.region_id).first()
-                        
-                        arbitrage_ops.append({
-                            "item": item,
-                            "buy_region": buy_region,
-                            "sell_region": sell_region,
-                            "buy_price": buy_data.buy_max,
-                            "sell_price": sell_data.sell_min,
-                            "profit": profit,
-                            "profit_margin": (profit / sell_data.sell_min) * 100 if sell_data.sell_min > 0 else 0,
-                            "buy_volume": buy_data.buy_volume,
-                            "sell_volume": sell_data.sell_volume
-                        })
-    
-    # Sort by profit and limit results
-    arbitrage_ops.sort(key=lambda x: x["profit"], reverse=True)
-    
-    return {"arbitrage_opportunities": arbitrage_ops[:limit]}
+    async def compute():
+        columns, pairs = await snapshot_pairs(db, per_type)
+        opportunities = select_top(columns, pairs, min_profit, limit)
+        return {"arbitrage_opportunities": await resolve_names(db, opportunities)}
+    
+    return await cached_json(request, db, compute)
+
+@app.get("/arbitrage/hauling")
+async def get_hauling_opportunities(
+    request: Request,
+    cargo_m3: float = Query(60000, gt=0),
+    capital: float = Query(1_000_000_000, gt=0),
+    sales_tax: float = Query(DEFAULT_SALES_TAX, ge=0, lt=1),
+    rank_by: str = Query("isk_per_jump", pattern=f"^({'|'.join(RANK_METRICS)})$"),
+    min_profit: float = Query(0, ge=0),
+    max_jumps: Optional[int] = Query(None, ge=1),
+    limit: int = Query(50, ge=1, le=200),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Find hauling trades between hubs that fit the cargo hold and capital"""
+    async def compute():
+        columns = await hauling_columns(db)
+        hauls = await run_in_threadpool(
+            find_hauls, columns, cargo_m3, capital, sales_tax, rank_by, min_profit, max_jumps, limit,
+            books=load_stored_books
+        )
+        return {
+            "hauling_opportunities": await resolve_haul_names(db, hauls),
+            # Routes without a jump count in HUB_JUMPS_FILE are not searched
+            "skipped_region_pairs": missing_routes(columns)
+        }
+    
+    return await cached_json(request, db, compute)
+
+@app.get("/order-book/{type_id}")
+async def get_order_book_depth(
+    request: Request,
+    type_id: int,
+    region_id: int,
+    side: str = Query("sell", pattern="^(sell|buy)$"),
+    levels: int = Query(20, ge=0, le=1000),
+    units: Optional[int] = Query(None, ge=1),
+    price: Optional[float] = Query(None, gt=0),
+    within_pct: Optional[float] = Query(None, ge=0, le=1000),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Depth of the latest stored order book: levels, cost of N units, volume up to a price"""
+    async def compute():
+        result = await depth_query(db, type_id, region_id, side, levels, units, price, within_pct)
+        if result is None:
+            raise HTTPException(status_code=404, detail="No order book stored for this item and region")
+        return result
+    
+    return await cached_json(request, db, compute)
 
 @app.get("/price-trends/{type_id}")
 async def get_price_trends(
     type_id: int,
     region_id: int,
-    days: int = Query(30, ge=1, le=365),
-    db: Session = Depends(get_db)
+    days: int = Query(30, ge=1, le=MAX_EXPORT_DAYS),
+    format: str = Query("json", pattern=FORMAT_PATTERN),
+    series: str = Query("historical_data", pattern="^(historical_data|market_data)$"),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Get price trends for an item in a specific region"""
     since_date = datetime.utcnow() - timedelta(days=days)
-    
-    # Get historical data
-    history = db.query(OrderHistory).filter(
+    history_conditions = [
         OrderHistory.type_id == type_id,
         OrderHistory.region_id == region_id,
         OrderHistory.date >= since_date
-    ).order_by(OrderHistory.date).all()
-    
-    # Get recent market data
-    market_data = db.query(MarketData).filter(
+    ]
+    market_conditions = [
         MarketData.type_id == type_id,
         MarketData.region_id == region_id,
         MarketData.timestamp >= since_date
-    ).order_by(MarketData.timestamp).all()
+    ]
+    
+    # Streaming formats carry one table, chosen by series
+    if format != "json":
+        filename = f"price-trends-{type_id}-{region_id}-{series}"
+        if series == "market_data":
+            return export_response(MarketData, market_conditions, [MarketData.timestamp], format, filename)
+        return export_response(OrderHistory, history_conditions, [OrderHistory.date], format, filename)
+    check_json_window(days)
+    
+    # Get historical data
+    history = (await db.scalars(select(OrderHistory).where(*history_conditions).order_by(OrderHistory.date))).all()
+    
+    # Get recent market data
+    market_data = (await db.scalars(select(MarketData).where(*market_conditions).order_by(MarketData.timestamp))).all()
     
     return {
         "historical_data": history,
         "market_data": market_data
     }
 
+@app.get("/price-trends/{type_id}/ohlc")
+async def get_price_ohlc(
+    request: Request,
+    type_id: int,
+    region_id: int,
+    resolution: str = Query("day", pattern="^(hour|day|week)$"),
+    days: int = Query(90, ge=1, le=MAX_EXPORT_DAYS),
+    indicators: Optional[str] = Query(None, description=f"Comma-separated: {', '.join(INDICATORS)}"),
+    window: int = Query(20, ge=2, le=200),
+    width: float = Query(2.0, gt=0, le=10),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Get OHLC buckets and rolling indicators for an item in a region"""
+    names = [name.strip() for name in indicators.split(",") if name.strip()] if indicators else []
+    unknown = [name for name in names if name not in INDICATORS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown indicators: {', '.join(unknown)}")
+    
+    return await cached_json(
+        request, db,
+        lambda: ohlc_series(db, type_id, region_id, resolution, days, names, window, width)
+    )
+
 @app.get("/market-health")
-async def get_market_health(db: Session = Depends(get_db)):
+async def get_market_health(request: Request, db: AsyncSession = Depends(get_async_db)):
     """Get overall market health statistics"""
-    # Get latest data timestamp
-    latest_data = db.query(func.max(MarketData.timestamp)).scalar()
-    
-    # Count active items and regions
-    active_items = db.query(func.count(func.distinct(MarketData.type_id))).scalar()
-    active_regions = db.query(func.count(func.distinct(MarketData.region_id))).scalar()
-    
-    # Get total volume and orders
-    total_buy_volume = db.query(func.sum(MarketData.buy_volume)).scalar() or 0
-    total_sell_volume = db.query(func.sum(MarketData.sell_volume)).scalar() or 0
-    total_orders = db.query(func.sum(MarketData.buy_orders + MarketData.sell_orders)).scalar() or 0
+    return await cached_json(request, db, lambda: market_health(db))
+
+async def market_health(db):
+    """Aggregate the latest snapshot per item/region in a single pass"""
+    (
+        latest_data,
+        active_items,
+        active_regions,
+        total_buy_volume,
+        total_sell_volume,
+        total_orders
+    ) = (await db.execute(select(
+        func.max(MarketLatest.timestamp),
+        func.count(func.distinct(MarketLatest.type_id)),
+        func.count(func.distinct(MarketLatest.region_id)),
+        func.sum(MarketLatest.buy_volume),
+        func.sum(MarketLatest.sell_volume),
+        func.sum(MarketLatest.buy_orders + MarketLatest.sell_orders)
+    ))).one()
     
     return {
         "last_update": latest_data,
         "active_items": active_items,
         "active_regions": active_regions,
-        "total_buy_volume": total_buy_volume,
-        "total_sell_volume": total_sell_volume,
-        "total_orders": total_orders
+        "total_buy_volume": total_buy_volume or 0,
+        "total_sell_volume": total_sell_volume or 0,
+        "total_orders": total_orders or 0
     }
 
-@app.post("/update-market-data")
+@app.post("/update-market-data", status_code=202)
 async def trigger_market_update():
-    """Manually trigger market data update"""
-    try:
-        await fetch_market_data()
-        return {"message": "Market data update completed successfully"}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Market data update failed: {str(e)}")
+    """Start a market data update in the background, or join the one already running"""
+    job, created = ingest_runner.start("manual")
+    return {
+        "message": "Market data update started" if created else "Market data update already running",
+        "created": created,
+        "job": job.to_dict()
+    }
+
+@app.get("/jobs/ingest")
+async def get_latest_ingest_job():
+    """Status of the most recent ingest job"""
+    job = ingest_runner.latest()
+    if job is None:
+        raise HTTPException(status_code=404, detail="No ingest job has run yet")
+    return job.to_dict()
+
+@app.get("/jobs/ingest/run")
+async def get_latest_ingest_run(db: AsyncSession = Depends(get_async_db)):
+    """Shards of the most recent ingest run and which worker holds or finished each"""
+    run = await latest_run(db)
+    if run is None:
+        raise HTTPException(status_code=404, detail="No ingest run has been planned yet")
+    return run
+
+@app.get("/jobs/{job_id}")
+async def get_ingest_job(job_id: str):
+    """Status and per-stage progress of an ingest job"""
+    job = ingest_runner.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+@app.get("/live")
+async def live_updates(
+    topics: str = Query(",".join(LIVE_TOPICS), pattern=f"^({'|'.join(LIVE_TOPICS)})(,({'|'.join(LIVE_TOPICS)}))*$"),
+    type_ids: Optional[str] = Query(None, pattern=r"^\d+(,\d+)*$"),
+    region_ids: Optional[str] = Query(None, pattern=r"^\d+(,\d+)*$")
+):
+    """Server-sent events: changed latest prices, arbitrage hits that appeared or disappeared, and ingest job progress"""
+    subscriber = live_hub.subscribe(
+        topics.split(","),
+        [int(type_id) for type_id in type_ids.split(",")] if type_ids else None,
+        [int(region_id) for region_id in region_ids.split(",")] if region_ids else None
+    )
+    if subscriber is None:
+        raise HTTPException(status_code=503, detail="Too many live feed clients, try again later")
+    return StreamingResponse(
+        live_hub.stream(subscriber),
+        media_type="text/event-stream",
+        # Proxies must pass events through as they come
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """Prometheus metrics of this process: ESI, ingest stages, DB statements and API routes"""
+    return Response(content=render_metrics(), media_type=METRICS_CONTENT_TYPE)
 
 if __name__ == "__main__":
+    import uvicorn
+
     uvicorn.run(app, host="0.0.0.0", port=8000)
 
@@ -0,0 +1,177 @@
+import asyncio
+import numpy as np
+from sqlalchemy import select
+from starlette.concurrency import run_in_threadpool
+
+from cache import current_generation
+from database import SessionLocal
+from models import Item, Region, MarketLatest
+
+def load_snapshot_columns(db):
+    """Load the latest buy_max/sell_min per item/region as columnar arrays"""
+    rows = db.execute(select(
+        MarketLatest.type_id,
+        MarketLatest.region_id,
+        MarketLatest.buy_max,
+        MarketLatest.sell_min,
+        MarketLatest.buy_volume,
+        MarketLatest.sell_volume
+    )).all()
+    return rows_to_columns(rows)
+
+def _load_snapshot_columns():
+    db = SessionLocal()
+    try:
+        return load_snapshot_columns(db)
+    finally:
+        db.close()
+
+# (generation, columns, {per_type: pairs}) of the last snapshot loaded by this process
+_snapshot = (None, None, {})
+_snapshot_lock = asyncio.Lock()
+
+async def snapshot_pairs(db, per_type=1):
+    """Snapshot columns and best pairs for the current data generation.
+
+    Both depend only on ingested data, so they are computed at most once
+    per generation (and per_type) in a worker thread; concurrent callers
+    share one computation and requests only run select_top.
+    """
+    global _snapshot
+    generation = await current_generation(db)
+    async with _snapshot_lock:
+        if _snapshot[0] != generation:
+            _snapshot = (generation, await run_in_threadpool(_load_snapshot_columns), {})
+        _, columns, pairs = _snapshot
+        if per_type not in pairs:
+            pairs[per_type] = await run_in_threadpool(best_pairs, columns, per_type)
+        return columns, pairs[per_type]
+
+def rows_to_columns(rows):
+    """Convert (type_id, region_id, buy_max, sell_min, buy_volume, sell_volume) rows to arrays"""
+    type_ids, region_ids, buy_max, sell_min, buy_volume, sell_volume = zip(*rows) if rows else ((),) * 6
+    # None prices become NaN and are skipped like the falsy prices they were
+    return {
+        'type_id': np.array(type_ids, dtype=np.int64),
+        'region_id': np.array(region_ids, dtype=np.int64),
+        'buy_max': np.array(buy_max, dtype=np.float64),
+        'sell_min': np.array(sell_min, dtype=np.float64),
+        'buy_volume': np.array([v or 0 for v in buy_volume], dtype=np.int64),
+        'sell_volume': np.array([v or 0 for v in sell_volume], dtype=np.int64),
+    }
+
+def _top_k(group_pos, values, descending, k, groups):
+    """Row indices of the k best values per group as a (groups, k) matrix, -1 padded"""
+    valid = np.flatnonzero(~np.isnan(values) & (values != 0))
+    top = np.full((groups, k), -1, dtype=np.int64)
+    if not len(valid):
+        return top
+    # Sort by value, then stably by group (a radix sort on the integer key)
+    ranked = values[valid]
+    rows = valid[np.argsort(-ranked if descending else ranked)]
+    rows = rows[np.argsort(group_pos[rows], kind='stable')]
+    pos = group_pos[rows]
+    starts = np.flatnonzero(np.r_[True, pos[1:] != pos[:-1]])
+    rank = np.arange(len(rows)) - np.repeat(starts, np.diff(np.r_[starts, len(rows)]))
+    keep = rank < k
+    top[pos[keep], rank[keep]] = rows[keep]
+    return top
+
+def best_pairs(columns, per_type=1):
+    """Best buy/sell region pairs per type, independent of min_profit and limit.
+
+    For each type only the per_type + 1 highest buy orders and lowest sell
+    orders across regions are kept: any pair outside them is beaten by at
+    least per_type pairs inside them, so the per-type cost is O(regions)
+    instead of O(regions^2). Returns row indices into columns and the
+    profit of every candidate pair.
+    """
+    type_ids = columns['type_id']
+    if not len(type_ids):
+        empty = np.zeros(0, dtype=np.int64)
+        return {'buy_row': empty, 'sell_row': empty, 'profit': np.zeros(0)}
+    types, group_pos = np.unique(type_ids, return_inverse=True)
+    k = per_type + 1
+
+    top_buy = _top_k(group_pos, columns['buy_max'], True, k, len(types))
+    top_sell = _top_k(group_pos, columns['sell_min'], False, k, len(types))
+
+    buy_price = np.where(top_buy >= 0, columns['buy_max'][top_buy], np.nan)
+    sell_price = np.where(top_sell >= 0, columns['sell_min'][top_sell], np.nan)
+    buy_region = np.where(top_buy >= 0, columns['region_id'][top_buy], -1)
+    sell_region = np.where(top_sell >= 0, columns['region_id'][top_sell], -2)
+
+    # (types, k, k) profit matrix of every buy/sell combination within the top k
+    profit = buy_price[:, :, None] - sell_price[:, None, :]
+    profit[buy_region[:, :, None] == sell_region[:, None, :]] = np.nan
+    profit = np.nan_to_num(profit.reshape(len(types), k * k), nan=-np.inf)
+
+    if per_type == 1:
+        best = profit.argmax(axis=1)[:, None]
+    else:
+        best = np.argsort(-profit, axis=1, kind='stable')[:, :per_type]
+    type_idx = np.repeat(np.arange(len(types)), best.shape[1])
+    pair = best.ravel()
+    pair_profit = profit[type_idx, pair]
+
+    valid = np.isfinite(pair_profit)
+    return {
+        'buy_row': top_buy[type_idx, pair // k][valid],
+        'sell_row': top_sell[type_idx, pair % k][valid],
+        'profit': pair_profit[valid],
+    }
+
+def select_top(columns, pairs, min_profit=0, limit=50):
+    """Pick the `limit` most profitable pairs with a partial partition instead of a full sort"""
+    profit = pairs['profit']
+    hits = np.flatnonzero(profit >= min_profit)
+    if len(hits) > limit:
+        hits = hits[np.argpartition(-profit[hits], limit - 1)[:limit]]
+    hits = hits[np.argsort(-profit[hits], kind='stable')]
+
+    opportunities = []
+    for i in hits.tolist():
+        buy_row = pairs['buy_row'][i]
+        sell_row = pairs['sell_row'][i]
+        buy = float(columns['buy_max'][buy_row])
+        sell = float(columns['sell_min'][sell_row])
+        profit_value = buy - sell
+        opportunities.append({
+            "type_id": int(columns['type_id'][buy_row]),
+            "buy_region_id": int(columns['region_id'][buy_row]),
+            "sell_region_id": int(columns['region_id'][sell_row]),
+            "buy_price": buy,
+            "sell_price": sell,
+            "profit": profit_value,
+            "profit_margin": (profit_value / sell) * 100 if sell > 0 else 0,
+            "buy_volume": int(columns['buy_volume'][buy_row]),
+            "sell_volume": int(columns['sell_volume'][sell_row])
+        })
+    return opportunities
+
+def find_opportunities(columns, min_profit=0, limit=50, per_type=1):
+    """Find the most profitable cross-region trades in a snapshot"""
+    return select_top(columns, best_pairs(columns, per_type), min_profit, limit)
+
+async def resolve_names(db, opportunities):
+    """Attach Item and Region objects using one query per table"""
+    type_ids = {op["type_id"] for op in opportunities}
+    items = {}
+    if type_ids:
+        items = {item.type_id: item for item in await db.scalars(select(Item).where(Item.type_id.in_(type_ids)))}
+    regions = {region.region_id: region for region in await db.scalars(select(Region))}
+
+    return [
+        {
+            "item": items.get(op["type_id"]),
+            "buy_region": regions.get(op["buy_region_id"]),
+            "sell_region": regions.get(op["sell_region_id"]),
+            "buy_price": op["buy_price"],
+            "sell_price": op["sell_price"],
+            "profit": op["profit"],
+            "profit_margin": op["profit_margin"],
+            "buy_volume": op["buy_volume"],
+            "sell_volume": op["sell_volume"]
+        }
+        for op in opportunities
+    ]
@@ -0,0 +1,641 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+import aiohttp
+import numpy as np
+import requests
+from sqlalchemy import create_engine, func, insert, select, text
+from sqlalchemy.orm import sessionmaker
+
+from arbitrage import find_opportunities
+import hauling
+from bulk_write import BulkWriter
+from fetch_market import HISTORY_FIELDS
+from order_stats import aggregate_orders, process_orders
+from migrations import migration_metadata, upgrade
+from models import Base, Item, Region, MarketData, MarketLatest, OrderHistory
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Metric limits checked after a run; see check_thresholds
+DEFAULT_THRESHOLDS = os.path.join(HERE, "benchmark_thresholds.json")
+
+def timed(fn, *args, **kwargs):
+    """Run fn once and return (result, seconds)"""
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def synthetic_orders(count, types, seed=42):
+    """Generate columnar synthetic orders spread across the given number of types"""
+    rng = np.random.default_rng(seed)
+    type_ids = rng.integers(1, types + 1, size=count)
+    prices = np.round(rng.lognormal(mean=10, sigma=2, size=count), 2)
+    volumes = rng.integers(1, 10_000, size=count)
+    is_buy = rng.random(count) < 0.5
+    return type_ids, prices, volumes, is_buy
+
+def bench_orders(args):
+    """Compare per-type process_orders with the grouped aggregate_orders pass"""
+    type_ids, prices, volumes, is_buy = synthetic_orders(args.orders, args.types)
+    print(f"{args.orders:,} orders across {args.types:,} types")
+
+    # process_orders runs once per (type, region) on ESI order dicts
+    by_type = {}
+    for type_id, price, volume, buy in zip(type_ids.tolist(), prices.tolist(), volumes.tolist(), is_buy.tolist()):
+        by_type.setdefault(type_id, []).append(
+            {'type_id': type_id, 'price': price, 'volume_remain': volume, 'is_buy_order': buy}
+        )
+    legacy, legacy_time = timed(lambda: {t: process_orders(o) for t, o in by_type.items()})
+    print(f"process_orders:   {legacy_time * 1000:10.1f} ms")
+
+    columns, vector_time = timed(aggregate_orders, type_ids, prices, volumes, is_buy)
+    print(f"aggregate_orders: {vector_time * 1000:10.1f} ms  ({legacy_time / vector_time:.1f}x)")
+
+    # Cross-check a sample of types against the reference implementation
+    for i in range(0, len(columns['type_id']), max(1, len(columns['type_id']) // 50)):
+        expected = legacy[int(columns['type_id'][i])]
+        for field in ('buy_max', 'sell_min', 'sell_volume', 'buy_orders'):
+            assert np.isclose(columns[field][i], expected[field]), field
+    return {
+        'process_orders_ms': legacy_time * 1000,
+        'aggregate_orders_ms': vector_time * 1000,
+        'orders_per_second': args.orders / vector_time,
+    }
+
+def scratch_url(db_url=None):
+    return db_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+
+def scratch_session(db_url=None):
+    """Create a fresh schema on db_url (default: a temporary SQLite file)"""
+    engine = create_engine(scratch_url(db_url))
+    Base.metadata.drop_all(bind=engine)
+    migration_metadata.drop_all(bind=engine)
+    upgrade(engine)
+    return sessionmaker(bind=engine)()
+
+def synthetic_history(types, regions, days):
+    """Yield OrderHistory row dicts for a types x regions x days grid"""
+    start = datetime(2025, 1, 1)
+    for type_id in range(1, types + 1):
+        for region_id in range(1, regions + 1):
+            for day in range(days):
+                yield {
+                    'type_id': type_id, 'region_id': region_id,
+                    'date': start + timedelta(days=day),
+                    'average': 100.0, 'highest': 110.0, 'lowest': 90.0,
+                    'order_count': 10, 'volume': 1000
+                }
+
+def bench_writes(args):
+    """Compare per-row SELECT + add with batched ON CONFLICT upserts for order history"""
+    types, regions, days = args.types // 10 or 1, 5, 30
+    rows = list(synthetic_history(types, regions, days))
+    print(f"{len(rows):,} history rows ({types} types x {regions} regions x {days} days)")
+
+    metrics = {}
+    for label, key, write in (('per-row ORM', 'orm', write_history_orm), ('bulk upsert', 'bulk', write_history_bulk)):
+        db = scratch_session(args.db_url)
+        dialect = db.get_bind().dialect.name
+        db.add_all([Item(type_id=t, name=f"Item {t}") for t in range(1, types + 1)])
+        db.add_all([Region(region_id=r, name=f"Region {r}") for r in range(1, regions + 1)])
+        db.commit()
+        _, elapsed = timed(write, db, rows)
+        # Re-ingesting the same rows must not create duplicates
+        write_history_bulk(db, rows[:1000])
+        assert db.query(func.count(OrderHistory.id)).scalar() == len(rows)
+        print(f"{label:12}: {elapsed:8.2f} s  {len(rows) / elapsed:12,.0f} rows/s  ({dialect})")
+        metrics[f'{dialect}_{key}_rows_per_second'] = len(rows) / elapsed
+        db.close()
+    return metrics
+
+def write_history_orm(db, rows):
+    """The original ingest path: one existence SELECT per row"""
+    for row in rows:
+        existing = db.query(OrderHistory).filter(
+            OrderHistory.type_id == row['type_id'],
+            OrderHistory.region_id == row['region_id'],
+            OrderHistory.date == row['date']
+        ).first()
+        if not existing:
+            db.add(OrderHistory(**row))
+    db.commit()
+
+def write_history_bulk(db, rows):
+    writer = BulkWriter(db, update_columns={OrderHistory: HISTORY_FIELDS})
+    writer.add_all(OrderHistory, rows)
+    writer.flush()
+
+def synthetic_snapshot(types, regions, seed=7):
+    """Latest-snapshot columns for every type in every region"""
+    rng = np.random.default_rng(seed)
+    count = types * regions
+    base = np.repeat(rng.lognormal(mean=13, sigma=2, size=types), regions)
+    buy_max = base * rng.uniform(0.8, 1.1, size=count)
+    sell_min = base * rng.uniform(0.9, 1.2, size=count)
+    buy_max[rng.random(count) < 0.1] = np.nan  # regions without buy orders
+    return {
+        'type_id': np.repeat(np.arange(1, types + 1), regions),
+        'region_id': np.tile(np.arange(1, regions + 1), types),
+        'buy_max': buy_max,
+        'sell_min': sell_min,
+        'buy_volume': rng.integers(1, 1000, size=count),
+        'sell_volume': rng.integers(1, 1000, size=count),
+    }
+
+def brute_force_best(columns, type_id):
+    """Best profit for one type using the original O(regions^2) pair loop"""
+    rows = np.flatnonzero(columns['type_id'] == type_id)
+    best = None
+    for b in rows:
+        for s in rows:
+            if b == s or np.isnan(columns['buy_max'][b]):
+                continue
+            profit = columns['buy_max'][b] - columns['sell_min'][s]
+            best = profit if best is None else max(best, profit)
+    return best
+
+def bench_arbitrage(args):
+    """Top-N arbitrage selection on a full latest snapshot"""
+    types, regions = args.types, args.regions
+    columns = synthetic_snapshot(types, regions)
+    print(f"{types:,} types x {regions} regions")
+
+    metrics = {}
+    for per_type in (1, 3):
+        runs = [timed(find_opportunities, columns, 0, 50, per_type) for _ in range(5)]
+        opportunities = runs[-1][0]
+        best = min(elapsed for _, elapsed in runs)
+        print(f"per_type={per_type}: {best * 1000:8.1f} ms (best of 5)")
+        metrics[f'per_type_{per_type}_ms'] = best * 1000
+
+    for op in opportunities[:10:3]:
+        assert np.isclose(op['profit'], brute_force_best(columns, op['type_id']))
+    return metrics
+
+def synthetic_book(types, regions, seed=11):
+    """Both sides of a latest snapshot plus item volumes, as loaded for hauling"""
+    rng = np.random.default_rng(seed)
+    count = types * regions
+    base = np.repeat(rng.lognormal(mean=13, sigma=2, size=types), regions)
+    sell_min = base * rng.uniform(0.9, 1.2, size=count)
+    sell_max = sell_min * rng.uniform(1.0, 3.0, size=count)
+    buy_max = base * rng.uniform(0.8, 1.1, size=count)
+    buy_min = buy_max * rng.uniform(0.2, 1.0, size=count)
+    return {
+        'type_id': np.repeat(np.arange(1, types + 1), regions),
+        'region_id': np.tile(np.arange(1, regions + 1), types),
+        'buy_max': buy_max,
+        'buy_min': buy_min,
+        'buy_avg': buy_max - (buy_max - buy_min) * rng.uniform(0.05, 0.5, size=count),
+        'buy_volume': rng.integers(0, 100_000, size=count).astype(np.float64),
+        'sell_min': sell_min,
+        'sell_max': sell_max,
+        'sell_avg': sell_min + (sell_max - sell_min) * rng.uniform(0.05, 0.5, size=count),
+        'sell_volume': rng.integers(0, 100_000, size=count).astype(np.float64),
+        'item_volume': np.repeat(rng.choice([0.01, 0.1, 1.0, 5.0, 50.0, 2500.0], size=types), regions),
+    }
+
+def bench_hauling(args):
+    """Hauling search with bound pruning vs. walking every candidate pair"""
+    types, regions = args.types, args.regions
+    columns = synthetic_book(types, regions)
+    rng = np.random.default_rng(5)
+    jumps = {}
+    for a in range(1, regions + 1):
+        for b in range(a + 1, regions + 1):
+            jumps[(a, b)] = jumps[(b, a)] = int(rng.integers(1, 40))
+    print(f"{types:,} types x {regions} regions")
+
+    metrics = {}
+    for rank_by in hauling.RANK_METRICS:
+        pruned, pruned_time = min((timed(hauling.find_hauls, columns, 60000, 1e9, 0.036, rank_by, 0, None, 50, jumps) for _ in range(3)), key=lambda run: run[1])
+        factor = hauling.EVALUATE_FACTOR
+        hauling.EVALUATE_FACTOR = len(columns['type_id']) ** 2
+        try:
+            full, full_time = timed(hauling.find_hauls, columns, 60000, 1e9, 0.036, rank_by, 0, None, 50, jumps)
+        finally:
+            hauling.EVALUATE_FACTOR = factor
+        assert [h[rank_by] for h in pruned] == [h[rank_by] for h in full]
+        print(f"{rank_by:13} pruned: {pruned_time * 1000:8.1f} ms  exhaustive: {full_time * 1000:8.1f} ms")
+        metrics[f'{rank_by}_ms'] = pruned_time * 1000
+    return metrics
+
+# Hot read queries and the index each must use: (label, query builder, index)
+PLAN_CHECKS = [
+    (
+        "/market-data/{type_id} with region",
+        lambda db, since: db.query(MarketData).filter(
+            MarketData.type_id == 34, MarketData.region_id == 10000002, MarketData.timestamp >= since
+        ).order_by(MarketData.timestamp.desc()),
+        "uq_market_data_type_region_timestamp",
+    ),
+    (
+        "/price-trends/{type_id} history",
+        lambda db, since: db.query(OrderHistory).filter(
+            OrderHistory.type_id == 34, OrderHistory.region_id == 10000002, OrderHistory.date >= since
+        ).order_by(OrderHistory.date),
+        "uq_order_history_type_region_date",
+    ),
+    (
+        "/price-trends/{type_id} snapshots",
+        lambda db, since: db.query(MarketData).filter(
+            MarketData.type_id == 34, MarketData.region_id == 10000002, MarketData.timestamp >= since
+        ).order_by(MarketData.timestamp),
+        "uq_market_data_type_region_timestamp",
+    ),
+]
+
+def query_plan(db, query):
+    """Return the database's plan for an ORM query as one string"""
+    bind = db.get_bind()
+    compiled = query.statement.compile(bind, compile_kwargs={"literal_binds": True})
+    if bind.dialect.name == "sqlite":
+        rows = db.execute(text(f"EXPLAIN QUERY PLAN {compiled}"))
+        return "\n".join(row[-1] for row in rows)
+    # Tiny scratch tables would otherwise always be seq-scanned
+    db.execute(text("SET enable_seqscan = off"))
+    return "\n".join(row[0] for row in db.execute(text(f"EXPLAIN {compiled}")))
+
+def bench_plans(args):
+    """Regression check: hot time-range queries must be served by the composite indexes"""
+    db = scratch_session(args.db_url)
+    since = datetime(2025, 1, 1)
+    failures = 0
+    for label, build, index in PLAN_CHECKS:
+        plan = query_plan(db, build(db, since))
+        ok = index in plan
+        failures += not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {label}: expected {index}")
+        if not ok:
+            print("     " + plan.replace("\n", "\n     "))
+    db.close()
+    if failures:
+        raise SystemExit(f"{failures} query plan regression(s)")
+
+def seed_snapshot(db, types, regions):
+    """Fill items, regions and market_latest with a synthetic snapshot"""
+    columns = synthetic_snapshot(types, regions)
+    db.execute(insert(Item), [{'type_id': t, 'name': f"Item {t}", 'volume': 1.0} for t in range(1, types + 1)])
+    db.execute(insert(Region), [{'region_id': r, 'name': f"Region {r}"} for r in range(1, regions + 1)])
+    now = datetime.utcnow()
+    writer = BulkWriter(db)
+    for i in range(len(columns['type_id'])):
+        buy_max = columns['buy_max'][i]
+        writer.add(MarketLatest, {
+            'type_id': int(columns['type_id'][i]), 'region_id': int(columns['region_id'][i]),
+            'buy_max': None if np.isnan(buy_max) else float(buy_max),
+            'sell_min': float(columns['sell_min'][i]),
+            'buy_volume': int(columns['buy_volume'][i]), 'sell_volume': int(columns['sell_volume'][i]),
+            'buy_orders': 1, 'sell_orders': 1, 'timestamp': now
+        })
+    writer.flush()
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(process, port, name):
+    for _ in range(100):
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise SystemExit(f"{name} did not start")
+
+def start_api(db_url, workers=1):
+    """Run app.py under uvicorn in a subprocess against db_url and wait until it answers"""
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=HERE,
+        env={**os.environ, "DATABASE_URL": db_url},
+    )
+    wait_for_port(process, port, "API")
+    return process, f"http://127.0.0.1:{port}"
+
+def start_stub(args):
+    """Run esi_stub.py with a synthetic universe of --esi-types types"""
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, "esi_stub.py", "serve", "--port", str(port), "--types", str(args.esi_types),
+         "--error-rate", str(args.esi_error_rate)],
+        cwd=HERE,
+    )
+    wait_for_port(process, port, "ESI stub")
+    return process, f"http://127.0.0.1:{port}"
+
+def stub_requests(esi_url):
+    return requests.get(f"{esi_url}/_stub/stats").json()['requests']
+
+def run_ingest(db_url, esi_url, args):
+    """Run fetch_market.py against the stub and return its wall time, interpreter start included"""
+    env = {
+        **os.environ,
+        "DATABASE_URL": db_url,
+        "ESI_BASE_URL": esi_url,
+        # The stub is local, so ESI's own pacing would only measure the token bucket
+        "ESI_REQUESTS_PER_SECOND": str(args.esi_rate),
+        "ESI_MAX_IN_FLIGHT": "50",
+    }
+    result, elapsed = timed(subprocess.run, [sys.executable, "fetch_market.py"], cwd=HERE, env=env, capture_output=True, text=True)
+    if result.returncode:
+        print(result.stderr[-2000:])
+        raise SystemExit("Ingest failed")
+    return elapsed
+
+def stored_rows(db_url):
+    engine = create_engine(db_url)
+    try:
+        with engine.connect() as conn:
+            return {
+                table: conn.scalar(select(func.count()).select_from(text(table)))
+                for table in ("items", "market_data", "order_history", "order_book_depth", "price_rollups")
+            }
+    finally:
+        engine.dispose()
+
+def ingest_fixture(args):
+    """Scratch database filled by one ingest from a fresh stub; returns (db_url, stub, esi_url, seconds)"""
+    db_url = scratch_url(args.db_url)
+    scratch_session(db_url).close()
+    stub, esi_url = start_stub(args)
+    try:
+        elapsed = run_ingest(db_url, esi_url, args)
+    except BaseException:
+        stub.terminate()
+        raise
+    return db_url, stub, esi_url, elapsed
+
+def bench_ingest(args):
+    """Full ingest against the local ESI stand-in: a cold run, then a warm one with history still fresh"""
+    db_url, stub, esi_url, cold = ingest_fixture(args)
+    try:
+        cold_requests = stub_requests(esi_url)
+        rows = stored_rows(db_url)
+        warm = run_ingest(db_url, esi_url, args)
+        warm_requests = stub_requests(esi_url) - cold_requests
+    finally:
+        stub.terminate()
+        stub.wait()
+
+    total = sum(rows.values())
+    print(f"{args.esi_types:,} ESI types, rows stored: " + ", ".join(f"{table}={count:,}" for table, count in rows.items()))
+    print(f"cold: {cold:8.2f} s  {cold_requests:6,} requests  {total / cold:10,.0f} rows/s")
+    print(f"warm: {warm:8.2f} s  {warm_requests:6,} requests")
+    return {
+        'cold_seconds': cold,
+        'warm_seconds': warm,
+        'rows_per_second': total / cold,
+        'requests_per_second': cold_requests / cold,
+    }
+
+async def measure_latency(session, url_factory, duration):
+    """Issue requests back to back for `duration` seconds and return latencies in ms"""
+    latencies = []
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        async with session.get(url_factory()) as response:
+            await response.read()
+            assert response.status == 200, response.status
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+async def run_load(base_url, duration, arbitrage_clients):
+    # Random parameters defeat the response cache so every request hits the DB
+    items_url = lambda: f"{base_url}/items?skip={random.randint(0, 5000)}&limit=100"
+    arbitrage_url = lambda: f"{base_url}/arbitrage?min_profit={random.randint(0, 10**6)}"
+    async with aiohttp.ClientSession() as session:
+        # The first /arbitrage of a data generation loads the snapshot; keep it out of the numbers
+        async with session.get(arbitrage_url()) as response:
+            await response.read()
+        alone = await measure_latency(session, items_url, duration)
+        results = await asyncio.gather(
+            measure_latency(session, items_url, duration),
+            *[measure_latency(session, arbitrage_url, duration) for _ in range(arbitrage_clients)]
+        )
+    return alone, results[0], [latency for result in results[1:] for latency in result]
+
+def latency_summary(latencies):
+    """Printable n/p50/p99 line plus the p50 and p99 in ms"""
+    p50, p99 = np.percentile(latencies, [50, 99])
+    return f"n={len(latencies):6}  p50={p50:7.1f} ms  p99={p99:7.1f} ms", p50, p99
+
+def bench_load(args):
+    """p99 latency of /items alone and while /arbitrage runs in parallel"""
+    db_url = scratch_url(args.db_url)
+    db = scratch_session(db_url)
+    seed_snapshot(db, args.types, args.regions)
+    db.close()
+    print(f"{args.types:,} types x {args.regions} regions, {args.duration}s per phase")
+
+    process, base_url = start_api(db_url)
+    try:
+        alone, loaded, arbitrage = asyncio.run(run_load(base_url, args.duration, args.clients))
+    finally:
+        process.terminate()
+        process.wait()
+
+    metrics = {}
+    for label, key, latencies in (
+        ("/items alone:         ", 'items_alone', alone),
+        ("/items with arbitrage:", 'items_loaded', loaded),
+        ("/arbitrage:           ", 'arbitrage', arbitrage),
+    ):
+        line, _, p99 = latency_summary(latencies)
+        print(f"{label} {line}")
+        metrics[f'{key}_p99_ms'] = p99
+    return metrics
+
+def bench_api(args):
+    """Latency of /items, /arbitrage and /price-trends on a database ingested from the ESI stand-in"""
+    db_url, stub, _, _ = ingest_fixture(args)
+    stub.terminate()
+    stub.wait()
+    engine = create_engine(db_url)
+    with engine.connect() as conn:
+        pairs = conn.execute(text("SELECT DISTINCT type_id, region_id FROM order_history")).all()
+        type_ids = [type_id for (type_id,) in conn.execute(text("SELECT type_id FROM items"))]
+    engine.dispose()
+
+    # Random parameters keep most requests out of the response cache
+    endpoints = {
+        'items': lambda: f"/items?limit=100&search={random.choice(type_ids)}",
+        'arbitrage': lambda: f"/arbitrage?min_profit={random.randint(0, 10**6)}",
+        'price_trends': lambda: "/price-trends/{}?region_id={}&days={}".format(*random.choice(pairs), random.randint(7, 60)),
+    }
+    process, base_url = start_api(db_url)
+
+    async def run():
+        async with aiohttp.ClientSession() as session:
+            results = {}
+            for name, path in endpoints.items():
+                # Warm-up request: the first /arbitrage of a generation loads the snapshot
+                async with session.get(base_url + path()) as response:
+                    await response.read()
+                results[name] = await measure_latency(session, lambda: base_url + path(), args.duration)
+            return results
+
+    try:
+        latencies = asyncio.run(run())
+    finally:
+        process.terminate()
+        process.wait()
+
+    metrics = {}
+    print(f"{len(type_ids):,} items, {len(pairs):,} history pairs, {args.duration}s per endpoint")
+    for name, values in latencies.items():
+        line, p50, p99 = latency_summary(values)
+        print(f"{name:13} {line}")
+        metrics[f'{name}_p50_ms'] = p50
+        metrics[f'{name}_p99_ms'] = p99
+    return metrics
+
+# Modules the API loads on first use only; importing app must not pull them in
+LAZY_MODULES = ("aiohttp", "esi_client", "fetch_market", "pipeline", "requests", "uvicorn")
+
+def import_profile(env):
+    """`import app` in a fresh interpreter under -X importtime.
+
+    Returns {module: (self_us, cumulative_us)} for every module the import
+    loaded, as timed by the interpreter itself.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"], cwd=HERE, env=env, capture_output=True, text=True)
+    if result.returncode:
+        print(result.stderr[-2000:])
+        raise SystemExit("Importing app failed")
+    profile = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        profile[name.strip()] = (int(self_us), int(cumulative_us))
+    return profile
+
+def is_app_module(name):
+    return os.path.exists(os.path.join(HERE, name.split(".")[0] + ".py"))
+
+def time_to_first_response(db_url, workers):
+    """Seconds from launching uvicorn with `workers` API processes until GET / answers"""
+    port = free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=HERE,
+        # The schema is migrated beforehand, as in a multi-worker deployment
+        env={**os.environ, "DATABASE_URL": db_url, "DB_UPGRADE_ON_STARTUP": "false"},
+    )
+    try:
+        while time.perf_counter() - start < 30:
+            try:
+                if requests.get(f"http://127.0.0.1:{port}/", timeout=1).ok:
+                    return time.perf_counter() - start
+            except requests.ConnectionError:
+                pass
+            time.sleep(0.01)
+        raise SystemExit("API did not start")
+    finally:
+        process.terminate()
+        process.wait()
+
+def bench_startup(args):
+    """Cold start of the API: `import app` in a fresh interpreter and time to first response"""
+    db_url = scratch_url(args.db_url)
+    scratch_session(db_url).close()
+    env = {**os.environ, "DATABASE_URL": db_url}
+    profiles = [import_profile(env) for _ in range(5)]
+    import_ms = float(np.median([profile["app"][1] for profile in profiles])) / 1000
+    # Time spent executing this repository's own modules, dependencies excluded
+    app_modules_ms = float(np.median([
+        sum(self_us for name, (self_us, _) in profile.items() if is_app_module(name)) for profile in profiles
+    ])) / 1000
+    eager = sorted({name for profile in profiles for name in profile if name.split(".")[0] in LAZY_MODULES})
+    first_response = time_to_first_response(db_url, args.api_workers)
+
+    print(f"import app:       {import_ms:8.1f} ms (median of {len(profiles)}, -X importtime)")
+    print(f"  app modules:    {app_modules_ms:8.1f} ms")
+    if eager:
+        print(f"  loaded eagerly: {', '.join(eager)}")
+    print(f"first response:   {first_response:8.2f} s ({args.api_workers} workers, interpreter start included)")
+    return {
+        'import_ms': import_ms,
+        'app_modules_ms': app_modules_ms,
+        'lazy_modules_imported': len({name.split(".")[0] for name in eager}),
+        'first_response_seconds': first_response,
+    }
+
+def check_thresholds(results, path):
+    """Compare measured metrics with {"bench.metric": {"max": x} or {"min": y}} limits.
+
+    Only metrics measured in this run are checked; any breach exits non-zero.
+    """
+    with open(path) as f:
+        thresholds = json.load(f)
+    failures = 0
+    print("== thresholds")
+    for metric, limits in thresholds.items():
+        if metric not in results:
+            continue
+        value = results[metric]
+        ok = value <= limits.get("max", float("inf")) and value >= limits.get("min", float("-inf"))
+        failures += not ok
+        bounds = ", ".join(f"{bound} {limit:,}" for bound, limit in limits.items())
+        print(f"{'ok  ' if ok else 'FAIL'} {metric}: {value:,.1f} ({bounds})")
+    if failures:
+        raise SystemExit(f"{failures} benchmark threshold(s) exceeded")
+
+BENCHMARKS = {
+    'orders': bench_orders,
+    'writes': bench_writes,
+    'arbitrage': bench_arbitrage,
+    'hauling': bench_hauling,
+    'plans': bench_plans,
+    'load': bench_load,
+    'ingest': bench_ingest,
+    'api': bench_api,
+    'startup': bench_startup,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="EVE Trading Tool benchmarks")
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS) + ['all'])
+    parser.add_argument('--orders', type=int, default=1_000_000)
+    parser.add_argument('--types', type=int, default=10_000)
+    parser.add_argument('--regions', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=10, help="seconds per load phase")
+    parser.add_argument('--clients', type=int, default=2, help="concurrent /arbitrage clients")
+    parser.add_argument('--db-url', default=None, help="scratch database (default: temporary SQLite file)")
+    parser.add_argument('--esi-types', type=int, default=2000, help="types in the ESI stand-in's universe")
+    parser.add_argument('--esi-rate', type=float, default=2000, help="ESI_REQUESTS_PER_SECOND for ingests against the stand-in")
+    parser.add_argument('--esi-error-rate', type=float, default=0.0, help="share of stand-in requests failing with 502")
+    parser.add_argument('--api-workers', type=int, default=2, help="uvicorn workers for the startup benchmark")
+    parser.add_argument('--thresholds', default=DEFAULT_THRESHOLDS, help="metric limits to check, '' to skip")
+    parser.add_argument('--output', help="write the measured metrics to this JSON file")
+    args = parser.parse_args()
+
+    results = {}
+    for name, bench in BENCHMARKS.items():
+        if args.benchmark in (name, 'all'):
+            print(f"== {name}")
+            metrics = bench(args) or {}
+            results.update((f"{name}.{key}", value) for key, value in metrics.items())
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.thresholds:
+        check_thresholds(results, args.thresholds)
@@ -0,0 +1,151 @@
+import os
+from datetime import datetime
+from sqlalchemy import insert as generic_insert, update
+from sqlalchemy.dialects import postgresql, sqlite
+import logging
+
+from models import DataGeneration
+
+logger = logging.getLogger(__name__)
+
+# Rows buffered per table before an INSERT batch is sent and committed
+DB_BATCH_SIZE = int(os.getenv("DB_BATCH_SIZE", "5000"))
+
+def insert_for(bind, table):
+    """Return a dialect-specific INSERT construct that supports ON CONFLICT"""
+    dialect = bind.dialect.name
+    if dialect == "postgresql":
+        return postgresql.insert(table)
+    if dialect == "sqlite":
+        return sqlite.insert(table)
+    return generic_insert(table)
+
+def upsert_statement(bind, table, conflict_columns, update_columns=None, version_column=None):
+    """Build INSERT ... ON CONFLICT DO NOTHING, or DO UPDATE of update_columns.
+
+    conflict_columns must match a unique index on the table. With
+    version_column the update only applies where the incoming value is at
+    least the stored one, so an out-of-order writer cannot replace newer
+    data with older. Dialects without ON CONFLICT support get a plain INSERT.
+    """
+    stmt = insert_for(bind, table)
+    if not hasattr(stmt, "on_conflict_do_nothing"):
+        return stmt
+    if not update_columns:
+        return stmt.on_conflict_do_nothing(index_elements=conflict_columns)
+    return stmt.on_conflict_do_update(
+        index_elements=conflict_columns,
+        set_={column: stmt.excluded[column] for column in update_columns},
+        where=table.c[version_column] <= stmt.excluded[version_column] if version_column else None
+    )
+
+def upsert_rows(db, model, rows, update_columns=None, returning=False):
+    """Insert a batch of row dicts for model using its upsert conflict key (and version column, if any).
+
+    Returns the number of rows sent, or with returning the rows the
+    database wrote; under ON CONFLICT DO NOTHING those are only the rows
+    actually inserted.
+    """
+    if not rows:
+        return [] if returning else 0
+    stmt = upsert_statement(
+        db.get_bind(), model.__table__, model.__upsert_key__, update_columns,
+        getattr(model, "__upsert_version__", None)
+    )
+    # A list of parameter sets runs as a batched executemany ("insertmanyvalues")
+    if returning:
+        return db.execute(stmt.returning(*model.__table__.c), rows).all()
+    db.execute(stmt, rows)
+    return len(rows)
+
+def bump_generation(db):
+    """Advance the data generation inside the caller's transaction.
+
+    Read caches key on this counter, so it must be bumped in the same
+    transaction that commits new data.
+    """
+    db.execute(
+        update(DataGeneration)
+        .where(DataGeneration.id == 1)
+        .values(generation=DataGeneration.generation + 1, updated_at=datetime.utcnow())
+    )
+
+class BulkWriter:
+    """Buffers rows per model and writes them in large upsert batches.
+
+    Each model must define __upsert_key__, the columns of its unique index.
+    Batches are flushed and committed once batch_size rows are pending, so
+    transactions are sized by row count rather than by item. Committed
+    rows only invalidate read caches once publish() advances the data
+    generation, so callers publish at the end of a stage rather than
+    every batch.
+    """
+
+    def __init__(self, db, batch_size=DB_BATCH_SIZE, update_columns=None, on_flush=None, on_publish=None, on_insert=None):
+        self.db = db
+        self.batch_size = batch_size
+        # Called with the row count of every committed batch
+        self.on_flush = on_flush
+        # Called after every publish that advanced the data generation
+        self.on_publish = on_publish
+        # model -> columns to refresh on conflict; models not listed DO NOTHING
+        self.update_columns = update_columns or {}
+        # model -> called with the rows each batch wrote, before it commits
+        self.on_insert = on_insert or {}
+        self.pending = {}
+        self.pending_count = 0
+        self.rows_written = 0
+        # Rows committed since the last publish()
+        self.unpublished = 0
+
+    def add(self, model, row):
+        self.pending.setdefault(model, []).append(row)
+        self.pending_count += 1
+        if self.pending_count >= self.batch_size:
+            self.flush()
+
+    def add_all(self, model, rows):
+        for row in rows:
+            self.add(model, row)
+
+    def flush(self):
+        if not self.pending_count:
+            return
+        try:
+            batch_rows = 0
+            for model, rows in self.pending.items():
+                on_insert = self.on_insert.get(model)
+                if on_insert:
+                    on_insert(upsert_rows(self.db, model, rows, self.update_columns.get(model), returning=True))
+                    batch_rows += len(rows)
+                else:
+                    batch_rows += upsert_rows(self.db, model, rows, self.update_columns.get(model))
+            self.db.commit()
+            self.rows_written += batch_rows
+            self.unpublished += batch_rows
+            if self.on_flush:
+                self.on_flush(batch_rows)
+        except Exception:
+            self.db.rollback()
+            raise
+        finally:
+            self.pending = {}
+            self.pending_count = 0
+        logger.info(f"Committed batch, {self.rows_written} rows written so far")
+
+    def publish(self, flush=True):
+        """Commit pending rows and advance the data generation once for
+        everything committed since the last publish.
+
+        With flush=False pending rows are left alone, so a failed stage can
+        still publish the batches it did commit.
+        """
+        if flush:
+            self.flush()
+        if not self.unpublished:
+            return
+        bump_generation(self.db)
+        self.db.commit()
+        self.unpublished = 0
+        if self.on_publish:
+            self.on_publish()
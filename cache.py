@@ -0,0 +1,76 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import select
+
+from models import DataGeneration
+
+# Cached responses kept in memory and how long one may be served
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "256"))
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", "300"))
+
+class ResponseCache:
+    """LRU cache of encoded JSON bodies tagged with the data generation they were built from"""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, generation):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            body, entry_generation, expires = entry
+            if entry_generation != generation or expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return body
+
+    def put(self, key, generation, body):
+        with self.lock:
+            self.entries[key] = (body, generation, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+response_cache = ResponseCache()
+
+async def current_generation(db):
+    """Read the data generation bumped once per published ingest stage"""
+    return await db.scalar(select(DataGeneration.generation).where(DataGeneration.id == 1)) or 0
+
+async def cached_json(request: Request, db, compute):
+    """Serve the awaited compute()'s result from the cache, keyed on path, query and data generation.
+
+    Responses carry an ETag derived from the generation and the request, so
+    a client that polls with If-None-Match gets an empty 304 until the next
+    ingest stage is published, and a tag from one endpoint or query never
+    validates another.
+    """
+    generation = await current_generation(db)
+    key = (request.url.path, tuple(sorted(request.query_params.multi_items())))
+    request_hash = hashlib.sha1(repr(key).encode()).hexdigest()[:12]
+    etag = f'W/"g{generation}-{request_hash}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+    if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    body = response_cache.get(key, generation)
+    if body is None:
+        body = json.dumps(jsonable_encoder(await compute()), separators=(",", ":")).encode()
+        response_cache.put(key, generation, body)
+    return Response(content=body, media_type="application/json", headers=headers)
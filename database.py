@@ -1,16 +1,83 @@
+import asyncio
 import os
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 from dotenv import load_dotenv
 
+from metrics import instrument_engine
+
 load_dotenv()
 
 DB_URL = os.getenv("DATABASE_URL", "sqlite:///./market.db")
+
+# Connection pool sizing for the API's async engine (ignored by SQLite)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+# Connections the API opens at startup, so the first requests find them ready
+DB_POOL_WARMUP = int(os.getenv("DB_POOL_WARMUP", str(DB_POOL_SIZE)))
+# Apply pending migrations when the API starts. Turn off where several API
+# processes share a database and `python migrations.py upgrade` runs first
+DB_UPGRADE_ON_STARTUP = os.getenv("DB_UPGRADE_ON_STARTUP", "true").lower() in ("1", "true", "yes")
+
 engine = create_engine(
-    DB_URL, 
+    DB_URL,
     connect_args={"check_same_thread": False} if DB_URL.startswith("sqlite") else {}
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+instrument_engine(engine, "ingest")
+
+def async_url(url):
+    """Map a sync database URL onto its asyncio driver (aiosqlite / asyncpg)"""
+    scheme, rest = url.split("://", 1)
+    base = scheme.split("+", 1)[0]
+    if base == "sqlite":
+        return f"sqlite+aiosqlite://{rest}"
+    if base in ("postgresql", "postgres"):
+        return f"postgresql+asyncpg://{rest}"
+    return url
+
+def create_api_engine(url=DB_URL):
+    options = {}
+    if url.startswith("sqlite"):
+        if ":memory:" in url or url.rstrip("/").endswith("sqlite:"):
+            return create_async_engine(async_url(url))
+        # aiosqlite defaults to NullPool, which opens a connection (and its
+        # worker thread) per request; keep them pooled like a server database
+        options["poolclass"] = AsyncAdaptedQueuePool
+    else:
+        options["pool_pre_ping"] = True
+    return create_async_engine(
+        async_url(url),
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        **options
+    )
+
+async_engine = create_api_engine()
+instrument_engine(async_engine.sync_engine, "api")
+# Objects stay readable after commit so responses can be encoded afterwards
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+async def warm_pool(engine=async_engine, connections=DB_POOL_WARMUP):
+    """Open up to `connections` pooled connections at once and return them to
+    the pool; returns how many were opened"""
+    pool = engine.sync_engine.pool
+    if not isinstance(pool, QueuePool):
+        return 0
+    opened = await asyncio.gather(
+        *(engine.connect().start() for _ in range(min(connections, pool.size()))),
+        return_exceptions=True
+    )
+    connected = [conn for conn in opened if not isinstance(conn, BaseException)]
+    await asyncio.gather(*(conn.close() for conn in connected))
+    for error in opened:
+        if isinstance(error, BaseException):
+            raise error
+    return len(connected)
 
 def get_db():
     db = SessionLocal()
@@ -19,3 +86,6 @@ def get_db():
     finally:
         db.close()
 
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
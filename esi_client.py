@@ -0,0 +1,212 @@
+import asyncio
+import os
+import random
+import time
+from collections import namedtuple
+from urllib.parse import urlsplit
+import aiohttp
+import logging
+
+from metrics import esi_endpoint, esi_request_seconds, esi_requests
+
+logger = logging.getLogger(__name__)
+
+# Scheduler tuning, overridable via environment
+ESI_MAX_IN_FLIGHT = int(os.getenv("ESI_MAX_IN_FLIGHT", "20"))
+ESI_MAX_RETRIES = int(os.getenv("ESI_MAX_RETRIES", "4"))
+ESI_CONNECTIONS_PER_HOST = int(os.getenv("ESI_CONNECTIONS_PER_HOST", "30"))
+ESI_REQUESTS_PER_SECOND = float(os.getenv("ESI_REQUESTS_PER_SECOND", "100"))
+ESI_ERROR_LIMIT_MARGIN = int(os.getenv("ESI_ERROR_LIMIT_MARGIN", "10"))
+
+# Statuses worth retrying: ESI error limit, rate limit and transient server errors
+RETRY_STATUSES = {420, 429, 500, 502, 503, 504}
+
+ESIResponse = namedtuple("ESIResponse", ["status", "headers", "data"])
+
+class TokenBucket:
+    """Classic token bucket limiting the request start rate"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class ErrorLimitGuard:
+    """Tracks ESI's error budget from the X-ESI-Error-Limit-* headers.
+
+    ESI allows a fixed number of 4xx/5xx responses per window and bans the
+    client once the budget is exhausted. Every request in flight may still
+    cost one error, so a request is only sent while the remaining budget
+    minus the requests in flight stays above the margin; otherwise it waits
+    for an answer or, once the budget is down to the margin, for the window
+    to reset.
+    """
+
+    def __init__(self, margin=ESI_ERROR_LIMIT_MARGIN):
+        self.margin = margin
+        self.remain = None
+        self.reset_at = 0.0
+        self.in_flight = 0
+        self.answered = asyncio.Event()
+
+    def update(self, headers):
+        remain = headers.get("X-ESI-Error-Limit-Remain")
+        reset = headers.get("X-ESI-Error-Limit-Reset")
+        if remain is None or reset is None:
+            return
+        try:
+            self.remain = int(remain)
+            self.reset_at = time.monotonic() + int(reset)
+        except ValueError:
+            return
+
+    def block_until_reset(self, seconds):
+        """Stop issuing requests for the given number of seconds"""
+        self.remain = 0
+        self.reset_at = max(self.reset_at, time.monotonic() + seconds)
+
+    async def acquire(self):
+        """Wait until a request fits the error budget and count it as in flight"""
+        # An exhausted budget blocks whatever the margin
+        margin = max(self.margin, 0)
+        while self.remain is not None and self.remain - self.in_flight <= margin:
+            if self.remain > margin:
+                # Requests in flight could use up the rest; wait for one to answer
+                self.answered.clear()
+                await self.answered.wait()
+                continue
+            delay = self.reset_at - time.monotonic()
+            if delay <= 0:
+                self.remain = None
+                break
+            logger.warning(f"ESI error budget low ({self.remain} left), pausing {delay:.1f}s")
+            await asyncio.sleep(delay)
+        self.in_flight += 1
+
+    def release(self, status=None, headers=None):
+        """Record the answer to a request counted by acquire(), before the next one is sent"""
+        self.in_flight -= 1
+        if headers is not None:
+            self.update(headers)
+        if status == 420:
+            # Error limited: nobody may send until the window resets
+            reset = headers.get("X-ESI-Error-Limit-Reset", "60") if headers is not None else "60"
+            self.block_until_reset(int(reset) if reset.isdigit() else 60)
+        self.answered.set()
+
+class FetchScheduler:
+    """Bounded-concurrency GET scheduler for ESI.
+
+    Limits the number of requests in flight, paces request starts with a
+    token bucket, honours the ESI error limit and retries transient failures
+    with full-jitter exponential backoff.
+    """
+
+    def __init__(
+        self,
+        max_in_flight=ESI_MAX_IN_FLIGHT,
+        requests_per_second=ESI_REQUESTS_PER_SECOND,
+        max_retries=ESI_MAX_RETRIES,
+        connections_per_host=ESI_CONNECTIONS_PER_HOST,
+        backoff_base=0.5,
+        backoff_cap=30.0,
+        timeout=30,
+        error_limit_margin=ESI_ERROR_LIMIT_MARGIN,
+        on_request=None,
+    ):
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.connections_per_host = connections_per_host
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+        self.bucket = TokenBucket(requests_per_second)
+        self.error_limit = ErrorLimitGuard(error_limit_margin)
+        # Called once per HTTP request sent, retries included
+        self.on_request = on_request
+        self.session = None
+
+    async def __aenter__(self):
+        # One pooled connector, capped per host so ESI sees keep-alive reuse
+        connector = aiohttp.TCPConnector(
+            limit=max(self.max_in_flight, self.connections_per_host),
+            limit_per_host=self.connections_per_host,
+            ttl_dns_cache=300,
+        )
+        self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self.session:
+            await self.session.close()
+
+    def backoff(self, attempt):
+        """Full-jitter exponential backoff delay for the given attempt"""
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    async def get(self, url, params=None, headers=None, raw=False):
+        """GET a URL and return an ESIResponse with the decoded JSON body, or the undecoded bytes if raw"""
+        return await self.request("GET", url, params=params, headers=headers, raw=raw)
+
+    async def post(self, url, json=None, params=None, headers=None):
+        """POST a JSON body, for ESI's bulk lookup endpoints"""
+        return await self.request("POST", url, params=params, headers=headers, json=json)
+
+    async def request(self, method, url, params=None, headers=None, json=None, raw=False):
+        """Send a request and return an ESIResponse with the decoded JSON body.
+
+        With raw the body is returned as bytes, for callers that decode it
+        off the event loop. Non-retryable errors are returned as-is; network errors and retryable
+        statuses are retried until max_retries is exhausted.
+        """
+        endpoint = esi_endpoint(urlsplit(url).path)
+        attempt = 0
+        while True:
+            await self.bucket.acquire()
+            if self.on_request:
+                self.on_request()
+            status = "error"
+            try:
+                async with self.semaphore:
+                    # Checked in the slot, so requests queued behind it see the latest budget
+                    await self.error_limit.acquire()
+                    response_headers = None
+                    started = time.perf_counter()
+                    try:
+                        async with self.session.request(method, url, params=params, headers=headers, json=json) as response:
+                            status = response.status
+                            response_headers = response.headers
+                            data = None
+                            if response.status == 200:
+                                data = await response.read() if raw else await response.json(content_type=None)
+                            result = ESIResponse(response.status, response.headers, data)
+                    finally:
+                        self.error_limit.release(status, response_headers)
+                        esi_request_seconds.observe(time.perf_counter() - started, endpoint=endpoint, method=method)
+                        esi_requests.inc(endpoint=endpoint, method=method, status=status)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.backoff(attempt)
+                logger.warning(f"Request to {url} failed ({e}), retrying in {delay:.1f}s")
+            else:
+                if result.status not in RETRY_STATUSES or attempt >= self.max_retries:
+                    return result
+                delay = self.backoff(attempt)
+                logger.warning(f"Request to {url} returned {result.status}, retrying in {delay:.1f}s")
+            attempt += 1
+            await asyncio.sleep(delay)
@@ -0,0 +1,408 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import random
+import time
+from datetime import date, timedelta
+from email.utils import formatdate
+import numpy as np
+from aiohttp import ClientSession, web
+
+logger = logging.getLogger(__name__)
+
+# The ingest's trade hub regions and their hub station
+HUB_STATIONS = {
+    10000002: 60003760,
+    10000043: 60008494,
+    10000032: 60011866,
+    10000030: 60004588,
+    10000042: 60005686,
+}
+
+# ESI page sizes
+TYPES_PAGE_SIZE = 1000
+ORDERS_PAGE_SIZE = 1000
+
+# First synthetic type ID; every tenth type has no market group
+FIRST_TYPE_ID = 1000
+UNPUBLISHED_EVERY = 10
+
+# Response headers kept when recording
+RECORDED_HEADERS = ("ETag", "Expires", "Last-Modified", "X-Pages")
+
+class SyntheticUniverse:
+    """Deterministic types, order books and history derived from a seed.
+
+    Every value is drawn from a generator seeded with the seed and the
+    IDs involved, so two servers with the same parameters serve identical
+    data and one type's numbers do not depend on how many others exist.
+    """
+
+    def __init__(self, types=1000, regions=tuple(HUB_STATIONS), orders_per_type=20, history_days=60, seed=1):
+        self.type_ids = list(range(FIRST_TYPE_ID, FIRST_TYPE_ID + types))
+        self.known_types = set(self.type_ids)
+        self.regions = list(regions)
+        self.orders_per_type = orders_per_type
+        self.history_days = history_days
+        self.seed = seed
+        self.books = {}
+
+    def rng(self, *ids):
+        return np.random.default_rng([self.seed, *ids])
+
+    def base_price(self, type_id):
+        return float(np.round(self.rng(type_id).lognormal(mean=10, sigma=2), 2))
+
+    def type_info(self, type_id):
+        if type_id not in self.known_types:
+            return None
+        rng = self.rng(type_id, 0)
+        return {
+            'type_id': type_id,
+            'name': f"Synthetic Item {type_id}",
+            'group_id': int(rng.integers(1, 2000)),
+            'market_group_id': None if type_id % UNPUBLISHED_EVERY == 0 else int(rng.integers(1, 3000)),
+            'volume': float(rng.choice([0.01, 0.1, 1.0, 5.0, 50.0, 2500.0])),
+            'description': "",
+            'published': True,
+        }
+
+    def book(self, region_id):
+        """Columnar order book of a region, built once and kept"""
+        if region_id not in self.books:
+            rng = self.rng(region_id)
+            tradeable = np.array([t for t in self.type_ids if t % UNPUBLISHED_EVERY], dtype=np.int64)
+            counts = rng.poisson(self.orders_per_type, size=len(tradeable))
+            type_ids = np.repeat(tradeable, counts)
+            base = np.repeat(np.array([self.base_price(t) for t in tradeable.tolist()]), counts)
+            # Regions price a type differently so there is something to arbitrage
+            region_skew = np.repeat(rng.uniform(0.9, 1.1, size=len(tradeable)), counts)
+            is_buy = rng.random(len(type_ids)) < 0.5
+            spread = rng.uniform(0.0, 0.15, size=len(type_ids))
+            prices = np.round(base * region_skew * np.where(is_buy, 0.97 - spread, 1.0 + spread), 2)
+            volume_total = rng.integers(1, 10_000, size=len(type_ids))
+            self.books[region_id] = {
+                'order_id': region_id * 10_000_000 + np.arange(len(type_ids)),
+                'type_id': type_ids,
+                'price': prices,
+                'volume_total': volume_total,
+                'volume_remain': np.maximum(1, (volume_total * rng.uniform(0.05, 1.0, size=len(type_ids))).astype(np.int64)),
+                'is_buy_order': is_buy,
+            }
+        return self.books[region_id]
+
+    def orders(self, region_id, type_id=None, page=1):
+        """One page of a region's orders as ESI dicts, optionally for one type only; returns (orders, pages)"""
+        book = self.book(region_id)
+        rows = np.flatnonzero(book['type_id'] == type_id) if type_id is not None else np.arange(len(book['type_id']))
+        rows, pages = page_of(rows, page, ORDERS_PAGE_SIZE)
+        columns = {name: values[rows].tolist() for name, values in book.items()}
+        location_id = HUB_STATIONS.get(region_id, 60000000 + region_id % 1000)
+        return [
+            {
+                'order_id': columns['order_id'][i],
+                'type_id': columns['type_id'][i],
+                'location_id': location_id,
+                'system_id': 30000000 + region_id % 10000,
+                'price': columns['price'][i],
+                'volume_total': columns['volume_total'][i],
+                'volume_remain': columns['volume_remain'][i],
+                'min_volume': 1,
+                'is_buy_order': columns['is_buy_order'][i],
+                'duration': 90,
+                'issued': "2025-01-01T00:00:00Z",
+                'range': "region",
+            }
+            for i in range(len(rows))
+        ], pages
+
+    def history(self, region_id, type_id):
+        """Daily history up to yesterday, as a random walk around the base price"""
+        if type_id not in self.known_types or type_id % UNPUBLISHED_EVERY == 0:
+            return []
+        rng = self.rng(region_id, type_id)
+        days = self.history_days
+        walk = self.base_price(type_id) * np.exp(np.cumsum(rng.normal(0, 0.02, size=days)))
+        high = walk * rng.uniform(1.0, 1.05, size=days)
+        low = walk * rng.uniform(0.95, 1.0, size=days)
+        volume = rng.integers(1, 100_000, size=days)
+        order_count = rng.integers(1, 500, size=days)
+        first = date.today() - timedelta(days=days)
+        return [
+            {
+                'date': (first + timedelta(days=i)).isoformat(),
+                'average': round(float(walk[i]), 2),
+                'highest': round(float(high[i]), 2),
+                'lowest': round(float(low[i]), 2),
+                'volume': int(volume[i]),
+                'order_count': int(order_count[i]),
+            }
+            for i in range(days)
+        ]
+
+def page_of(items, page, size):
+    pages = max(1, -(-len(items) // size))
+    return items[(page - 1) * size:page * size], pages
+
+def replay_key(method, path, query, body=None):
+    """Identity of a request for replay: method, path, sorted query and POST body"""
+    key = [method, path.rstrip("/") + "/", sorted(query.items())]
+    if body:
+        key.append(hashlib.sha1(body).hexdigest())
+    return json.dumps(key)
+
+def load_replay(path):
+    """Recorded responses keyed by replay_key, last recording winning"""
+    responses = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                responses[entry['key']] = entry
+    return responses
+
+class ErrorBudget:
+    """ESI's error limit: a number of 4xx/5xx answers allowed per window.
+
+    Once the budget is used up every request is answered with a 420 until
+    the window resets, as ESI does.
+    """
+
+    def __init__(self, budget=100, window=60):
+        self.budget = budget
+        self.window = window
+        self.remain = budget
+        self.window_start = time.monotonic()
+
+    def reset_in(self):
+        """Whole seconds until the window resets, opening a new one when it has"""
+        elapsed = time.monotonic() - self.window_start
+        if elapsed >= self.window:
+            self.window_start += elapsed // self.window * self.window
+            self.remain = self.budget
+            elapsed = time.monotonic() - self.window_start
+        return max(1, math.ceil(self.window - elapsed))
+
+    @property
+    def exhausted(self):
+        self.reset_in()
+        return self.remain <= 0
+
+    def count(self, status):
+        if 400 <= status < 600 and status != 420:
+            self.remain = max(0, self.remain - 1)
+
+    def headers(self):
+        reset = self.reset_in()
+        return {"X-ESI-Error-Limit-Remain": str(self.remain), "X-ESI-Error-Limit-Reset": str(reset)}
+
+def build_app(universe, replay=None, error_rate=0.0, history_expires=300, latency=0.0,
+              error_status=502, error_budget=100, error_window=60):
+    """aiohttp app serving universe, with recorded responses taking precedence.
+
+    error_rate is the share of requests answered with error_status to
+    exercise the client's retries. Every 4xx/5xx answer counts against an
+    error budget of error_budget per error_window seconds, reported in the
+    X-ESI-Error-Limit-* headers; once it is used up requests get a 420
+    until the window resets. latency delays every answer by that many
+    seconds. History expires history_expires seconds after it is served,
+    like ESI's cache window.
+    """
+    app = web.Application()
+    hits = {}
+    statuses = {}
+    budget = ErrorBudget(error_budget, error_window)
+    # Seeded so injected failures are reproducible too
+    failures = random.Random(universe.seed)
+    started = formatdate(time.time(), usegmt=True)
+
+    def respond(request, data, headers=None):
+        return web.json_response(data, headers=headers)
+
+    async def answer(request, handler):
+        if latency:
+            await asyncio.sleep(latency)
+        if budget.exhausted:
+            return web.json_response({"error": "This software has exceeded the error limit for ESI."}, status=420)
+        if replay:
+            body = await request.read() if request.method == "POST" else None
+            entry = replay.get(replay_key(request.method, request.path, dict(request.query), body))
+            if entry:
+                return web.Response(
+                    status=entry['status'],
+                    headers=entry['headers'],
+                    body=entry['body'].encode() if entry['body'] is not None else None,
+                    content_type="application/json" if entry['body'] is not None else None
+                )
+        if error_rate and failures.random() < error_rate:
+            return web.json_response({"error": "injected failure"}, status=error_status)
+        return await handler(request)
+
+    @web.middleware
+    async def stub_middleware(request, handler):
+        if request.path.startswith("/_stub/"):
+            return await handler(request)
+        route = request.match_info.route.resource.canonical if request.match_info.route.resource else "unmatched"
+        hits[route] = hits.get(route, 0) + 1
+        try:
+            response = await answer(request, handler)
+        except web.HTTPException as e:
+            response = e
+        budget.count(response.status)
+        statuses[str(response.status)] = statuses.get(str(response.status), 0) + 1
+        response.headers.update(budget.headers())
+        return response
+
+    app.middlewares.append(stub_middleware)
+
+    async def types(request):
+        data, pages = page_of(universe.type_ids, int(request.query.get("page", 1)), TYPES_PAGE_SIZE)
+        return respond(request, data, {"X-Pages": str(pages)})
+
+    async def type_info(request):
+        info = universe.type_info(int(request.match_info["type_id"]))
+        if info is None:
+            return web.json_response({"error": "Type not found!"}, status=404)
+        return respond(request, info)
+
+    async def regions(request):
+        return respond(request, universe.regions)
+
+    async def names(request):
+        ids = await request.json()
+        return respond(request, [
+            {'id': type_id, 'name': f"Synthetic Item {type_id}", 'category': "inventory_type"}
+            for type_id in ids if type_id in universe.known_types
+        ] + [
+            {'id': region_id, 'name': f"Synthetic Region {region_id}", 'category': "region"}
+            for region_id in ids if region_id in universe.regions
+        ])
+
+    async def orders(request):
+        region_id = int(request.match_info["region_id"])
+        if region_id not in universe.regions:
+            return web.json_response({"error": "Region not found!"}, status=404)
+        type_id = request.query.get("type_id")
+        data, pages = universe.orders(region_id, int(type_id) if type_id else None, int(request.query.get("page", 1)))
+        return respond(request, data, {"X-Pages": str(pages), "Expires": formatdate(time.time() + 300, usegmt=True)})
+
+    async def history(request):
+        region_id = int(request.match_info["region_id"])
+        type_id = int(request.query.get("type_id", 0))
+        if region_id not in universe.regions:
+            return web.json_response({"error": "Region not found!"}, status=404)
+        # Data only changes with the seed and the day, and so does the tag
+        etag = '"' + hashlib.sha1(f"{universe.seed}:{region_id}:{type_id}:{date.today()}".encode()).hexdigest()[:16] + '"'
+        headers = {
+            "ETag": etag,
+            "Last-Modified": started,
+            "Expires": formatdate(time.time() + history_expires, usegmt=True),
+        }
+        if etag in request.headers.get("If-None-Match", ""):
+            return web.Response(status=304, headers=headers)
+        return respond(request, universe.history(region_id, type_id), headers)
+
+    async def stats(request):
+        return web.json_response({
+            "requests": sum(hits.values()),
+            "by_route": hits,
+            "by_status": statuses,
+            "error_limit_remain": budget.remain,
+        })
+
+    app.router.add_get("/universe/types/", types)
+    app.router.add_get("/universe/types/{type_id}/", type_info)
+    app.router.add_get("/universe/regions/", regions)
+    app.router.add_post("/universe/names/", names)
+    app.router.add_get("/markets/{region_id}/orders/", orders)
+    app.router.add_get("/markets/{region_id}/history/", history)
+    app.router.add_get("/_stub/stats", stats)
+    return app
+
+def build_recorder(upstream, out):
+    """Proxy to upstream that appends every response to out for later replay"""
+    app = web.Application()
+
+    async def on_startup(app):
+        app['session'] = ClientSession()
+        app['out'] = open(out, "a")
+
+    async def on_cleanup(app):
+        await app['session'].close()
+        app['out'].close()
+
+    async def proxy(request):
+        body = await request.read() if request.method == "POST" else None
+        url = upstream.rstrip("/") + request.path
+        headers = {name: value for name, value in request.headers.items() if name in ("If-None-Match", "If-Modified-Since", "Content-Type")}
+        async with app['session'].request(request.method, url, params=request.query, data=body, headers=headers) as response:
+            content = await response.read()
+            kept = {name: response.headers[name] for name in RECORDED_HEADERS if name in response.headers}
+        # Conditional answers depend on the validators sent, so only full responses are replayed
+        if response.status != 304:
+            app['out'].write(json.dumps({
+                'key': replay_key(request.method, request.path, dict(request.query), body),
+                'status': response.status,
+                'headers': kept,
+                'body': content.decode() if content else None,
+            }) + "\n")
+            app['out'].flush()
+        return web.Response(status=response.status, headers=kept, body=content, content_type="application/json")
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    app.router.add_route("*", "/{path:.*}", proxy)
+    return app
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(description="Local ESI stand-in for offline ingest runs and benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve = subparsers.add_parser("serve", help="serve a synthetic universe and/or recorded responses")
+    serve.add_argument("--port", type=int, default=8090)
+    serve.add_argument("--types", type=int, default=1000)
+    serve.add_argument("--regions", default=",".join(str(region_id) for region_id in HUB_STATIONS),
+                       help="comma-separated region IDs")
+    serve.add_argument("--orders-per-type", type=int, default=20, help="mean orders per type and region")
+    serve.add_argument("--history-days", type=int, default=60)
+    serve.add_argument("--history-expires", type=int, default=300, help="seconds until served history expires")
+    serve.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with --error-status")
+    serve.add_argument("--error-status", type=int, default=502, help="status of injected failures")
+    serve.add_argument("--error-budget", type=int, default=100,
+                       help="4xx/5xx answers per --error-window before every request gets a 420")
+    serve.add_argument("--error-window", type=int, default=60, help="seconds per error limit window")
+    serve.add_argument("--latency", type=float, default=0.0, help="seconds added to every answer")
+    serve.add_argument("--seed", type=int, default=1)
+    serve.add_argument("--replay", help="JSON lines file written by the record command")
+
+    record = subparsers.add_parser("record", help="proxy to ESI and record every response")
+    record.add_argument("--port", type=int, default=8090)
+    record.add_argument("--upstream", default="https://esi.evetech.net/latest")
+    record.add_argument("--out", required=True)
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        universe = SyntheticUniverse(
+            types=args.types,
+            regions=[int(region_id) for region_id in args.regions.split(",") if region_id.strip()],
+            orders_per_type=args.orders_per_type,
+            history_days=args.history_days,
+            seed=args.seed
+        )
+        app = build_app(
+            universe,
+            load_replay(args.replay) if args.replay else None,
+            args.error_rate,
+            args.history_expires,
+            latency=args.latency,
+            error_status=args.error_status,
+            error_budget=args.error_budget,
+            error_window=args.error_window
+        )
+    else:
+        app = build_recorder(args.upstream, args.out)
+    web.run_app(app, host="127.0.0.1", port=args.port, print=None)
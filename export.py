@@ -0,0 +1,161 @@
+import csv
+import io
+import json
+import os
+from datetime import datetime
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from sqlalchemy import Boolean, DateTime, Float, Integer, select
+
+from database import AsyncSessionLocal
+
+# Rows fetched from the server-side cursor per encoded chunk
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "10000"))
+
+EXPORT_FORMATS = ("json", "ndjson", "csv", "arrow", "parquet")
+FORMAT_PATTERN = f"^({'|'.join(EXPORT_FORMATS)})$"
+
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+class DrainSink:
+    """Write-only file object whose buffered bytes can be taken between writes.
+
+    tell() keeps counting across drains, as the Parquet footer records
+    absolute offsets.
+    """
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.buffer.write(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def readable(self):
+        return False
+
+    def take(self):
+        data = self.buffer.getvalue()
+        self.buffer = io.BytesIO()
+        return data
+
+def arrow_schema(table):
+    import pyarrow as pa
+    types = []
+    for column in table.columns:
+        if isinstance(column.type, Boolean):
+            arrow_type = pa.bool_()
+        elif isinstance(column.type, Integer):
+            arrow_type = pa.int64()
+        elif isinstance(column.type, Float):
+            arrow_type = pa.float64()
+        elif isinstance(column.type, DateTime):
+            arrow_type = pa.timestamp("us")
+        else:
+            arrow_type = pa.string()
+        types.append(pa.field(column.name, arrow_type))
+    return pa.schema(types)
+
+def json_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+async def row_batches(query):
+    """Yield lists of row tuples from a server-side cursor.
+
+    The stream owns its session: the request's session may be closed
+    before the response body has been sent.
+    """
+    async with AsyncSessionLocal() as db:
+        result = await db.stream(query.execution_options(yield_per=EXPORT_BATCH_SIZE))
+        async for rows in result.partitions():
+            yield rows
+
+async def encode_ndjson(query, columns):
+    async for rows in row_batches(query):
+        yield "".join(
+            json.dumps(dict(zip(columns, map(json_value, row))), separators=(",", ":")) + "\n"
+            for row in rows
+        ).encode()
+
+async def encode_csv(query, columns):
+    text = io.StringIO()
+    writer = csv.writer(text)
+    writer.writerow(columns)
+    async for rows in row_batches(query):
+        writer.writerows([json_value(value) for value in row] for row in rows)
+        yield text.getvalue().encode()
+        text.seek(0)
+        text.truncate()
+    if text.tell():
+        yield text.getvalue().encode()
+
+async def encode_arrow(query, schema, parquet=False):
+    import pyarrow as pa
+    sink = DrainSink()
+    if parquet:
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(sink, schema)
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+    async for rows in row_batches(query):
+        # Transpose the partition into one array per column
+        arrays = [
+            pa.array(values, type=field.type)
+            for values, field in zip(zip(*rows), schema)
+        ]
+        writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+def export_response(model, conditions, order_by, format, filename):
+    """Stream the rows of model matching conditions in an export format.
+
+    Rows are read from a server-side cursor and encoded a batch at a time,
+    so memory stays bounded by EXPORT_BATCH_SIZE whatever the window.
+    """
+    table = model.__table__
+    columns = [column.name for column in table.columns]
+    query = select(*table.columns).where(*conditions).order_by(*order_by)
+
+    if format == "ndjson":
+        body = encode_ndjson(query, columns)
+    elif format == "csv":
+        body = encode_csv(query, columns)
+    elif format in ("arrow", "parquet"):
+        try:
+            schema = arrow_schema(table)
+        except ImportError:
+            raise HTTPException(status_code=501, detail=f"{format} export requires pyarrow")
+        body = encode_arrow(query, schema, parquet=format == "parquet")
+    else:
+        raise HTTPException(status_code=400, detail=f"Unsupported format: {format}")
+
+    return StreamingResponse(
+        body,
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{format}"'}
+    )
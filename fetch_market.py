@@ -1,18 +1,33 @@
+import argparse
 import asyncio
-import aiohttp
-import requests
-from datetime import datetime
-from sqlalchemy.orm import Session
+import os
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from sqlalchemy import func, insert, select, update
 from database import SessionLocal, engine
-from models import Base, Item, Region, MarketData, OrderHistory
+from models import Item, Region, MarketData, MarketLatest, OrderHistory, HistorySyncState, PriceRollup, OrderBookDepth
+from esi_client import FetchScheduler
+from bulk_write import BulkWriter, bump_generation
+from item_search import index_items
+from migrations import upgrade
+from order_book import BOOK_FIELDS, ORDER_BOOK_DEPTH
+from partitions import apply_retention
+from pipeline import (
+    IngestPipeline, history_rows, item_snapshot_rows, order_count, parse_order_page, region_snapshot_rows, snapshot_count
+)
+from progress import IngestProgress
+from shards import (
+    INGEST_WORKER_ID, claim_shard, fail_shard, finish_run, finish_shard, has_claimable_shards, holding_lease,
+    open_run, plan_run, run_type_ids, shard_pairs, split_ids
+)
+from rollups import ROLLUP_FIELDS, backfill_rollups, refresh_rollups
+from order_stats import MARKET_STAT_FIELDS
 import logging
 
-# Setup logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# EVE Online ESI API base URL
-ESI_BASE_URL = "https://esi.evetech.net/latest"
+# EVE Online ESI API base URL; point it at esi_stub.py to ingest offline
+ESI_BASE_URL = os.getenv("ESI_BASE_URL", "https://esi.evetech.net/latest").rstrip("/")
 
 # Region IDs for major trading hubs
 REGIONS = {
@@ -23,161 +38,341 @@ REGIONS = {
     10000042: "Metropolis (Hek)"
 }
 
+# Regions to ingest: "hubs" for the trade hubs above, "all" for every
+# region with a market, or comma-separated region IDs
+INGEST_REGIONS = os.getenv("INGEST_REGIONS", "hubs")
+
+# Type IDs to sync history for, comma-separated; empty for every market type
+INGEST_TYPES = split_ids(os.getenv("INGEST_TYPES", ""))
+
+# Market types synced per run, lowest IDs first; 0 for all
+INGEST_TYPE_LIMIT = int(os.getenv("INGEST_TYPE_LIMIT", "100"))
+
+# Shards one worker ingests at once
+INGEST_SHARDS_AT_ONCE = int(os.getenv("INGEST_SHARDS_AT_ONCE", "5"))
+
+# Region IDs from here on are wormhole, abyssal and other regions without a market
+KSPACE_REGION_END = 11000000
+
+# Jove regions: listed by ESI but unreachable and without a market
+MARKETLESS_REGIONS = {10000004, 10000017, 10000019}
+
+# Columns refreshed when a history day is ingested again
+HISTORY_FIELDS = ('average', 'highest', 'lowest', 'order_count', 'volume')
+
+# Columns refreshed on every history sync of an item/region pair
+SYNC_STATE_FIELDS = ('last_date', 'etag', 'expires', 'last_modified', 'checked_at')
+
+# Columns replaced in market_latest by every new snapshot
+LATEST_FIELDS = MARKET_STAT_FIELDS + ('timestamp',)
+
+# Days of history stored for a pair that has never been synced
+HISTORY_BACKFILL_DAYS = 30
+
+# Type IDs per /universe/names/ request (ESI's maximum)
+NAMES_BATCH_SIZE = 1000
+
+# Type detail requests scheduled at once during the catalog sync
+CATALOG_FETCH_WINDOW = 1000
+
+# Re-resolve names of known types through /universe/names/ on every sync
+REFRESH_TYPE_NAMES = os.getenv("ESI_REFRESH_TYPE_NAMES", "false").lower() in ("1", "true", "yes")
+
+# Page through whole-region order books instead of one request per type
+BULK_ORDERS = os.getenv("ESI_BULK_ORDERS", "true").lower() in ("1", "true", "yes")
+
+# Region order pages requested ahead of the page being consumed
+ORDER_PAGE_WINDOW = 50
+
 class MarketDataFetcher:
-    def __init__(self):
-        self.session = None
+    def __init__(self, progress=None, base_url=None, **scheduler_options):
+        self.base_url = (base_url or ESI_BASE_URL).rstrip("/")
+        if progress:
+            scheduler_options.setdefault("on_request", progress.request_sent)
+        self.scheduler = FetchScheduler(**scheduler_options)
         
     async def __aenter__(self):
-        self.session = aiohttp.ClientSession()
+        await self.scheduler.__aenter__()
         return self
         
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        if self.session:
-            await self.session.close()
+        await self.scheduler.__aexit__(exc_type, exc_val, exc_tb)
     
     async def fetch_types(self):
-        """Fetch all market type IDs"""
-        url = f"{ESI_BASE_URL}/universe/types/"
+        """Fetch all type IDs, following the X-Pages header across every page"""
+        url = f"{self.base_url}/universe/types/"
         try:
-            async with self.session.get(url) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    logger.info(f"Fetched {len(data)} type IDs")
-                    return data
-                else:
-                    logger.error(f"Failed to fetch types: {response.status}")
+            response = await self.scheduler.get(url, params={"page": 1})
+            if response.status != 200:
+                logger.error(f"Failed to fetch types: {response.status}")
+                return []
+            type_ids = list(response.data)
+            pages = int(response.headers.get("X-Pages", 1))
+            responses = await asyncio.gather(*[
+                self.scheduler.get(url, params={"page": page}) for page in range(2, pages + 1)
+            ])
+            for page, response in enumerate(responses, start=2):
+                if response.status != 200:
+                    # A partial list would make the sync think types vanished
+                    logger.error(f"Failed to fetch types page {page}: {response.status}")
                     return []
+                type_ids.extend(response.data)
+            logger.info(f"Fetched {len(type_ids)} type IDs from {pages} pages")
+            return type_ids
         except Exception as e:
             logger.error(f"Error fetching types: {e}")
             return []
     
     async def fetch_type_info(self, type_id):
         """Fetch detailed information about a specific type"""
-        url = f"{ESI_BASE_URL}/universe/types/{type_id}/"
+        url = f"{self.base_url}/universe/types/{type_id}/"
         try:
-            async with self.session.get(url) as response:
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    logger.warning(f"Failed to fetch type info for {type_id}: {response.status}")
-                    return None
+            response = await self.scheduler.get(url)
+            if response.status == 200:
+                return response.data
+            else:
+                logger.warning(f"Failed to fetch type info for {type_id}: {response.status}")
+                return None
         except Exception as e:
             logger.error(f"Error fetching type info for {type_id}: {e}")
             return None
     
-    async def fetch_market_orders(self, region_id, type_id):
-        """Fetch market orders for a specific type in a region"""
-        url = f"{ESI_BASE_URL}/markets/{region_id}/orders/"
+    async def fetch_names(self, ids, category):
+        """Resolve names of one category ("inventory_type", "region", ...) through /universe/names/ in batches of 1000 IDs"""
+        url = f"{self.base_url}/universe/names/"
+        batches = [ids[i:i + NAMES_BATCH_SIZE] for i in range(0, len(ids), NAMES_BATCH_SIZE)]
+        names = {}
+        for response in await asyncio.gather(*[self.scheduler.post(url, json=batch) for batch in batches], return_exceptions=True):
+            if isinstance(response, Exception):
+                logger.error(f"Error resolving {category} names: {response}")
+            elif response.status != 200:
+                logger.warning(f"Failed to resolve {category} names: {response.status}")
+            else:
+                names.update((entry['id'], entry['name']) for entry in response.data if entry.get('category') == category)
+        return names
+    
+    async def fetch_type_names(self, type_ids):
+        return await self.fetch_names(type_ids, "inventory_type")
+    
+    async def fetch_regions(self):
+        """Fetch all region IDs"""
+        url = f"{self.base_url}/universe/regions/"
+        try:
+            response = await self.scheduler.get(url)
+            if response.status == 200:
+                return response.data
+            logger.error(f"Failed to fetch regions: {response.status}")
+            return []
+        except Exception as e:
+            logger.error(f"Error fetching regions: {e}")
+            return []
+    
+    async def fetch_market_orders(self, region_id, type_id, raw=False):
+        """Fetch market orders for a specific type in a region; raw returns the undecoded body, or None on failure"""
+        url = f"{self.base_url}/markets/{region_id}/orders/"
         params = {"type_id": type_id}
+        failed = None if raw else []
         
         try:
-            async with self.session.get(url, params=params) as response:
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    logger.warning(f"Failed to fetch orders for region {region_id}, type {type_id}: {response.status}")
-                    return []
+            response = await self.scheduler.get(url, params=params, raw=raw)
+            if response.status == 200:
+                return response.data
+            else:
+                logger.warning(f"Failed to fetch orders for region {region_id}, type {type_id}: {response.status}")
+                return failed
         except Exception as e:
             logger.error(f"Error fetching orders for region {region_id}, type {type_id}: {e}")
-            return []
+            return failed
+    
+    async def fetch_region_orders(self, region_id, raw=False):
+        """Yield pages of all market orders in a region as they arrive.
+
+        The first page is fetched alone to learn the page count from the
+        X-Pages header. The remaining pages are requested concurrently, at
+        most ORDER_PAGE_WINDOW ahead of the consumer, and yielded in
+        completion order so callers can aggregate and drop them. A consumer
+        that stops pulling pages stops new requests too.
+        """
+        url = f"{self.base_url}/markets/{region_id}/orders/"
+        
+        try:
+            response = await self.scheduler.get(url, params={"order_type": "all", "page": 1}, raw=raw)
+        except Exception as e:
+            logger.error(f"Error fetching orders page 1 for region {region_id}: {e}")
+            return
+        if response.status != 200:
+            logger.warning(f"Failed to fetch orders page 1 for region {region_id}: {response.status}")
+            return
+        
+        pages = int(response.headers.get("X-Pages", 1))
+        yield response.data
+        
+        pending = set()
+        next_page = 2
+        try:
+            while next_page <= pages or pending:
+                while next_page <= pages and len(pending) < ORDER_PAGE_WINDOW:
+                    pending.add(asyncio.ensure_future(
+                        self.scheduler.get(url, params={"order_type": "all", "page": next_page}, raw=raw)
+                    ))
+                    next_page += 1
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    try:
+                        response = task.result()
+                    except Exception as e:
+                        logger.error(f"Error fetching orders page for region {region_id}: {e}")
+                        continue
+                    if response.status == 200:
+                        yield response.data
+                    else:
+                        logger.warning(f"Failed to fetch orders page for region {region_id}: {response.status}")
+        finally:
+            for task in pending:
+                task.cancel()
+        
+        logger.info(f"Fetched {pages} order pages for region {region_id}")
     
     async def fetch_market_history(self, region_id, type_id):
         """Fetch market history for a specific type in a region"""
-        url = f"{ESI_BASE_URL}/markets/{region_id}/history/"
+        url = f"{self.base_url}/markets/{region_id}/history/"
         params = {"type_id": type_id}
         
         try:
-            async with self.session.get(url, params=params) as response:
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    logger.warning(f"Failed to fetch history for region {region_id}, type {type_id}: {response.status}")
-                    return []
+            response = await self.scheduler.get(url, params=params)
+            if response.status == 200:
+                return response.data
+            else:
+                logger.warning(f"Failed to fetch history for region {region_id}, type {type_id}: {response.status}")
+                return []
         except Exception as e:
             logger.error(f"Error fetching history for region {region_id}, type {type_id}: {e}")
             return []
-
-def process_orders(orders):
-    """Process orders and calculate statistics"""
-    if not orders:
-        return None
     
-    buy_orders = [order for order in orders if not order.get('is_buy_order', True)]
-    sell_orders = [order for order in orders if order.get('is_buy_order', True)]
-    
-    def calculate_stats(order_list):
-        if not order_list:
-            return None, None, None, 0, 0
-        
-        prices = [order['price'] for order in order_list]
-        volumes = [order['volume_remain'] for order in order_list]
+    async def fetch_market_history_conditional(self, region_id, type_id, etag=None, last_modified=None, raw=False):
+        """Fetch market history, letting ESI answer 304 if it is unchanged"""
+        url = f"{self.base_url}/markets/{region_id}/history/"
+        params = {"type_id": type_id}
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
         
-        return (
-            max(prices),
-            min(prices),
-            sum(price * volume for price, volume in zip(prices, volumes)) / sum(volumes) if sum(volumes) > 0 else 0,
-            sum(volumes),
-            len(order_list)
-        )
-    
-    buy_stats = calculate_stats(buy_orders)
-    sell_stats = calculate_stats(sell_orders)
-    
+        try:
+            response = await self.scheduler.get(url, params=params, headers=headers, raw=raw)
+            if response.status not in (200, 304):
+                logger.warning(f"Failed to fetch history for region {region_id}, type {type_id}: {response.status}")
+                return None
+            return response
+        except Exception as e:
+            logger.error(f"Error fetching history for region {region_id}, type {type_id}: {e}")
+            return None
+
+async def ingest_region_orders(fetcher, pipeline, region_id, timestamp, known_type_ids):
+    """Snapshot a region's whole order book through the pipeline.
+
+    Pages are decoded in the parse pool as they arrive, then aggregated
+    there into snapshot and order book rows for the writer. Returns the
+    number of orders, snapshots and books.
+    """
+    pending = []
+    async for body in fetcher.fetch_region_orders(region_id, raw=True):
+        pipeline.fetched(body)
+        pending.append(await pipeline.submit("parse", parse_order_page, body, size=order_count))
+    # An empty book is one empty page; there is nothing to aggregate
+    parts = [part for part in await asyncio.gather(*pending) if order_count(part)]
+    if not parts:
+        return 0, 0, 0
+    snapshots, books = await pipeline.parse(
+        "aggregate", region_snapshot_rows, parts, region_id, timestamp, known_type_ids, ORDER_BOOK_DEPTH,
+        size=snapshot_count
+    )
+    await pipeline.write((MarketData, snapshots), (MarketLatest, snapshots), (OrderBookDepth, books))
+    orders = sum(order_count(part) for part in parts)
+    logger.info(f"Aggregated {orders} orders for {len(snapshots)} types in region {region_id}")
+    return orders, len(snapshots), len(books)
+
+def item_row(type_id, type_info):
+    """Build an Item insert row from /universe/types/{id}/"""
     return {
-        'buy_max': buy_stats[0],
-        'buy_min': buy_stats[1],
-        'buy_avg': buy_stats[2],
-        'buy_volume': buy_stats[3],
-        'buy_orders': buy_stats[4],
-        'sell_max': sell_stats[0],
-        'sell_min': sell_stats[1],
-        'sell_avg': sell_stats[2],
-        'sell_volume': sell_stats[3],
-        'sell_orders': sell_stats[4]
+        'type_id': type_id,
+        'name': type_info.get('name', f'Unknown Item {type_id}'),
+        'group_id': type_info.get('group_id'),
+        'market_group_id': type_info.get('market_group_id'),
+        'volume': type_info.get('volume'),
+        'description': type_info.get('description', ''),
+        'published': type_info.get('published', True)
     }
 
-async def update_items_database():
-    """Update the items database with current type information"""
+async def fetch_type_row(fetcher, type_id):
+    type_info = await fetcher.fetch_type_info(type_id)
+    return item_row(type_id, type_info) if type_info else None
+
+async def update_items_database(progress=None, refresh_names=REFRESH_TYPE_NAMES):
+    """Sync the item catalog with ESI's full type list.
+
+    Existing IDs are diffed in one query and only missing types have their
+    details fetched, concurrently and committed in batches. Types without a
+    market_group_id are stored too, so they are not fetched again next run,
+    but the market loop skips them.
+    """
     logger.info("Starting items database update...")
+    progress = progress or IngestProgress()
+    progress.stage("items")
     
-    async with MarketDataFetcher() as fetcher:
-        # Get all type IDs
+    async with MarketDataFetcher(progress) as fetcher:
         type_ids = await fetcher.fetch_types()
-        
-        # Filter for market types only (basic filtering)
-        market_type_ids = type_ids[:1000]  # Limit for testing
+        if not type_ids:
+            return
         
         db = SessionLocal()
+        writer = BulkWriter(
+            db,
+            on_flush=lambda rows: progress.add("rows_written", rows),
+            on_publish=progress.published,
+            # Only rows the insert did not skip as existing are indexed
+            on_insert={Item: lambda rows: index_items(db, added=[(row.type_id, row.name) for row in rows])},
+        )
         try:
-            for type_id in market_type_ids:
-                # Check if item already exists
-                existing_item = db.query(Item).filter(Item.type_id == type_id).first()
-                if existing_item:
-                    continue
-                
-                # Fetch type information
-                type_info = await fetcher.fetch_type_info(type_id)
-                if not type_info:
-                    continue
-                
-                # Create new item
-                item = Item(
-                    type_id=type_id,
-                    name=type_info.get('name', f'Unknown Item {type_id}'),
-                    group_id=type_info.get('group_id'),
-                    market_group_id=type_info.get('market_group_id'),
-                    volume=type_info.get('volume'),
-                    description=type_info.get('description', ''),
-                    published=type_info.get('published', True)
-                )
-                
-                db.add(item)
-                
-                if len(market_type_ids) % 100 == 0:
+            existing_ids = set(db.scalars(select(Item.type_id)))
+            missing_ids = [type_id for type_id in type_ids if type_id not in existing_ids]
+            progress.set("types_total", len(type_ids))
+            progress.add("rows_processed", len(type_ids))
+            progress.set("types_missing", len(missing_ids))
+            logger.info(f"{len(existing_ids)} types known, fetching details for {len(missing_ids)}")
+            
+            # Bounded windows keep the number of pending coroutines small
+            for start in range(0, len(missing_ids), CATALOG_FETCH_WINDOW):
+                window = missing_ids[start:start + CATALOG_FETCH_WINDOW]
+                tasks = [asyncio.ensure_future(fetch_type_row(fetcher, type_id)) for type_id in window]
+                for task in asyncio.as_completed(tasks):
+                    row = await task
+                    progress.add("types_checked")
+                    if row:
+                        writer.add(Item, row)
+                        progress.add("items_added")
+                writer.flush()
+                logger.info(f"Processed {start + len(window)} of {len(missing_ids)} new types...")
+            writer.publish()
+            
+            if refresh_names and existing_ids:
+                names = await fetcher.fetch_type_names(sorted(existing_ids))
+                current = dict(db.execute(select(Item.type_id, Item.name)).all())
+                renamed = [
+                    (type_id, current[type_id], name)
+                    for type_id, name in names.items()
+                    if type_id in current and current[type_id] != name
+                ]
+                if renamed:
+                    db.execute(update(Item), [{'type_id': type_id, 'name': name} for type_id, _, name in renamed])
+                    index_items(db, renamed=renamed)
+                    bump_generation(db)
                     db.commit()
-                    logger.info(f"Processed {len(market_type_ids)} items...")
+                    progress.add("rows_written", len(renamed))
+                    progress.published()
+                progress.set("items_renamed", len(renamed))
             
-            db.commit()
             logger.info("Items database update completed")
             
         except Exception as e:
@@ -186,22 +381,177 @@ async def update_items_database():
         finally:
             db.close()
 
-async def fetch_market_data():
-    """Main function to fetch all market data"""
+def backfill_market_latest(db):
+    """Fill an empty market_latest from the newest market_data snapshot per pair"""
+    if db.query(MarketLatest.type_id).first() is not None:
+        return
+    latest = db.query(
+        MarketData.type_id,
+        MarketData.region_id,
+        func.max(MarketData.timestamp).label('timestamp')
+    ).group_by(MarketData.type_id, MarketData.region_id).subquery()
+    
+    columns = ('type_id', 'region_id') + LATEST_FIELDS
+    source = db.query(*(getattr(MarketData, column) for column in columns)).join(
+        latest,
+        (MarketData.type_id == latest.c.type_id) &
+        (MarketData.region_id == latest.c.region_id) &
+        (MarketData.timestamp == latest.c.timestamp)
+    )
+    db.execute(insert(MarketLatest).from_select(columns, source))
+    bump_generation(db)
+    db.commit()
+
+def parse_http_date(value):
+    """Parse an HTTP date header into a naive UTC datetime"""
+    try:
+        return parsedate_to_datetime(value).astimezone(timezone.utc).replace(tzinfo=None)
+    except (TypeError, ValueError):
+        return None
+
+def history_is_fresh(sync_state, now):
+    """True while ESI's cached history for a pair has not expired yet"""
+    return sync_state is not None and sync_state.expires is not None and sync_state.expires > now
+
+async def sync_item_history(fetcher, pipeline, type_id, region_id, sync_state=None):
+    """Fetch history rows newer than the pair's watermark.
+
+    Returns (rows, sync_row). ESI's ETag/Last-Modified are sent back as
+    validators so an unchanged series costs a 304 without a body. sync_row
+    is the updated watermark, or None if the request failed.
+    """
+    etag = sync_state.etag if sync_state else None
+    last_modified = sync_state.last_modified if sync_state else None
+    last_date = sync_state.last_date if sync_state else None
+    
+    response = await fetcher.fetch_market_history_conditional(region_id, type_id, etag, last_modified, raw=True)
+    if response is None:
+        return [], None
+    
+    sync_row = {
+        'type_id': type_id,
+        'region_id': region_id,
+        'last_date': last_date,
+        'etag': response.headers.get('ETag', etag),
+        'expires': parse_http_date(response.headers.get('Expires')),
+        'last_modified': response.headers.get('Last-Modified', last_modified),
+        'checked_at': datetime.utcnow()
+    }
+    if response.status == 304:
+        return [], sync_row
+    
+    pipeline.fetched(response.data)
+    rows = await pipeline.parse("parse", history_rows, response.data, type_id, region_id, last_date, HISTORY_BACKFILL_DAYS)
+    if rows:
+        sync_row['last_date'] = max(row['date'] for row in rows)
+    return rows, sync_row
+
+async def fetch_item_orders(fetcher, pipeline, type_id, region_id, timestamp):
+    """Snapshot one type's orders in a region; returns (snapshot row or None, order book rows)"""
+    body = await fetcher.fetch_market_orders(region_id, type_id, raw=True)
+    if body is None:
+        return None, []
+    pipeline.fetched(body)
+    return await pipeline.parse(
+        "aggregate", item_snapshot_rows, body, type_id, region_id, timestamp, ORDER_BOOK_DEPTH,
+        size=lambda result: (result[0] is not None) + len(result[1])
+    )
+
+async def ingest_item_region(fetcher, pipeline, type_id, region_id, timestamp, with_orders=True, sync_state=None, with_history=True):
+    """Fetch current orders and new history for one item in one region and queue their rows.
+
+    Returns the number of history rows and the oldest history date
+    written, if any.
+    """
+    snapshot, books, history, sync_row = None, [], [], None
+    if with_orders and with_history:
+        (snapshot, books), (history, sync_row) = await asyncio.gather(
+            fetch_item_orders(fetcher, pipeline, type_id, region_id, timestamp),
+            sync_item_history(fetcher, pipeline, type_id, region_id, sync_state)
+        )
+    elif with_orders:
+        snapshot, books = await fetch_item_orders(fetcher, pipeline, type_id, region_id, timestamp)
+    elif with_history:
+        history, sync_row = await sync_item_history(fetcher, pipeline, type_id, region_id, sync_state)
+    
+    batches = []
+    if snapshot:
+        batches += [(MarketData, [snapshot]), (MarketLatest, [snapshot]), (OrderBookDepth, books)]
+    batches.append((OrderHistory, history))
+    # Queued after its rows so the watermark never runs ahead of the data
+    if sync_row:
+        batches.append((HistorySyncState, [sync_row]))
+    await pipeline.write(*batches)
+    return len(history), min((row['date'] for row in history), default=None)
+
+def market_type_ids(db):
+    return {type_id for (type_id,) in db.query(Item.type_id).filter(Item.market_group_id.isnot(None))}
+
+def history_sync_states(db):
+    """Watermarks per (type_id, region_id) as plain rows: ORM instances would expire on every batch commit"""
+    return {
+        (state.type_id, state.region_id): state
+        for state in db.query(
+            HistorySyncState.type_id,
+            HistorySyncState.region_id,
+            HistorySyncState.last_date,
+            HistorySyncState.etag,
+            HistorySyncState.expires,
+            HistorySyncState.last_modified
+        )
+    }
+
+async def configured_regions(setting=INGEST_REGIONS, progress=None):
+    """Region IDs and names to ingest for an INGEST_REGIONS setting"""
+    if setting == "hubs":
+        return dict(REGIONS)
+    async with MarketDataFetcher(progress) as fetcher:
+        if setting == "all":
+            region_ids = [
+                region_id for region_id in await fetcher.fetch_regions()
+                if region_id < KSPACE_REGION_END and region_id not in MARKETLESS_REGIONS
+            ]
+            if not region_ids:
+                logger.error("No regions fetched, ingesting the trade hubs only")
+                return dict(REGIONS)
+        else:
+            region_ids = split_ids(setting)
+        names = await fetcher.fetch_names(region_ids, "region")
+    return {region_id: REGIONS.get(region_id) or names.get(region_id, f"Region {region_id}") for region_id in region_ids}
+
+async def fetch_market_data(bulk_orders=BULK_ORDERS, progress=None, worker=INGEST_WORKER_ID):
+    """Sync regions and the item catalog, then plan a sharded market run and ingest it.
+
+    A run still open from another process is joined instead of planning a
+    second one; workers started with --worker help with either.
+    """
     logger.info("Starting market data fetch...")
+    progress = progress or IngestProgress()
+    progress.stage("schema")
     
-    # Create tables if they don't exist
-    Base.metadata.create_all(bind=engine)
+    # Bring the schema up to date
+    upgrade(engine)
+    regions = await configured_regions(progress=progress)
     
     # Initialize regions
     db = SessionLocal()
     try:
-        for region_id, region_name in REGIONS.items():
-            existing_region = db.query(Region).filter(Region.region_id == region_id).first()
-            if not existing_region:
-                region = Region(region_id=region_id, name=region_name)
-                db.add(region)
+        existing_ids = set(db.scalars(select(Region.region_id)))
+        added = [
+            Region(region_id=region_id, name=region_name)
+            for region_id, region_name in regions.items()
+            if region_id not in existing_ids
+        ]
+        if added:
+            db.add_all(added)
+            # Cached /regions answers go stale with the same commit
+            bump_generation(db)
         db.commit()
+        if added:
+            progress.published()
+        # Databases from before market_latest / price_rollups existed get them seeded once
+        backfill_market_latest(db)
+        backfill_rollups(db)
     except Exception as e:
         logger.error(f"Error initializing regions: {e}")
         db.rollback()
@@ -209,73 +559,205 @@ async def fetch_market_data():
         db.close()
     
     # Update items database
-    await update_items_database()
+    await update_items_database(progress)
     
-    # Fetch market data
-    async with MarketDataFetcher() as fetcher:
+    db = SessionLocal()
+    try:
+        run = open_run(db)
+        if run is None:
+            run = plan_run(db, list(regions), bulk_orders, INGEST_TYPES, INGEST_TYPE_LIMIT)
+        else:
+            logger.info(f"Joining open ingest run {run.id}")
+    finally:
+        db.close()
+    await ingest_run(run, progress, worker)
+
+async def ingest_run(run, progress=None, worker=INGEST_WORKER_ID):
+    """Claim and ingest shards of run until none are left to claim.
+
+    Region order books are claimed first, so a worker publishes snapshots
+    before the much longer history sync. The worker that reports the
+    run's last shard rebuilds the hour rollups from every shard's
+    snapshots and applies retention. Returns the number of shards this
+    worker ingested.
+    """
+    progress = progress or IngestProgress()
+    async with MarketDataFetcher(progress) as fetcher:
         db = SessionLocal()
+        writer = BulkWriter(db, update_columns={
+            MarketLatest: LATEST_FIELDS,
+            OrderHistory: HISTORY_FIELDS,
+            HistorySyncState: SYNC_STATE_FIELDS,
+            PriceRollup: ROLLUP_FIELDS,
+            OrderBookDepth: BOOK_FIELDS
+        }, on_flush=lambda rows: progress.add("rows_written", rows), on_publish=progress.published)
+        # One timestamp per run so a snapshot is keyed by (type, region, timestamp)
+        snapshot_time = run.snapshot_time
+        claimed = 0
+        finished = False
         try:
-            # Get all items from database
-            items = db.query(Item).limit(100).all()  # Limit for testing
-            
-            for item in items:
-                logger.info(f"Processing item: {item.name} (ID: {item.type_id})")
+            async with IngestPipeline(writer) as pipeline:
                 
-                for region_id in REGIONS.keys():
-                    try:
-                        # Fetch current orders
-                        orders = await fetcher.fetch_market_orders(region_id, item.type_id)
-                        order_stats = process_orders(orders)
-                        
-                        if order_stats:
-                            # Save market data
-                            market_data = MarketData(
-                                type_id=item.type_id,
-                                region_id=region_id,
-                                **order_stats
-                            )
-                            db.add(market_data)
-                        
-                        # Fetch historical data
-                        history = await fetcher.fetch_market_history(region_id, item.type_id)
-                        for hist_entry in history[-30:]:  # Last 30 days
-                            existing_history = db.query(OrderHistory).filter(
-                                OrderHistory.type_id == item.type_id,
-                                OrderHistory.region_id == region_id,
-                                OrderHistory.date == datetime.fromisoformat(hist_entry['date'])
-                            ).first()
-                            
-                            if not existing_history:
-                                order_history = OrderHistory(
-                                    type_id=item.type_id,
-                                    region_id=region_id,
-                                    date=datetime.fromisoformat(hist_entry['date']),
-                                    average=hist_entry.get('average'),
-                                    highest=hist_entry.get('highest'),
-                                    lowest=hist_entry.get('lowest'),
-                                    order_count=hist_entry.get('order_count'),
-                                    volume=hist_entry.get('volume')
+                async def work(phase, ingest_shard):
+                    nonlocal claimed
+                    while True:
+                        shard = await asyncio.to_thread(claim_shard, run.id, phase, worker)
+                        if shard is None:
+                            return
+                        claimed += 1
+                        async with holding_lease(shard, worker):
+                            try:
+                                rows = await ingest_shard(shard)
+                                # Committed before the shard is reported done
+                                await pipeline.call(writer.flush)
+                            except Exception as e:
+                                logger.error(f"Error ingesting shard {shard.shard}: {e}")
+                                await asyncio.to_thread(fail_shard, shard, worker, e)
+                                progress.add("shards_failed")
+                                # A failed write stops the pipeline, and with it this worker
+                                pipeline.check()
+                                continue
+                        if not await asyncio.to_thread(finish_shard, shard, worker, rows):
+                            # The shard was taken over or its run expired; its state stands
+                            logger.warning(f"Lease on shard {shard.shard} was lost before it finished, result discarded")
+                            progress.add("shards_lost")
+                            continue
+                        progress.add("shards_done")
+                
+                async def work_phase(phase, ingest_shard):
+                    await asyncio.gather(*[work(phase, ingest_shard) for _ in range(INGEST_SHARDS_AT_ONCE)])
+                
+                if run.bulk_orders:
+                    progress.stage("orders")
+                    progress.set("regions_total", len(split_ids(run.regions)))
+                    # A region snapshot costs one request per page, so store stats
+                    # for every known market item rather than only the synced types
+                    known_type_ids = await pipeline.call(market_type_ids, db)
+                    
+                    async def ingest_orders_shard(shard):
+                        orders, stored, books = await ingest_region_orders(
+                            fetcher, pipeline, shard.region_id, snapshot_time, known_type_ids
+                        )
+                        progress.add("rows_processed", orders)
+                        progress.add("books_stored", books)
+                        progress.add("regions_done")
+                        progress.add("types_stored", stored)
+                        return orders
+                    
+                    await work_phase("orders", ingest_orders_shard)
+                    pipeline.report(progress, "orders")
+                    # Readers see this worker's order books once, not batch by batch
+                    await pipeline.call(writer.publish)
+                
+                progress.stage("history")
+                sync_states = await pipeline.call(history_sync_states, db)
+                type_ids = await pipeline.call(run_type_ids, db, run)
+                # Oldest history date written per pair, for the rollup refresh
+                history_since = {}
+                
+                async def ingest_history_shard(shard):
+                    # Pairs whose history is still within ESI's cache window are not
+                    # requested at all. The window is judged against the clock, not
+                    # the run's snapshot time, which can be hours old for a late shard
+                    now = datetime.utcnow()
+                    pairs = []
+                    skipped = 0
+                    for type_id, region_id in shard_pairs(shard, run, type_ids):
+                        sync_state = sync_states.get((type_id, region_id))
+                        with_history = not history_is_fresh(sync_state, now)
+                        if not with_history:
+                            skipped += 1
+                            if run.bulk_orders:
+                                continue
+                        pairs.append((type_id, region_id, sync_state, with_history))
+                    logger.info(f"Shard {shard.shard}: syncing {len(pairs)} item/region pairs, {skipped} histories still fresh")
+                    progress.add("pairs_total", len(pairs))
+                    progress.add("pairs_skipped", skipped)
+                    processed = 0
+                    
+                    async def sync_pairs(remaining):
+                        nonlocal processed
+                        for type_id, region_id, sync_state, with_history in remaining:
+                            try:
+                                rows, since = await ingest_item_region(
+                                    fetcher, pipeline, type_id, region_id, snapshot_time,
+                                    not run.bulk_orders, sync_state, with_history
                                 )
-                                db.add(order_history)
-                        
-                        # Commit every 10 items to avoid large transactions
-                        if item.type_id % 10 == 0:
-                            db.commit()
-                            logger.info(f"Committed data for item {item.type_id}")
+                            except Exception as e:
+                                logger.error(f"Error processing item {type_id} in region {region_id}: {e}")
+                                continue
+                            if since:
+                                history_since[(type_id, region_id)] = since
+                            processed += rows
+                            progress.add("rows_processed", rows)
+                            progress.add("pairs_done")
                     
-                    except Exception as e:
-                        logger.error(f"Error processing item {item.type_id} in region {region_id}: {e}")
-                        continue
+                    # Enough fetchers to keep the scheduler's request slots busy;
+                    # they pull from one iterator so at most that many pairs are open
+                    remaining = iter(pairs)
+                    await asyncio.gather(*[sync_pairs(remaining) for _ in range(fetcher.scheduler.max_in_flight * 2)])
+                    return processed
+                
+                await work_phase("history", ingest_history_shard)
+                pipeline.report(progress, "history")
+                
+                progress.stage("rollups")
+                progress.add("buckets", await pipeline.call(refresh_rollups, db, writer, history_since))
+                await pipeline.call(writer.publish)
+                finished = await asyncio.to_thread(finish_run, run.id)
+                if finished:
+                    # Every shard's snapshots are in, so the run's hour bucket is complete
+                    progress.add("buckets", await pipeline.call(refresh_rollups, db, writer, {}, snapshot_time))
+                    await pipeline.call(writer.publish)
+            logger.info(f"Worker {worker} ingested {claimed} shards of run {run.id}, {writer.rows_written} rows written")
             
-            db.commit()
-            logger.info("Market data fetch completed successfully")
+            if finished:
+                logger.info(f"Ingest run {run.id} completed")
+                progress.stage("retention")
+                apply_retention(engine)
             
         except Exception as e:
             logger.error(f"Error in market data fetch: {e}")
             db.rollback()
+            # Rows committed before the failure are served all the same
+            try:
+                writer.publish(flush=False)
+            except Exception as publish_error:
+                logger.error(f"Error publishing committed rows: {publish_error}")
+            raise
         finally:
             db.close()
+            progress.finish()
+    return claimed
 
-if __name__ == "__main__":
-    asyncio.run(fetch_market_data())
+async def work_open_runs(poll=0, worker=INGEST_WORKER_ID):
+    """Ingest shards of runs planned by another process.
 
+    With poll, keeps checking for claimable shards every poll seconds;
+    otherwise returns once the open run has nothing left to claim.
+    """
+    while True:
+        db = SessionLocal()
+        try:
+            run = open_run(db)
+            # Shards leased by live workers are left to them
+            if run is not None and not has_claimable_shards(db, run.id):
+                run = None
+        finally:
+            db.close()
+        claimed = await ingest_run(run, worker=worker) if run is not None else 0
+        if not claimed:
+            if not poll:
+                logger.info("No ingest shards left to claim")
+                return
+            await asyncio.sleep(poll)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Fetch EVE Online market data from ESI")
+    parser.add_argument("--worker", action="store_true",
+                        help="only ingest shards of the open run, without syncing the catalog or planning a run")
+    parser.add_argument("--poll", type=float, default=0,
+                        help="with --worker, seconds between checks for new shards; 0 exits when none are left")
+    args = parser.parse_args()
+    asyncio.run(work_open_runs(args.poll) if args.worker else fetch_market_data())
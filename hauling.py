@@ -0,0 +1,425 @@
+import asyncio
+import json
+import logging
+import os
+import numpy as np
+from sqlalchemy import select
+from starlette.concurrency import run_in_threadpool
+
+from cache import current_generation
+from database import SessionLocal
+from models import Item, Region, MarketLatest, OrderBookDepth
+from order_book import decode_book
+
+logger = logging.getLogger(__name__)
+
+# Static hub-to-hub jump counts, one entry per unordered region pair
+HUB_JUMPS_FILE = os.getenv("HUB_JUMPS_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "hub_jumps.json"))
+
+# Default sales tax charged when selling into buy orders
+DEFAULT_SALES_TAX = 0.036
+
+RANK_METRICS = ("isk_per_jump", "isk_per_m3", "profit")
+
+# Candidate pairs generated per chunk of types, bounding peak memory
+PAIR_CHUNK = 2_000_000
+
+# Candidates evaluated exactly per branch-and-bound round, per requested result
+EVALUATE_FACTOR = 4
+
+# Bisection steps of the depth walk; 2^-50 of the unit bound is far below one unit
+WALK_STEPS = 50
+
+def load_jump_matrix(path=HUB_JUMPS_FILE):
+    """Read the jump file into {(region_a, region_b): jumps}, symmetric"""
+    with open(path) as f:
+        data = json.load(f)
+    jumps = {}
+    for region_a, region_b, count in data["jumps"]:
+        jumps[(region_a, region_b)] = jumps[(region_b, region_a)] = count
+    return jumps
+
+_jumps = None
+# Region pairs without a jump count already logged by this process
+_reported_missing = set()
+
+def jump_matrix():
+    global _jumps
+    if _jumps is None:
+        _jumps = load_jump_matrix()
+    return _jumps
+
+def load_hauling_columns(db):
+    """Load both sides of the latest snapshot and the item volume as columnar arrays"""
+    rows = db.execute(
+        select(
+            MarketLatest.type_id, MarketLatest.region_id,
+            MarketLatest.buy_max, MarketLatest.buy_min, MarketLatest.buy_avg, MarketLatest.buy_volume,
+            MarketLatest.sell_min, MarketLatest.sell_max, MarketLatest.sell_avg, MarketLatest.sell_volume,
+            Item.volume
+        ).join(Item, Item.type_id == MarketLatest.type_id)
+        .where(Item.volume > 0)
+        .order_by(MarketLatest.type_id)
+    ).all()
+    names = (
+        'type_id', 'region_id', 'buy_max', 'buy_min', 'buy_avg', 'buy_volume',
+        'sell_min', 'sell_max', 'sell_avg', 'sell_volume', 'item_volume'
+    )
+    values = list(zip(*rows)) if rows else [()] * len(names)
+    columns = {}
+    for name, column in zip(names, values):
+        if name in ('type_id', 'region_id'):
+            columns[name] = np.array(column, dtype=np.int64)
+        elif name.endswith('_volume') and name != 'item_volume':
+            columns[name] = np.array([v or 0 for v in column], dtype=np.float64)
+        else:
+            columns[name] = np.array(column, dtype=np.float64)
+    return columns
+
+def _load_hauling_columns():
+    db = SessionLocal()
+    try:
+        return load_hauling_columns(db)
+    finally:
+        db.close()
+
+# (generation, columns) of the last snapshot loaded by this process
+_snapshot = (None, None)
+_snapshot_lock = asyncio.Lock()
+
+async def hauling_columns(db):
+    """Snapshot columns for the current data generation, loaded once per generation"""
+    global _snapshot
+    generation = await current_generation(db)
+    async with _snapshot_lock:
+        if _snapshot[0] != generation:
+            _snapshot = (generation, await run_in_threadpool(_load_hauling_columns))
+        return _snapshot[1]
+
+def candidate_pairs(columns, sales_tax):
+    """All (source row, destination row) pairs of a type whose best prices still profit after tax.
+
+    Rows are sorted by type, so each type's rows form one contiguous group
+    and its pairs are the group's cross product, built in type chunks.
+    """
+    type_ids = columns['type_id']
+    if not len(type_ids):
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty
+    starts = np.flatnonzero(np.r_[True, type_ids[1:] != type_ids[:-1]])
+    sizes = np.diff(np.r_[starts, len(type_ids)])
+    net_buy = columns['buy_max'] * (1 - sales_tax)
+
+    sources, destinations = [], []
+    chunk_start = 0
+    pair_counts = np.cumsum(sizes * sizes)
+    while chunk_start < len(starts):
+        offset = pair_counts[chunk_start - 1] if chunk_start else 0
+        chunk_end = max(chunk_start + 1, np.searchsorted(pair_counts, offset + PAIR_CHUNK, side='right'))
+        group_starts = starts[chunk_start:chunk_end]
+        group_sizes = sizes[chunk_start:chunk_end]
+
+        # Every source row is repeated once per row of its group as destination
+        pair_sizes = np.repeat(group_sizes, group_sizes)
+        src = np.repeat(np.arange(group_starts[0], group_starts[-1] + group_sizes[-1]), pair_sizes)
+        first = np.repeat(np.repeat(group_starts, group_sizes), pair_sizes)
+        within = np.arange(len(src)) - np.repeat(np.cumsum(pair_sizes) - pair_sizes, pair_sizes)
+        dst = first + within
+
+        keep = (src != dst) & (net_buy[dst] > columns['sell_min'][src])
+        sources.append(src[keep])
+        destinations.append(dst[keep])
+        chunk_start = chunk_end
+    return np.concatenate(sources), np.concatenate(destinations)
+
+def depth_exponent(best, worst, vwap):
+    """Exponent k of the depth curve price(q) = best + (worst - best) * q**k.
+
+    q is the share of the side's volume already consumed. The curve runs
+    from the best to the worst order, and k makes its mean equal the side's
+    volume-weighted average price, so it reproduces the stored book shape.
+    """
+    span = worst - best
+    with np.errstate(invalid='ignore', divide='ignore'):
+        share = np.where(span != 0, (vwap - best) / span, 0.5)
+    share = np.clip(np.nan_to_num(share, nan=0.5), 0.01, 0.99)
+    return 1.0 / share - 1.0
+
+def depth_price(best, worst, k, volume, units):
+    """Price of the order that fills the units-th unit"""
+    q = np.clip(units / volume, 0.0, 1.0)
+    return best + (worst - best) * q ** k
+
+def depth_notional(best, worst, k, volume, units):
+    """ISK exchanged when the first units of the side are filled"""
+    q = np.clip(units / volume, 0.0, 1.0)
+    return volume * (best * q + (worst - best) * q ** (k + 1) / (k + 1))
+
+def walk_depth(columns, src, dst, cargo_m3, capital, sales_tax):
+    """Executable quantity and proceeds of hauling each pair, walking both books.
+
+    Units are bought from the source's sell orders cheapest first and sold
+    into the destination's buy orders highest first. The walk stops where
+    the next unit no longer profits after tax, the capital is spent, the
+    cargo is full or either book is exhausted. Both stop conditions are
+    monotone in the quantity, so the walk is a vectorized bisection.
+
+    The books here are the depth curves fitted to the snapshot's best,
+    worst and average prices. walk_pairs replaces them by the stored
+    order books where those exist; the curve covers books that were not
+    stored (ORDER_BOOK_DEPTH off, or not yet ingested).
+    """
+    sell_best, sell_worst = columns['sell_min'][src], columns['sell_max'][src]
+    buy_best, buy_worst = columns['buy_max'][dst], columns['buy_min'][dst]
+    sell_volume, buy_volume = columns['sell_volume'][src], columns['buy_volume'][dst]
+    sell_k = depth_exponent(sell_best, sell_worst, columns['sell_avg'][src])
+    buy_k = depth_exponent(buy_best, buy_worst, columns['buy_avg'][dst])
+
+    cargo_units = np.floor(cargo_m3 / columns['item_volume'][src])
+    depth_units = np.minimum(sell_volume, buy_volume)
+    upper = np.minimum(cargo_units, depth_units)
+
+    def feasible(units):
+        margin = depth_price(buy_best, buy_worst, buy_k, buy_volume, units) * (1 - sales_tax) \
+            - depth_price(sell_best, sell_worst, sell_k, sell_volume, units)
+        cost = depth_notional(sell_best, sell_worst, sell_k, sell_volume, units)
+        return (margin >= 0) & (cost <= capital)
+
+    low = np.zeros(len(src))
+    high = upper.copy()
+    done = feasible(high)
+    low[done] = high[done]
+    for _ in range(WALK_STEPS):
+        mid = (low + high) / 2
+        ok = feasible(mid)
+        low = np.where(ok, mid, low)
+        high = np.where(ok, high, mid)
+    units = np.floor(low)
+
+    cost = depth_notional(sell_best, sell_worst, sell_k, sell_volume, units)
+    revenue = depth_notional(buy_best, buy_worst, buy_k, buy_volume, units) * (1 - sales_tax)
+
+    # What stopped the walk: a full hold, an exhausted book, capital or the spread
+    next_cost = depth_notional(sell_best, sell_worst, sell_k, sell_volume, units + 1)
+    limited_by = np.where(
+        units >= cargo_units, 'cargo',
+        np.where(units >= depth_units, 'depth', np.where(next_cost > capital, 'capital', 'spread'))
+    )
+    return units, cost, revenue, limited_by
+
+def load_books(db, keys):
+    """Stored order books for (type_id, region_id) keys as {key: (sell, buy)} BookSides"""
+    keys = set(keys)
+    if not keys:
+        return {}
+    rows = db.execute(select(OrderBookDepth.type_id, OrderBookDepth.region_id, OrderBookDepth.book).where(
+        OrderBookDepth.type_id.in_({type_id for type_id, _ in keys}),
+        OrderBookDepth.region_id.in_({region_id for _, region_id in keys})
+    ))
+    return {(type_id, region_id): decode_book(book) for type_id, region_id, book in rows if (type_id, region_id) in keys}
+
+def load_stored_books(keys):
+    db = SessionLocal()
+    try:
+        return load_books(db, keys)
+    finally:
+        db.close()
+
+def walk_books(sell, buy, cargo_units, capital, sales_tax):
+    """Exact walk of one pair's stored books; same result shape as walk_depth.
+
+    sell is the source region's sell side, buy the destination's buy side.
+    The marginal margin only falls and the cost only rises with the
+    quantity, so the largest feasible quantity is an integer bisection
+    over the level arrays.
+    """
+    depth_units = min(sell.total_volume, buy.total_volume)
+    upper = int(min(cargo_units, depth_units))
+
+    def marginal_price(side, units):
+        return side.prices[np.searchsorted(side.cumulative, units, side='left')]
+
+    def feasible(units):
+        if units == 0:
+            return True
+        margin = marginal_price(buy, units) * (1 - sales_tax) - marginal_price(sell, units)
+        return margin >= 0 and sell.fill(units)[1] <= capital
+
+    low, high = 0, upper
+    if feasible(high):
+        low = high
+    while high - low > 1:
+        mid = (low + high) // 2
+        if feasible(mid):
+            low = mid
+        else:
+            high = mid
+
+    cost = sell.fill(low)[1]
+    revenue = buy.fill(low)[1] * (1 - sales_tax)
+    if low >= cargo_units:
+        limited_by = 'cargo'
+    elif low >= depth_units:
+        limited_by = 'depth'
+    elif sell.fill(low + 1)[1] > capital:
+        limited_by = 'capital'
+    else:
+        limited_by = 'spread'
+    return low, cost, revenue, limited_by
+
+def walk_pairs(columns, src, dst, cargo_m3, capital, sales_tax, books=None):
+    """walk_depth for a block of pairs, walking the stored books where both sides have one.
+
+    Returns walk_depth's arrays plus whether each pair was walked on a
+    stored book rather than the fitted curve.
+    """
+    units, cost, revenue, limited_by = walk_depth(columns, src, dst, cargo_m3, capital, sales_tax)
+    exact = np.zeros(len(src), dtype=bool)
+    if books is None or not len(src):
+        return units, cost, revenue, limited_by, exact
+    type_ids = columns['type_id'][src].tolist()
+    sources = columns['region_id'][src].tolist()
+    destinations = columns['region_id'][dst].tolist()
+    stored = books(set(zip(type_ids, sources)) | set(zip(type_ids, destinations)))
+    cargo_units = np.floor(cargo_m3 / columns['item_volume'][src])
+    for i, (type_id, source, destination) in enumerate(zip(type_ids, sources, destinations)):
+        source_book, destination_book = stored.get((type_id, source)), stored.get((type_id, destination))
+        if source_book is None or destination_book is None:
+            continue
+        units[i], cost[i], revenue[i], limited_by[i] = walk_books(
+            source_book[0], destination_book[1], cargo_units[i], capital, sales_tax
+        )
+        exact[i] = True
+    return units, cost, revenue, limited_by, exact
+
+def missing_routes(columns, jumps=None):
+    """Region pairs of the snapshot without a jump count, as sorted [region_a, region_b] lists"""
+    jumps = jump_matrix() if jumps is None else jumps
+    regions = np.unique(columns['region_id']).tolist()
+    return [
+        [region_a, region_b]
+        for i, region_a in enumerate(regions) for region_b in regions[i + 1:]
+        if (region_a, region_b) not in jumps
+    ]
+
+def report_missing_routes(missing):
+    """Log region pairs hauling cannot route, once per pair and process"""
+    new = [pair for pair in missing if tuple(pair) not in _reported_missing]
+    if new:
+        _reported_missing.update(tuple(pair) for pair in new)
+        logger.warning(
+            f"No jump count for {len(new)} region pairs, hauling skips them: "
+            + ", ".join(f"{region_a}-{region_b}" for region_a, region_b in new[:20])
+            + (" ..." if len(new) > 20 else "")
+        )
+
+def rank_values(metric, profit, cargo_used, jumps):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if metric == "isk_per_m3":
+            return np.where(cargo_used > 0, profit / cargo_used, -np.inf)
+        if metric == "isk_per_jump":
+            return np.where(jumps > 0, profit / jumps, -np.inf)
+    return profit
+
+def find_hauls(
+    columns, cargo_m3, capital, sales_tax=DEFAULT_SALES_TAX, rank_by="isk_per_jump",
+    min_profit=0, max_jumps=None, limit=50, jumps=None, books=None
+):
+    """Best hauling trades between hubs ranked by ISK per jump, per m³ or in total.
+
+    Every profitable pair gets an optimistic bound from its best prices
+    and the cargo, capital and book-volume caps; no depth walk can beat
+    it. Pairs are walked exactly in bound order, a block at a time, until
+    the limit-th best exact value beats every remaining bound. books
+    loads stored order books for a set of (type_id, region_id) keys, see
+    load_stored_books; without it every walk uses the fitted curves.
+    Region pairs missing from the jump matrix are skipped and logged.
+    """
+    jumps = jump_matrix() if jumps is None else jumps
+    report_missing_routes(missing_routes(columns, jumps))
+    src, dst = candidate_pairs(columns, sales_tax)
+    region_ids = columns['region_id']
+    regions, region_pos = np.unique(region_ids, return_inverse=True)
+    matrix = np.full((len(regions), len(regions)), -1.0)
+    for a, region_a in enumerate(regions.tolist()):
+        for b, region_b in enumerate(regions.tolist()):
+            matrix[a, b] = jumps.get((region_a, region_b), -1)
+    route_jumps = matrix[region_pos[src], region_pos[dst]]
+    keep = route_jumps > 0
+    if max_jumps is not None:
+        keep &= route_jumps <= max_jumps
+    src, dst, route_jumps = src[keep], dst[keep], route_jumps[keep]
+
+    margin = columns['buy_max'][dst] * (1 - sales_tax) - columns['sell_min'][src]
+    volume = columns['item_volume'][src]
+    units_bound = np.minimum.reduce([
+        np.floor(cargo_m3 / volume),
+        np.floor(capital / columns['sell_min'][src]),
+        columns['sell_volume'][src],
+        columns['buy_volume'][dst],
+    ])
+    profit_bound = margin * units_bound
+    if rank_by == "isk_per_m3":
+        # The first unit has the widest margin, so no haul averages more per m³
+        bound = margin / volume
+    else:
+        bound = rank_values(rank_by, profit_bound, None, route_jumps)
+    viable = (units_bound >= 1) & (profit_bound >= max(min_profit, 0)) & (profit_bound > 0)
+    candidates = np.flatnonzero(viable)
+    candidates = candidates[np.argsort(-bound[candidates], kind='stable')]
+
+    block = max(limit * EVALUATE_FACTOR, 64)
+    found = []
+    for start in range(0, len(candidates), block):
+        idx = candidates[start:start + block]
+        units, cost, revenue, limited_by, exact = walk_pairs(columns, src[idx], dst[idx], cargo_m3, capital, sales_tax, books)
+        profit = revenue - cost
+        cargo_used = units * volume[idx]
+        values = rank_values(rank_by, profit, cargo_used, route_jumps[idx])
+        hit = (units >= 1) & (profit >= min_profit) & (profit > 0)
+        for i in np.flatnonzero(hit).tolist():
+            found.append((values[i], idx[i], units[i], cost[i], revenue[i], cargo_used[i], limited_by[i], exact[i]))
+        found.sort(key=lambda entry: -entry[0])
+        del found[limit:]
+        # Stop once nothing left can outrank the current limit-th result
+        if len(found) == limit and start + block < len(candidates) and found[-1][0] >= bound[candidates[start + block]]:
+            break
+
+    hauls = []
+    for value, i, units, cost, revenue, cargo_used, limited_by, exact in found:
+        profit = revenue - cost
+        hauls.append({
+            "type_id": int(columns['type_id'][src[i]]),
+            "from_region_id": int(region_ids[src[i]]),
+            "to_region_id": int(region_ids[dst[i]]),
+            "jumps": int(route_jumps[i]),
+            "quantity": int(units),
+            "cargo_m3": float(cargo_used),
+            "buy_price_avg": float(cost / units),
+            "sell_price_avg": float(revenue / units / (1 - sales_tax)),
+            "cost": float(cost),
+            "revenue_after_tax": float(revenue),
+            "profit": float(profit),
+            "isk_per_m3": float(profit / cargo_used),
+            "isk_per_jump": float(profit / route_jumps[i]),
+            "limited_by": str(limited_by),
+            "depth": "book" if exact else "estimated"
+        })
+    return hauls
+
+async def resolve_haul_names(db, hauls):
+    """Attach Item and Region objects using one query per table"""
+    type_ids = {haul["type_id"] for haul in hauls}
+    items = {}
+    if type_ids:
+        items = {item.type_id: item for item in await db.scalars(select(Item).where(Item.type_id.in_(type_ids)))}
+    regions = {region.region_id: region for region in await db.scalars(select(Region))}
+
+    resolved = []
+    for haul in hauls:
+        entry = {"item": items.get(haul["type_id"])}
+        entry["from_region"] = regions.get(haul["from_region_id"])
+        entry["to_region"] = regions.get(haul["to_region_id"])
+        entry.update((key, value) for key, value in haul.items() if key not in ("type_id", "from_region_id", "to_region_id"))
+        resolved.append(entry)
+    return resolved
@@ -0,0 +1,87 @@
+import numpy as np
+
+# Indicators the OHLC endpoint can compute over a rollup series
+INDICATORS = ("sma", "ema", "volatility", "bollinger", "vwap")
+
+def rolling_sum(values, window):
+    """Trailing sum over window points; NaN until the window is full"""
+    values = np.asarray(values, dtype=np.float64)
+    result = np.full(len(values), np.nan)
+    if len(values) >= window:
+        cumulative = np.cumsum(np.r_[0.0, values])
+        result[window - 1:] = cumulative[window:] - cumulative[:-window]
+    return result
+
+def sma(values, window):
+    return rolling_sum(values, window) / window
+
+def rolling_std(values, window):
+    """Trailing population standard deviation from running sums of x and x^2"""
+    values = np.asarray(values, dtype=np.float64)
+    mean = sma(values, window)
+    variance = sma(values * values, window) - mean * mean
+    # Cancellation can leave tiny negative variances on flat series
+    return np.sqrt(np.maximum(variance, 0.0))
+
+def ema(values, span):
+    """Exponential moving average with alpha = 2 / (span + 1), seeded with the first value.
+
+    The recurrence is unrolled into a cumulative sum over blocks short
+    enough that the decay powers cannot overflow.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    result = np.empty(len(values))
+    if not len(values):
+        return result
+    alpha = 2.0 / (span + 1)
+    decay = 1.0 - alpha
+    block = max(1, int(500 / -np.log(decay)))
+    previous = values[0]
+    for start in range(0, len(values), block):
+        chunk = values[start:start + block]
+        powers = decay ** np.arange(1, len(chunk) + 1)
+        # ema[i] = decay^(i+1) * previous + alpha * sum_k decay^(i-k) * chunk[k]
+        result[start:start + len(chunk)] = powers * (previous + alpha * np.cumsum(chunk / powers))
+        previous = result[start + len(chunk) - 1]
+    return result
+
+def volatility(close, window):
+    """Standard deviation of log returns over the trailing window"""
+    close = np.asarray(close, dtype=np.float64)
+    result = np.full(len(close), np.nan)
+    if len(close) > 1:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            returns = np.diff(np.log(close))
+        result[1:] = rolling_std(returns, window) * np.sqrt(window / (window - 1))
+    return result
+
+def bollinger(close, window, width=2.0):
+    """Middle, upper and lower Bollinger bands"""
+    middle = sma(close, window)
+    spread = width * rolling_std(close, window)
+    return middle, middle + spread, middle - spread
+
+def rolling_vwap(turnover, volume, window):
+    """Volume-weighted average price over the trailing window"""
+    turnover = np.asarray(turnover, dtype=np.float64)
+    volume = np.asarray(volume, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        total = rolling_sum(volume, window)
+        return np.where(total > 0, rolling_sum(turnover, window) / total, np.nan)
+
+def compute_indicators(columns, names, window, width=2.0):
+    """Evaluate the requested indicators over a rollup series' columns"""
+    close = columns['close']
+    results = {}
+    for name in names:
+        if name == "sma":
+            results["sma"] = sma(close, window)
+        elif name == "ema":
+            results["ema"] = ema(close, window)
+        elif name == "volatility":
+            results["volatility"] = volatility(close, window)
+        elif name == "bollinger":
+            results["bollinger_middle"], results["bollinger_upper"], results["bollinger_lower"] = bollinger(close, window, width)
+        elif name == "vwap":
+            results["vwap"] = rolling_vwap(columns['turnover'], columns['volume'], window)
+    return results
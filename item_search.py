@@ -0,0 +1,148 @@
+import base64
+import json
+import logging
+from sqlalchemy import func, literal_column, select, text, tuple_
+from sqlalchemy.sql import column, table
+
+from models import Item
+
+logger = logging.getLogger(__name__)
+
+# Approximate totals stop counting here
+APPROX_TOTAL_CAP = 1000
+
+# Shortest term the trigram index can match; shorter terms are name prefixes
+TRIGRAM_MIN_LENGTH = 3
+
+# Range of the BIGINT columns a cursor's ints are compared against
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+# FTS5 index over items.name on SQLite, maintained by update_items_database
+items_fts = table("items_fts", column("rowid"), column("name"))
+
+def create_search_index(conn):
+    """Create the dialect's item name index: FTS5 trigram on SQLite, pg_trgm on PostgreSQL"""
+    dialect = conn.dialect.name
+    if dialect == "sqlite":
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_items_name_nocase ON items (name COLLATE NOCASE)"))
+        try:
+            conn.execute(text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5("
+                "name, content='items', content_rowid='type_id', tokenize='trigram')"
+            ))
+        except Exception as e:
+            # SQLite before 3.34 has no trigram tokenizer; search falls back to LIKE
+            logger.warning(f"FTS5 trigram index unavailable, item search uses LIKE: {e}")
+            return
+        conn.execute(text("INSERT INTO items_fts(items_fts) VALUES ('rebuild')"))
+    elif dialect == "postgresql":
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_items_name_trgm ON items USING gin (name gin_trgm_ops)"))
+
+def has_fts(conn):
+    if conn.dialect.name != "sqlite":
+        return False
+    return conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'items_fts'")).first() is not None
+
+def index_items(db, added=(), renamed=()):
+    """Mirror item inserts and renames into the FTS5 index inside the caller's transaction.
+
+    added holds (type_id, name) pairs, renamed (type_id, old_name, new_name).
+    PostgreSQL maintains its trigram index itself.
+    """
+    if not (added or renamed) or not has_fts(db.connection()):
+        return
+    insert = text("INSERT INTO items_fts(rowid, name) VALUES (:type_id, :name)")
+    if renamed:
+        # External-content FTS5 rows are removed by replaying their old values
+        db.execute(
+            text("INSERT INTO items_fts(items_fts, rowid, name) VALUES ('delete', :type_id, :name)"),
+            [{"type_id": type_id, "name": old_name} for type_id, old_name, _ in renamed]
+        )
+        db.execute(insert, [{"type_id": type_id, "name": new_name} for type_id, _, new_name in renamed])
+    if added:
+        db.execute(insert, [{"type_id": type_id, "name": name} for type_id, name in added])
+
+def escape_like(term):
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key, separators=(",", ":")).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor, types):
+    """Decode a next_cursor value whose key fields must have the given types.
+
+    Raises ValueError on anything malformed, so a forged cursor is a 400
+    rather than a database error.
+    """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(key, list) or not key:
+        raise ValueError("Invalid cursor")
+    if len(key) != len(types):
+        raise ValueError("Cursor does not belong to this query")
+    # bool is an int to isinstance, but never a valid key
+    if any(isinstance(value, bool) or not isinstance(value, kind) for value, kind in zip(key, types)):
+        raise ValueError("Invalid cursor")
+    if any(isinstance(value, int) and not INT64_MIN <= value <= INT64_MAX for value in key):
+        raise ValueError("Invalid cursor")
+    return key
+
+def match_condition(search, dialect, fts):
+    """Filter for items whose name contains search (or starts with it, for short terms)"""
+    if fts and len(search) >= TRIGRAM_MIN_LENGTH:
+        phrase = '"' + search.replace('"', '""') + '"'
+        matches = select(items_fts.c.rowid).where(literal_column("items_fts").op("MATCH")(phrase))
+        return Item.type_id.in_(matches)
+    if dialect == "sqlite":
+        # SQLite's LIKE is case-insensitive and a prefix can use the NOCASE index
+        pattern = escape_like(search) + "%" if fts else "%" + escape_like(search) + "%"
+        return Item.name.like(pattern, escape="\\")
+    return Item.name.ilike("%" + escape_like(search) + "%", escape="\\")
+
+async def search_items(db, search=None, limit=100, cursor=None, skip=0, total="approx"):
+    """One page of items, optionally filtered by name.
+
+    Pages are keyset-paginated: by (name, type_id) when searching, by
+    type_id otherwise, and next_cursor encodes the last key. total is
+    "none", "exact" or "approx" (counted up to APPROX_TOTAL_CAP).
+    """
+    conn = await db.connection()
+    dialect = conn.dialect.name
+    fts = await conn.run_sync(has_fts)
+
+    conditions = []
+    if search:
+        conditions.append(match_condition(search, dialect, fts))
+        order = (Item.name, Item.type_id)
+        key_types = (str, int)
+    else:
+        order = (Item.type_id,)
+        key_types = (int,)
+
+    page_conditions = list(conditions)
+    if cursor:
+        key = decode_cursor(cursor, key_types)
+        page_conditions.append(tuple_(*order) > tuple_(*key) if len(order) > 1 else order[0] > key[0])
+
+    query = select(Item).where(*page_conditions).order_by(*order).limit(limit)
+    if skip and not cursor:
+        query = query.offset(skip)
+    items = (await db.scalars(query)).all()
+
+    next_cursor = None
+    if len(items) == limit:
+        last = items[-1]
+        next_cursor = encode_cursor([last.name, last.type_id] if search else [last.type_id])
+
+    result = {"items": items, "limit": limit, "skip": skip, "next_cursor": next_cursor}
+    if total != "none":
+        matching = select(Item.type_id).where(*conditions)
+        if total == "approx":
+            matching = matching.limit(APPROX_TOTAL_CAP)
+        count = await db.scalar(select(func.count()).select_from(matching.subquery()))
+        result["total"] = count
+        result["total_exact"] = total == "exact" or count < APPROX_TOTAL_CAP
+    return result
@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import schedule
+
+from metrics import ingest_runs
+from progress import IngestProgress
+
+logger = logging.getLogger(__name__)
+
+# Periodic ingest inside the API process. Off by default: with several API
+# workers every one of them would run its own schedule.
+INGEST_SCHEDULE_MINUTES = int(os.getenv("INGEST_SCHEDULE_MINUTES", "0"))
+INGEST_SCHEDULE_AT = [at.strip() for at in os.getenv("INGEST_SCHEDULE_AT", "").split(",") if at.strip()]
+# Finished jobs kept around for the status endpoint
+INGEST_JOB_HISTORY = int(os.getenv("INGEST_JOB_HISTORY", "20"))
+
+class IngestJob:
+    """One run of fetch_market_data and its progress"""
+
+    def __init__(self, trigger, on_write=()):
+        self.id = uuid.uuid4().hex
+        self.trigger = trigger
+        self.status = "queued"
+        self.created_at = datetime.utcnow()
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+        self.progress = IngestProgress(on_write)
+
+    @property
+    def active(self):
+        return self.status in ("queued", "running")
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "trigger": self.trigger,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+            "progress": self.progress.snapshot()
+        }
+
+class IngestJobRunner:
+    """Runs the ingest off the API's event loop, one job at a time.
+
+    The ingest mixes aiohttp with synchronous SQLAlchemy work, so it gets a
+    worker thread with its own event loop. Triggers arriving while a job is
+    queued or running join that job instead of starting a second one.
+    """
+
+    def __init__(self, history=INGEST_JOB_HISTORY):
+        self.history = history
+        self.jobs = OrderedDict()
+        self.current = None
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingest")
+        # Called from the ingest thread whenever a job commits rows
+        self.on_write = []
+
+    def start(self, trigger="manual"):
+        """Start an ingest job, or join the active one. Returns (job, created)"""
+        with self.lock:
+            if self.current and self.current.active:
+                return self.current, False
+            job = IngestJob(trigger, self.on_write)
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.history:
+                self.jobs.popitem(last=False)
+            self.current = job
+        self.executor.submit(self._run, job)
+        return job, True
+
+    def _run(self, job):
+        # Imported on first use: the ingest stack (aiohttp, the ESI client,
+        # the parse pool) is not needed to serve the API
+        from fetch_market import fetch_market_data
+
+        job.status = "running"
+        job.started_at = datetime.utcnow()
+        logger.info(f"Ingest job {job.id} started ({job.trigger})")
+        try:
+            asyncio.run(fetch_market_data(progress=job.progress))
+            job.status = "succeeded"
+        except Exception as e:
+            logger.exception(f"Ingest job {job.id} failed")
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            job.finished_at = datetime.utcnow()
+            ingest_runs.inc(status=job.status)
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def latest(self):
+        with self.lock:
+            return self.current
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+class IngestSchedule:
+    """Drives periodic ingest runs from a daemon thread using `schedule`"""
+
+    def __init__(self, runner, every_minutes=INGEST_SCHEDULE_MINUTES, daily_at=INGEST_SCHEDULE_AT):
+        self.runner = runner
+        self.scheduler = schedule.Scheduler()
+        self.stop_event = threading.Event()
+        self.thread = None
+        if every_minutes > 0:
+            self.scheduler.every(every_minutes).minutes.do(self.trigger)
+        for at in daily_at:
+            self.scheduler.every().day.at(at).do(self.trigger)
+
+    @property
+    def enabled(self):
+        return bool(self.scheduler.jobs)
+
+    def trigger(self):
+        job, created = self.runner.start("schedule")
+        if not created:
+            logger.info(f"Scheduled ingest skipped, job {job.id} still {job.status}")
+
+    def loop(self):
+        while not self.stop_event.is_set():
+            self.scheduler.run_pending()
+            idle = self.scheduler.idle_seconds
+            self.stop_event.wait(min(idle, 60) if idle is not None and idle > 0 else 1)
+
+    def start(self):
+        if not self.enabled or self.thread:
+            return
+        self.thread = threading.Thread(target=self.loop, name="ingest-schedule", daemon=True)
+        self.thread.start()
+        logger.info(f"Ingest schedule started: {self.scheduler.jobs}")
+
+    def stop(self):
+        self.stop_event.set()
+
+ingest_runner = IngestJobRunner()
+ingest_schedule = IngestSchedule(ingest_runner)
@@ -0,0 +1,280 @@
+import asyncio
+import json
+import logging
+import os
+import numpy as np
+from fastapi.encoders import jsonable_encoder
+from starlette.concurrency import run_in_threadpool
+
+from arbitrage import select_top, snapshot_pairs
+from cache import current_generation
+from database import AsyncSessionLocal
+from metrics import live_dropped, live_events, live_subscribers
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks for new data and job progress; an ingest in this
+# process wakes the feed on every commit instead
+LIVE_POLL_SECONDS = float(os.getenv("LIVE_POLL_SECONDS", "2"))
+# Minimum profit for a pair to count as an arbitrage hit, as in /arbitrage
+LIVE_ARBITRAGE_MIN_PROFIT = float(os.getenv("LIVE_ARBITRAGE_MIN_PROFIT", "1000000"))
+# Events buffered per client; a client that falls further behind is disconnected
+LIVE_QUEUE_SIZE = int(os.getenv("LIVE_QUEUE_SIZE", "100"))
+# Concurrent feed clients per API process
+LIVE_MAX_SUBSCRIBERS = int(os.getenv("LIVE_MAX_SUBSCRIBERS", "1000"))
+# Seconds between keep-alive comments on an idle stream
+LIVE_HEARTBEAT_SECONDS = 15
+
+TOPICS = ("prices", "arbitrage", "jobs")
+
+# Row fields a region filter is matched against
+REGION_FIELDS = ("region_id", "buy_region_id", "sell_region_id")
+
+def sse(event, data):
+    """One server-sent event; data is JSON on a single line"""
+    return f"event: {event}\ndata: {data}\n\n"
+
+class Subscriber:
+    """One feed client: its filters and the encoded events waiting for it"""
+
+    def __init__(self, topics, type_ids=None, region_ids=None, queue_size=LIVE_QUEUE_SIZE):
+        self.topics = set(topics)
+        self.type_ids = set(type_ids or ())
+        self.region_ids = set(region_ids or ())
+        self.queue = asyncio.Queue(queue_size)
+        self.overflowed = False
+
+    @property
+    def filtered(self):
+        return bool(self.type_ids or self.region_ids)
+
+    def accepts(self, row):
+        if self.type_ids and row['type_id'] not in self.type_ids:
+            return False
+        if self.region_ids and not any(row.get(field) in self.region_ids for field in REGION_FIELDS):
+            return False
+        return True
+
+    def send(self, message):
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # Dropping single events would leave the client with silently
+            # wrong state; it reconnects and re-reads instead
+            self.overflowed = True
+            live_dropped.inc()
+
+class LiveHub:
+    """In-process fan-out of feed events to subscribed clients.
+
+    Every event is computed once per change and encoded once per distinct
+    filter result, so the work per change grows with the number of
+    clients only by a filter pass and a queue put. Runs on the event loop;
+    publish from other threads through the loop.
+    """
+
+    def __init__(self, max_subscribers=LIVE_MAX_SUBSCRIBERS):
+        self.max_subscribers = max_subscribers
+        self.subscribers = set()
+
+    def subscribe(self, topics, type_ids=None, region_ids=None):
+        """Register a client, or return None when the process is at max_subscribers"""
+        if len(self.subscribers) >= self.max_subscribers:
+            return None
+        subscriber = Subscriber(topics, type_ids, region_ids)
+        self.subscribers.add(subscriber)
+        live_subscribers.set(len(self.subscribers))
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+        live_subscribers.set(len(self.subscribers))
+
+    def wants(self, topic):
+        return any(topic in subscriber.topics for subscriber in self.subscribers)
+
+    def publish(self, topic, payload, rows=None):
+        """Send payload to every subscriber of topic.
+
+        With rows, the event carries each subscriber's matching rows as
+        payload["changes"] and is skipped for subscribers none match.
+        """
+        unfiltered = None
+        for subscriber in list(self.subscribers):
+            if topic not in subscriber.topics:
+                continue
+            if rows is None:
+                matching = None
+            elif subscriber.filtered:
+                matching = [row for row in rows if subscriber.accepts(row)]
+                if not matching:
+                    continue
+            else:
+                matching = rows
+            if matching is rows:
+                if unfiltered is None:
+                    unfiltered = sse(topic, json.dumps(jsonable_encoder({**payload, 'changes': rows} if rows is not None else payload)))
+                message = unfiltered
+            else:
+                message = sse(topic, json.dumps(jsonable_encoder({**payload, 'changes': matching})))
+            subscriber.send(message)
+            live_events.inc(topic=topic)
+
+    async def stream(self, subscriber):
+        """Server-sent events for one subscriber until it disconnects or falls behind"""
+        try:
+            # Reconnect delay for EventSource clients
+            yield f"retry: {int(LIVE_HEARTBEAT_SECONDS * 1000)}\n\n"
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscriber.queue.get(), LIVE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    # Comment lines keep proxies from closing an idle stream
+                    yield ": keep-alive\n\n"
+                    continue
+                yield message
+                if subscriber.overflowed and subscriber.queue.empty():
+                    yield sse("overflow", json.dumps({'reason': "client fell behind, reconnect and reload"}))
+                    return
+        finally:
+            self.unsubscribe(subscriber)
+
+def row_keys(columns):
+    return (columns['type_id'] << 32) | columns['region_id']
+
+def nan_equal(a, b):
+    return (a == b) | (np.isnan(a) & np.isnan(b))
+
+def price_changes(previous, current):
+    """Latest prices in current that are new or differ from previous, with the previous prices"""
+    keys = row_keys(current)
+    found = np.zeros(len(keys), dtype=bool)
+    buy_max = np.full(len(keys), np.nan)
+    sell_min = np.full(len(keys), np.nan)
+    previous_keys = row_keys(previous)
+    if len(previous_keys):
+        order = np.argsort(previous_keys, kind='stable')
+        pos = np.minimum(np.searchsorted(previous_keys[order], keys), len(order) - 1)
+        rows = order[pos]
+        found = previous_keys[rows] == keys
+        buy_max = previous['buy_max'][rows]
+        sell_min = previous['sell_min'][rows]
+    same = found & nan_equal(buy_max, current['buy_max']) & nan_equal(sell_min, current['sell_min'])
+
+    def price(value):
+        return None if np.isnan(value) else value
+
+    changes = []
+    for row in np.flatnonzero(~same).tolist():
+        changes.append({
+            'type_id': int(current['type_id'][row]),
+            'region_id': int(current['region_id'][row]),
+            'buy_max': price(float(current['buy_max'][row])),
+            'sell_min': price(float(current['sell_min'][row])),
+            'buy_volume': int(current['buy_volume'][row]),
+            'sell_volume': int(current['sell_volume'][row]),
+            'previous_buy_max': price(float(buy_max[row])) if found[row] else None,
+            'previous_sell_min': price(float(sell_min[row])) if found[row] else None
+        })
+    return changes
+
+def arbitrage_hits(columns, pairs, min_profit=LIVE_ARBITRAGE_MIN_PROFIT):
+    """Every pair at or above min_profit, keyed by (type_id, buy_region_id, sell_region_id)"""
+    hits = select_top(columns, pairs, min_profit, max(len(pairs['profit']), 1))
+    return {(hit['type_id'], hit['buy_region_id'], hit['sell_region_id']): hit for hit in hits}
+
+def arbitrage_changes(previous, current):
+    return (
+        [{**hit, 'change': "appeared"} for key, hit in current.items() if key not in previous] +
+        [{**hit, 'change': "disappeared"} for key, hit in previous.items() if key not in current]
+    )
+
+class LiveFeed:
+    """Turns new data generations and ingest progress into hub events.
+
+    Checks the data generation every LIVE_POLL_SECONDS, so ingests running
+    in other processes are picked up too; an ingest in this process wakes
+    the feed through notify() whenever it publishes a stage. Each new generation is
+    diffed once against the previous snapshot, reusing the snapshot the
+    /arbitrage endpoint caches. Nothing is computed while no client
+    listens.
+    """
+
+    def __init__(self, hub, latest_job=None, poll_seconds=LIVE_POLL_SECONDS):
+        self.hub = hub
+        self.latest_job = latest_job
+        self.poll_seconds = poll_seconds
+        self.generation = None
+        self.columns = None
+        self.hits = None
+        self.job_message = None
+        self.loop = None
+        self.wake = None
+        self.task = None
+
+    def notify(self):
+        """Wake the feed; safe to call from any thread"""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wake.set)
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.wake = asyncio.Event()
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        self.loop = None
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wake.wait(), self.poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            try:
+                await self.check_data()
+                self.check_job()
+            except Exception as e:
+                logger.error(f"Error updating live feed: {e}")
+
+    async def check_data(self):
+        if not (self.hub.wants("prices") or self.hub.wants("arbitrage")):
+            # Without listeners there is no baseline to keep current
+            self.generation = self.columns = self.hits = None
+            return
+        async with AsyncSessionLocal() as db:
+            generation = await current_generation(db)
+            if generation == self.generation:
+                return
+            columns, pairs = await snapshot_pairs(db)
+        hits = await run_in_threadpool(arbitrage_hits, columns, pairs)
+        if self.columns is not None:
+            payload = {'generation': generation}
+            prices = await run_in_threadpool(price_changes, self.columns, columns)
+            if prices:
+                self.hub.publish("prices", payload, prices)
+            arbitrage = arbitrage_changes(self.hits, hits)
+            if arbitrage:
+                self.hub.publish("arbitrage", payload, arbitrage)
+        self.generation, self.columns, self.hits = generation, columns, hits
+
+    def check_job(self):
+        if self.latest_job is None or not self.hub.wants("jobs"):
+            return
+        job = self.latest_job()
+        if job is None:
+            return
+        state = jsonable_encoder(job.to_dict())
+        message = json.dumps(state)
+        if message != self.job_message:
+            self.job_message = message
+            self.hub.publish("jobs", state)
+
+live_hub = LiveHub()
@@ -0,0 +1,243 @@
+import contextvars
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter as StatementCounts
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# The same statement run this often in one API request is reported as N+1
+N_PLUS_ONE_THRESHOLD = int(os.getenv("METRICS_N_PLUS_ONE_THRESHOLD", "10"))
+
+# Latency buckets in seconds: HTTP and ESI requests, and single DB statements
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 250, 1000)
+
+# Starlette appends the charset
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(names, values, extra=()):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    """A named metric family with a fixed set of label names.
+
+    The ingest thread and the API's event loop both record into the same
+    metrics, so every family guards its samples with a lock.
+    """
+
+    kind = None
+
+    def __init__(self, name, help, labels=(), registry=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.samples = {}
+        self.lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, value in sorted(self.samples.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, key)} {format_value(value)}")
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.samples[key] = self.samples.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.samples[self.key(labels)] = value
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=REQUEST_BUCKETS, registry=None):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, labels, registry)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            sample = self.samples.get(key)
+            if sample is None:
+                # Per-bucket counts, then sum and count
+                sample = self.samples[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    sample[0][i] += 1
+                    break
+            sample[1] += value
+            sample[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.samples.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    le = (("le", format_value(float(bound))),)
+                    lines.append(f"{self.name}_bucket{format_labels(self.labels, key, le)} {cumulative}")
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, key, (('le', '+Inf'),))} {count}")
+                lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {format_value(float(total))}")
+                lines.append(f"{self.name}_count{format_labels(self.labels, key)} {count}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+esi_requests = Counter("esi_requests_total", "ESI requests sent, retries included", ("endpoint", "method", "status"))
+esi_request_seconds = Histogram("esi_request_duration_seconds", "ESI request latency", ("endpoint", "method"))
+
+ingest_rows = Counter("ingest_rows_total", "Rows processed and written per ingest stage", ("stage", "kind"))
+ingest_stage_seconds = Gauge("ingest_stage_duration_seconds", "Duration of each stage in the last ingest run", ("stage",))
+ingest_runs = Counter("ingest_runs_total", "Finished ingest jobs", ("status",))
+pipeline_units = Counter("ingest_pipeline_units_total", "Bytes fetched and rows parsed, aggregated and written per pipeline stage", ("stage",))
+pipeline_busy_seconds = Counter("ingest_pipeline_busy_seconds_total", "Time spent in pipeline jobs per stage, summed over workers", ("stage",))
+pipeline_queue_depth = Gauge("ingest_pipeline_queue_depth", "Jobs waiting in a pipeline queue when one was last added", ("queue",))
+
+live_subscribers = Gauge("live_subscribers", "Clients connected to the /live feed")
+live_events = Counter("live_events_total", "Events queued for /live clients", ("topic",))
+live_dropped = Counter("live_dropped_total", "/live clients disconnected for falling behind")
+
+db_query_seconds = Histogram("db_query_duration_seconds", "Database statement latency", ("engine", "operation"), QUERY_BUCKETS)
+db_request_queries = Histogram("db_queries_per_request", "Database statements per API request", ("route",), COUNT_BUCKETS)
+db_n_plus_one = Counter("db_n_plus_one_total", "API requests repeating one statement at least METRICS_N_PLUS_ONE_THRESHOLD times", ("route",))
+
+http_requests = Counter("http_requests_total", "API requests", ("method", "route", "status"))
+http_request_seconds = Histogram("http_request_duration_seconds", "API request latency up to the last body chunk", ("method", "route"))
+
+def esi_endpoint(path):
+    """Collapse IDs in an ESI path so requests group by endpoint type"""
+    return re.sub(r"/\d+(?=/|$)", "/{id}", path)
+
+class QueryTracker:
+    """Statements executed while serving one API request"""
+
+    def __init__(self):
+        self.count = 0
+        self.statements = StatementCounts()
+
+    def record(self, statement):
+        self.count += 1
+        self.statements[statement] += 1
+
+    def repeated(self):
+        """The most repeated statement and how often it ran"""
+        if not self.statements:
+            return None, 0
+        return self.statements.most_common(1)[0]
+
+# Set by MetricsMiddleware for the duration of a request
+current_queries = contextvars.ContextVar("current_queries", default=None)
+
+def statement_operation(statement):
+    word = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else ""
+    return word if word in ("select", "insert", "update", "delete", "with") else "other"
+
+def instrument_engine(engine, name):
+    """Time every statement on a sync engine (or an async engine's sync_engine)"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_started"].pop()
+        db_query_seconds.observe(time.perf_counter() - started, engine=name, operation=statement_operation(statement))
+        tracker = current_queries.get()
+        if tracker is not None:
+            tracker.record(statement)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        # A failed statement never reaches after_cursor_execute
+        started = context.connection.info.get("query_started") if context.connection is not None else None
+        if started:
+            started.pop()
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency, status and DB statements per route.
+
+    Routes are labelled by their path template, so /items/34 and /items/35
+    share a series. Latency runs until the last body chunk is sent, which
+    includes the time spent streaming exports.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        tracker = QueryTracker()
+        token = current_queries.set(tracker)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            current_queries.reset(token)
+            route = scope.get("route")
+            # Unmatched paths share one label so scanners cannot grow the series
+            path = route.path if route is not None else "unmatched"
+            method = scope["method"]
+            http_request_seconds.observe(time.perf_counter() - started, method=method, route=path)
+            http_requests.inc(method=method, route=path, status=status)
+            db_request_queries.observe(tracker.count, route=path)
+            statement, times = tracker.repeated()
+            if times >= N_PLUS_ONE_THRESHOLD:
+                db_n_plus_one.inc(route=path)
+                logger.warning(f"{method} {path} ran one statement {times} times (N+1?): {' '.join(statement.split())[:200]}")
+
+def render():
+    return REGISTRY.render()
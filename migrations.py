@@ -0,0 +1,139 @@
+import argparse
+from datetime import datetime
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, text
+import logging
+
+from models import Item, Region, MarketData, MarketLatest, OrderHistory, HistorySyncState, DataGeneration, PriceRollup, OrderBookDepth, IngestRun, IngestShard
+from item_search import create_search_index
+from partitions import partition_market_data, partitioning_enabled, is_partitioned
+
+logger = logging.getLogger(__name__)
+
+# Applied versions are recorded here, like Alembic's alembic_version table
+migration_metadata = MetaData()
+schema_migrations = Table(
+    "schema_migrations",
+    migration_metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", String, nullable=False),
+    Column("applied_at", DateTime, default=datetime.utcnow),
+)
+
+def create_tables(conn, *models):
+    for model in models:
+        model.__table__.create(bind=conn, checkfirst=True)
+
+def create_indexes(conn, *indexes):
+    for index in indexes:
+        index.create(bind=conn, checkfirst=True)
+
+def drop_indexes(conn, table_name, *index_names):
+    existing = {index["name"] for index in inspect(conn).get_indexes(table_name)}
+    for name in index_names:
+        if name in existing:
+            conn.execute(text(f"DROP INDEX {name}"))
+
+def table_index(model, name):
+    return next(index for index in model.__table__.indexes if index.name == name)
+
+# Every step is idempotent so databases created by the old create_all()
+# calls, which carry no version table, can be brought under migration.
+
+def initial_schema(conn):
+    create_tables(conn, Item, Region, MarketData, OrderHistory)
+
+def upsert_keys(conn):
+    create_indexes(
+        conn,
+        table_index(MarketData, "uq_market_data_type_region_timestamp"),
+        table_index(OrderHistory, "uq_order_history_type_region_date"),
+    )
+    create_tables(conn, HistorySyncState)
+
+def market_latest(conn):
+    create_tables(conn, MarketLatest)
+
+def composite_indexes(conn):
+    # The (type_id, region_id, timestamp/date) upsert keys also serve the
+    # per-item time-range reads; the separate id indexes only duplicate the
+    # primary keys and slow down every insert.
+    drop_indexes(conn, "market_data", "ix_market_data_id")
+    drop_indexes(conn, "order_history", "ix_order_history_id")
+
+def data_generation(conn):
+    create_tables(conn, DataGeneration)
+    if conn.execute(DataGeneration.__table__.select()).first() is None:
+        conn.execute(DataGeneration.__table__.insert().values(id=1, generation=0))
+
+def price_rollups(conn):
+    create_tables(conn, PriceRollup)
+
+def order_book_depth(conn):
+    create_tables(conn, OrderBookDepth)
+
+def ingest_shards(conn):
+    create_tables(conn, IngestRun, IngestShard)
+
+def partition_by_month(conn):
+    if not is_partitioned(conn):
+        partition_market_data(conn)
+
+# (version, description, upgrade function, condition)
+# A step whose condition is false is left pending and re-evaluated on the next upgrade.
+MIGRATIONS = [
+    (1, "initial schema", initial_schema, None),
+    (2, "upsert keys and history sync state", upsert_keys, None),
+    (3, "market_latest snapshot table", market_latest, None),
+    (4, "composite time-range indexes", composite_indexes, None),
+    (5, "monthly partitioning of market_data", partition_by_month, partitioning_enabled),
+    (6, "data generation counter", data_generation, None),
+    (7, "price rollup table", price_rollups, None),
+    (8, "item name search index", create_search_index, None),
+    (9, "order book depth store", order_book_depth, None),
+    (10, "ingest run shards and leases", ingest_shards, None),
+]
+
+def applied_versions(conn):
+    schema_migrations.create(bind=conn, checkfirst=True)
+    return {version for (version,) in conn.execute(schema_migrations.select().with_only_columns(schema_migrations.c.version))}
+
+def pending_migrations(engine):
+    with engine.begin() as conn:
+        applied = applied_versions(conn)
+    return [
+        migration for migration in MIGRATIONS
+        if migration[0] not in applied and (migration[3] is None or migration[3](engine))
+    ]
+
+def upgrade(engine):
+    """Apply pending migrations in order, each in its own transaction"""
+    for version, description, step, _ in pending_migrations(engine):
+        with engine.begin() as conn:
+            step(conn)
+            conn.execute(schema_migrations.insert().values(version=version, description=description))
+        logger.info(f"Applied migration {version}: {description}")
+
+def status(engine):
+    with engine.begin() as conn:
+        applied = applied_versions(conn)
+    for version, description, _, condition in MIGRATIONS:
+        if version in applied:
+            state = "applied"
+        elif condition is not None and not condition(engine):
+            state = "skipped"
+        else:
+            state = "pending"
+        print(f"{version:4}  {state:8}  {description}")
+
+if __name__ == "__main__":
+    from database import engine
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Database schema migrations")
+    parser.add_argument("command", choices=["upgrade", "status"])
+    args = parser.parse_args()
+
+    if args.command == "upgrade":
+        upgrade(engine)
+    else:
+        status(engine)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Boolean, Text
+from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Boolean, Text, Index, LargeBinary
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime
@@ -7,6 +7,7 @@ Base = declarative_base()
 
 class Item(Base):
     __tablename__ = "items"
+    __upsert_key__ = ("type_id",)
     
     type_id = Column(Integer, primary_key=True, index=True)
     name = Column(String, nullable=False)
@@ -34,8 +35,14 @@ class Region(Base):
 
 class MarketData(Base):
     __tablename__ = "market_data"
+    __table_args__ = (
+        # One snapshot per item/region/fetch time; makes re-ingesting a snapshot
+        # idempotent and serves per-item time-range reads
+        Index("uq_market_data_type_region_timestamp", "type_id", "region_id", "timestamp", unique=True),
+    )
+    __upsert_key__ = ("type_id", "region_id", "timestamp")
     
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     type_id = Column(Integer, ForeignKey("items.type_id"), nullable=False)
     region_id = Column(Integer, ForeignKey("regions.region_id"), nullable=False)
     
@@ -61,10 +68,38 @@ class MarketData(Base):
     item = relationship("Item", back_populates="market_data")
     region = relationship("Region", back_populates="market_data")
 
+class MarketLatest(Base):
+    """Most recent MarketData snapshot per item/region, upserted at ingest"""
+    __tablename__ = "market_latest"
+    __upsert_key__ = ("type_id", "region_id")
+    # Conflicting rows are only replaced by snapshots at least as new
+    __upsert_version__ = "timestamp"
+    
+    type_id = Column(Integer, ForeignKey("items.type_id"), primary_key=True)
+    region_id = Column(Integer, ForeignKey("regions.region_id"), primary_key=True)
+    
+    buy_max = Column(Float)
+    buy_min = Column(Float)
+    buy_avg = Column(Float)
+    buy_volume = Column(Integer)
+    buy_orders = Column(Integer)
+    
+    sell_max = Column(Float)
+    sell_min = Column(Float)
+    sell_avg = Column(Float)
+    sell_volume = Column(Integer)
+    sell_orders = Column(Integer)
+    
+    timestamp = Column(DateTime, nullable=False)
+
 class OrderHistory(Base):
     __tablename__ = "order_history"
+    __table_args__ = (
+        Index("uq_order_history_type_region_date", "type_id", "region_id", "date", unique=True),
+    )
+    __upsert_key__ = ("type_id", "region_id", "date")
     
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     type_id = Column(Integer, ForeignKey("items.type_id"), nullable=False)
     region_id = Column(Integer, ForeignKey("regions.region_id"), nullable=False)
     
@@ -78,3 +113,115 @@ class OrderHistory(Base):
     
     created_at = Column(DateTime, default=datetime.utcnow)
 
+
+class HistorySyncState(Base):
+    """Per item/region watermark for incremental history sync"""
+    __tablename__ = "history_sync_state"
+    __upsert_key__ = ("type_id", "region_id")
+    
+    type_id = Column(Integer, ForeignKey("items.type_id"), primary_key=True)
+    region_id = Column(Integer, ForeignKey("regions.region_id"), primary_key=True)
+    
+    # Newest history date already stored in order_history
+    last_date = Column(DateTime)
+    
+    # ESI cache validators from the last history response
+    etag = Column(String)
+    expires = Column(DateTime)
+    last_modified = Column(String)
+    
+    checked_at = Column(DateTime, default=datetime.utcnow)
+
+class OrderBookDepth(Base):
+    """Latest order book per item/region as price levels, upserted at ingest.
+
+    book is the binary encoding from order_book.encode_book: sorted level
+    prices and cumulative volumes of both sides.
+    """
+    __tablename__ = "order_book_depth"
+    __upsert_key__ = ("type_id", "region_id")
+    # Conflicting rows are only replaced by books at least as new
+    __upsert_version__ = "timestamp"
+    
+    type_id = Column(Integer, ForeignKey("items.type_id"), primary_key=True)
+    region_id = Column(Integer, ForeignKey("regions.region_id"), primary_key=True)
+    
+    sell_levels = Column(Integer, nullable=False)
+    buy_levels = Column(Integer, nullable=False)
+    book = Column(LargeBinary, nullable=False)
+    
+    timestamp = Column(DateTime, nullable=False)
+
+class PriceRollup(Base):
+    """OHLC bucket per item/region and resolution, refreshed after each ingest.
+
+    Hour buckets are built from market_data snapshots (mid price, no traded
+    volume); day and week buckets from order_history.
+    """
+    __tablename__ = "price_rollups"
+    __upsert_key__ = ("type_id", "region_id", "resolution", "bucket")
+    
+    type_id = Column(Integer, ForeignKey("items.type_id"), primary_key=True)
+    region_id = Column(Integer, ForeignKey("regions.region_id"), primary_key=True)
+    resolution = Column(String, primary_key=True)  # hour, day or week
+    bucket = Column(DateTime, primary_key=True)  # Start of the bucket
+    
+    open = Column(Float)
+    high = Column(Float)
+    low = Column(Float)
+    close = Column(Float)
+    volume = Column(Integer)
+    turnover = Column(Float)  # Sum of price * volume, for VWAP over any span
+    order_count = Column(Integer)
+    samples = Column(Integer)  # Snapshots or history days in the bucket
+
+class DataGeneration(Base):
+    """Single-row counter bumped whenever ingested data is committed"""
+    __tablename__ = "data_generation"
+    
+    id = Column(Integer, primary_key=True)
+    generation = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class IngestRun(Base):
+    """One market refresh, split into IngestShards that ingest workers lease.
+
+    The settings every worker needs to agree on are stored with the run, so
+    workers joining it do not depend on their own environment.
+    """
+    __tablename__ = "ingest_runs"
+    
+    id = Column(String, primary_key=True)
+    snapshot_time = Column(DateTime, nullable=False)  # Timestamp of every snapshot in the run
+    regions = Column(Text, nullable=False)  # Comma-separated region IDs
+    type_ids = Column(Text)  # Comma-separated type IDs, or all market types
+    type_limit = Column(Integer, nullable=False, default=0)  # Lowest market type IDs only; 0 for all
+    bulk_orders = Column(Boolean, nullable=False)
+    shard_by = Column(String, nullable=False)  # region or type
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime)
+
+class IngestShard(Base):
+    """A unit of an ingest run, claimed by one worker at a time through a lease.
+
+    orders shards snapshot one region's order book; history shards sync
+    history for one region, or for the types with type_id % buckets ==
+    bucket in every region.
+    """
+    __tablename__ = "ingest_shards"
+    
+    run_id = Column(String, ForeignKey("ingest_runs.id"), primary_key=True)
+    shard = Column(String, primary_key=True)  # e.g. orders:10000002, history:type:3/16
+    phase = Column(String, nullable=False)  # orders or history
+    region_id = Column(Integer)
+    bucket = Column(Integer)
+    buckets = Column(Integer)
+    
+    status = Column(String, nullable=False, default="pending")  # pending, leased, done or failed
+    worker = Column(String)
+    lease_expires = Column(DateTime)
+    attempts = Column(Integer, nullable=False, default=0)
+    rows_processed = Column(Integer)
+    error = Column(Text)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
@@ -0,0 +1,167 @@
+import os
+import struct
+import zlib
+import numpy as np
+from sqlalchemy import select
+
+from models import OrderBookDepth
+from order_stats import book_levels
+
+# Keep each latest order book at ingest for depth queries
+ORDER_BOOK_DEPTH = os.getenv("ORDER_BOOK_DEPTH", "true").lower() in ("1", "true", "yes")
+
+# "zlib" or "none"
+ORDER_BOOK_COMPRESSION = os.getenv("ORDER_BOOK_COMPRESSION", "zlib")
+
+# Columns replaced in order_book_depth by every new book
+BOOK_FIELDS = ('sell_levels', 'buy_levels', 'book', 'timestamp')
+
+# version, flags, sell level count, buy level count
+BOOK_HEADER = struct.Struct("<BBII")
+BOOK_VERSION = 1
+FLAG_ZLIB = 1
+
+def encode_book(sell_prices, sell_volumes, buy_prices, buy_volumes, compression=ORDER_BOOK_COMPRESSION):
+    """Pack both sides of a book into one blob.
+
+    Each side is stored best level first as float64 prices followed by
+    int64 cumulative volumes, so depth lookups are a binary search on the
+    decoded arrays without any per-level work.
+    """
+    payload = b"".join((
+        np.asarray(sell_prices, dtype="<f8").tobytes(),
+        np.cumsum(sell_volumes, dtype="<i8").tobytes(),
+        np.asarray(buy_prices, dtype="<f8").tobytes(),
+        np.cumsum(buy_volumes, dtype="<i8").tobytes(),
+    ))
+    flags = 0
+    if compression == "zlib":
+        payload = zlib.compress(payload, 6)
+        flags |= FLAG_ZLIB
+    return BOOK_HEADER.pack(BOOK_VERSION, flags, len(sell_prices), len(buy_prices)) + payload
+
+class BookSide:
+    """One side of a decoded book, best level first"""
+
+    def __init__(self, prices, cumulative, ascending):
+        self.prices = prices
+        self.cumulative = cumulative
+        self.ascending = ascending
+        # ISK needed to take every level up to and including each one
+        self.notional = np.cumsum(prices * np.diff(np.r_[0, cumulative]))
+
+    @property
+    def total_volume(self):
+        return int(self.cumulative[-1]) if len(self.cumulative) else 0
+
+    @property
+    def best_price(self):
+        return float(self.prices[0]) if len(self.prices) else None
+
+    def levels(self, count):
+        volumes = np.diff(np.r_[0, self.cumulative[:count]])
+        return [[price, volume] for price, volume in zip(self.prices[:count].tolist(), volumes.tolist())]
+
+    def volume_to_price(self, price):
+        """Units available at prices at least as good as price"""
+        if self.ascending:
+            count = np.searchsorted(self.prices, price, side='right')
+        else:
+            count = np.searchsorted(-self.prices, -price, side='right')
+        return int(self.cumulative[count - 1]) if count else 0
+
+    def fill(self, units):
+        """Fill units against the side; returns filled units, ISK exchanged and the last level's price"""
+        if not len(self.prices) or units <= 0:
+            return 0, 0.0, None
+        level = np.searchsorted(self.cumulative, units, side='left')
+        if level >= len(self.prices):
+            return self.total_volume, float(self.notional[-1]), float(self.prices[-1])
+        before = int(self.cumulative[level - 1]) if level else 0
+        notional = (float(self.notional[level - 1]) if level else 0.0) + (units - before) * float(self.prices[level])
+        return units, notional, float(self.prices[level])
+
+def decode_book(blob):
+    """Unpack encode_book output into (sell, buy) BookSides"""
+    version, flags, sell_count, buy_count = BOOK_HEADER.unpack_from(blob)
+    if version != BOOK_VERSION:
+        raise ValueError(f"Unsupported order book version {version}")
+    payload = blob[BOOK_HEADER.size:]
+    if flags & FLAG_ZLIB:
+        payload = zlib.decompress(payload)
+    arrays = []
+    offset = 0
+    for count, dtype in ((sell_count, "<f8"), (sell_count, "<i8"), (buy_count, "<f8"), (buy_count, "<i8")):
+        arrays.append(np.frombuffer(payload, dtype=dtype, count=count, offset=offset))
+        offset += count * 8
+    return BookSide(arrays[0], arrays[1], True), BookSide(arrays[2], arrays[3], False)
+
+def book_rows(type_ids, prices, volumes, is_buy, region_id, timestamp, known_type_ids=None):
+    """Encode the order book of every type in columnar orders into order_book_depth rows"""
+    if not len(type_ids):
+        return []
+    levels = book_levels(type_ids, prices, volumes, is_buy)
+    level_types = levels['type_id']
+    starts = np.flatnonzero(np.r_[True, level_types[1:] != level_types[:-1]])
+    ends = np.r_[starts[1:], len(level_types)]
+    # Sell levels sort before buy levels within each type
+    buy_starts = starts + np.add.reduceat(~levels['is_buy'], starts)
+
+    rows = []
+    for type_id, start, buy_start, end in zip(level_types[starts].tolist(), starts.tolist(), buy_starts.tolist(), ends.tolist()):
+        if known_type_ids is not None and type_id not in known_type_ids:
+            continue
+        rows.append({
+            'type_id': type_id,
+            'region_id': region_id,
+            'sell_levels': buy_start - start,
+            'buy_levels': end - buy_start,
+            'book': encode_book(
+                levels['price'][start:buy_start], levels['volume'][start:buy_start],
+                levels['price'][buy_start:end], levels['volume'][buy_start:end]
+            ),
+            'timestamp': timestamp
+        })
+    return rows
+
+async def depth_query(db, type_id, region_id, side, levels=20, units=None, price=None, within_pct=None):
+    """Answer depth questions about one stored book, or None if it has not been stored"""
+    row = (await db.execute(
+        select(OrderBookDepth.book, OrderBookDepth.timestamp).where(
+            OrderBookDepth.type_id == type_id,
+            OrderBookDepth.region_id == region_id
+        )
+    )).first()
+    if row is None:
+        return None
+    sell, buy = decode_book(row.book)
+    book = sell if side == "sell" else buy
+
+    result = {
+        'type_id': type_id,
+        'region_id': region_id,
+        'side': side,
+        'timestamp': row.timestamp,
+        'best_price': book.best_price,
+        'total_volume': book.total_volume,
+        'level_count': len(book.prices),
+        'levels': book.levels(levels)
+    }
+    if units is not None:
+        filled, notional, last_price = book.fill(units)
+        average = notional / filled if filled else None
+        result['fill'] = {
+            'units': units,
+            'filled': filled,
+            'notional': notional,
+            'average_price': average,
+            'last_price': last_price,
+            'slippage_pct': (abs(average - book.best_price) / book.best_price * 100) if average else None
+        }
+    if within_pct is not None and book.best_price is not None:
+        # Worse than the best price by within_pct: higher for sells, lower for buys
+        direction = 1 if side == "sell" else -1
+        price = book.best_price * (1 + direction * within_pct / 100)
+    if price is not None:
+        result['depth'] = {'price': price, 'volume': book.volume_to_price(price)}
+    return result
@@ -0,0 +1,176 @@
+import numpy as np
+
+# Statistics stored on MarketData, in process_orders order
+MARKET_STAT_FIELDS = (
+    'buy_max', 'buy_min', 'buy_avg', 'buy_volume', 'buy_orders',
+    'sell_max', 'sell_min', 'sell_avg', 'sell_volume', 'sell_orders'
+)
+
+# Share of a side's volume used for the depth price (buy_p5/sell_p5)
+DEPTH_FRACTION = 0.05
+
+def orders_to_columns(orders):
+    """Convert a list of ESI order dicts into columnar arrays"""
+    count = len(orders)
+    type_ids = np.fromiter((o['type_id'] for o in orders), dtype=np.int64, count=count)
+    prices = np.fromiter((o['price'] for o in orders), dtype=np.float64, count=count)
+    volumes = np.fromiter((o['volume_remain'] for o in orders), dtype=np.int64, count=count)
+    is_buy = np.fromiter((o.get('is_buy_order', False) for o in orders), dtype=np.bool_, count=count)
+    return type_ids, prices, volumes, is_buy
+
+def empty_aggregate():
+    """aggregate_orders output for a region without orders"""
+    result = {'type_id': np.empty(0, dtype=np.int64)}
+    for side in ('buy', 'sell'):
+        for name in ('max', 'min', 'avg', 'p5'):
+            result[f'{side}_{name}'] = np.empty(0, dtype=np.float64)
+        for name in ('volume', 'orders'):
+            result[f'{side}_{name}'] = np.empty(0, dtype=np.int64)
+    return result
+
+def aggregate_orders(type_ids, prices, volumes, is_buy, depth_fraction=DEPTH_FRACTION):
+    """Compute per-type order statistics for a whole region in one grouped pass.
+
+    Takes columnar arrays and returns a dict of arrays aligned with the
+    sorted unique 'type_id' column. Missing sides have NaN prices and zero
+    volume/count. buy_p5/sell_p5 are the prices at which the best
+    depth_fraction of each side's volume is exhausted.
+    """
+    type_ids = np.asarray(type_ids, dtype=np.int64)
+    prices = np.asarray(prices, dtype=np.float64)
+    volumes = np.asarray(volumes, dtype=np.int64)
+    is_buy = np.asarray(is_buy, dtype=np.bool_)
+    if not len(type_ids):
+        return empty_aggregate()
+
+    # Rank orders best-first within each side: buys are best at the highest
+    # price, so they are ranked on -price
+    signed = np.where(is_buy, -prices, prices)
+    group_key = type_ids * 2 + is_buy
+    order = np.argsort(signed)
+    order = order[np.argsort(group_key[order], kind='stable')]
+    group_key = group_key[order]
+    signed = signed[order]
+    volumes = volumes[order]
+
+    # Every (type, side) group is now contiguous and sorted best to worst
+    starts = np.flatnonzero(np.r_[True, group_key[1:] != group_key[:-1]])
+    ends = np.r_[starts[1:], len(group_key)]
+    group_key = group_key[starts]
+
+    volume_sum = np.add.reduceat(volumes, starts)
+    notional = np.add.reduceat(signed * volumes, starts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        vwap = np.abs(np.where(volume_sum > 0, notional / volume_sum, 0.0))
+
+    cumulative = np.cumsum(volumes)
+    before = cumulative[starts] - volumes[starts]
+    depth_idx = np.searchsorted(cumulative, before + depth_fraction * volume_sum, side='left')
+    depth_idx = np.minimum(np.maximum(depth_idx, starts), ends - 1)
+
+    best = np.abs(signed[starts])
+    worst = np.abs(signed[ends - 1])
+    depth = np.abs(signed[depth_idx])
+    counts = ends - starts
+
+    unique_types = np.unique(group_key // 2)
+    n = len(unique_types)
+    result = {'type_id': unique_types}
+
+    for side, flag in (('buy', 1), ('sell', 0)):
+        groups = (group_key & 1) == flag
+        pos = np.searchsorted(unique_types, group_key[groups] // 2)
+        high, low = (best, worst) if flag else (worst, best)
+        for name, values, fill in (
+            ('max', high, np.nan), ('min', low, np.nan), ('avg', vwap, np.nan),
+            ('volume', volume_sum, 0), ('orders', counts, 0), ('p5', depth, np.nan)
+        ):
+            column = np.full(n, fill, dtype=values.dtype)
+            column[pos] = values[groups]
+            result[f'{side}_{name}'] = column
+
+    return result
+
+def process_orders(orders):
+    """Process orders and calculate statistics"""
+    if not orders:
+        return None
+    
+    buy_orders = [order for order in orders if order.get('is_buy_order', False)]
+    sell_orders = [order for order in orders if not order.get('is_buy_order', False)]
+    
+    def calculate_stats(order_list):
+        if not order_list:
+            return None, None, None, 0, 0
+        
+        prices = [order['price'] for order in order_list]
+        volumes = [order['volume_remain'] for order in order_list]
+        
+        return (
+            max(prices),
+            min(prices),
+            sum(price * volume for price, volume in zip(prices, volumes)) / sum(volumes) if sum(volumes) > 0 else 0,
+            sum(volumes),
+            len(order_list)
+        )
+    
+    buy_stats = calculate_stats(buy_orders)
+    sell_stats = calculate_stats(sell_orders)
+    
+    return {
+        'buy_max': buy_stats[0],
+        'buy_min': buy_stats[1],
+        'buy_avg': buy_stats[2],
+        'buy_volume': buy_stats[3],
+        'buy_orders': buy_stats[4],
+        'sell_max': sell_stats[0],
+        'sell_min': sell_stats[1],
+        'sell_avg': sell_stats[2],
+        'sell_volume': sell_stats[3],
+        'sell_orders': sell_stats[4]
+    }
+
+def market_data_row(type_id, region_id, order_stats, timestamp):
+    """Build a MarketData insert row from order statistics"""
+    row = {field: order_stats[field] for field in MARKET_STAT_FIELDS}
+    row.update(type_id=type_id, region_id=region_id, timestamp=timestamp)
+    return row
+
+def stats_by_type(columns):
+    """Turn aggregate_orders output into {type_id: stats dict} with None for missing sides"""
+    keys = [key for key in columns if key != 'type_id']
+    lists = {key: columns[key].tolist() for key in keys}
+    results = {}
+    for i, type_id in enumerate(columns['type_id'].tolist()):
+        stats = {}
+        for key in keys:
+            value = lists[key][i]
+            stats[key] = None if value != value else value  # NaN -> None
+        results[type_id] = stats
+    return results
+
+def book_levels(type_ids, prices, volumes, is_buy):
+    """Collapse orders into price levels per type and side in one sorted pass.
+
+    Returns aligned level arrays ordered by type, sell side before buy side,
+    then best to worst price: ascending for sells, descending for buys.
+    """
+    type_ids = np.asarray(type_ids, dtype=np.int64)
+    prices = np.asarray(prices, dtype=np.float64)
+    volumes = np.asarray(volumes, dtype=np.int64)
+    is_buy = np.asarray(is_buy, dtype=np.bool_)
+
+    signed = np.where(is_buy, -prices, prices)
+    order = np.lexsort((signed, is_buy, type_ids))
+    type_ids, is_buy, signed, volumes = type_ids[order], is_buy[order], signed[order], volumes[order]
+
+    starts = np.flatnonzero(np.r_[
+        True,
+        (type_ids[1:] != type_ids[:-1]) | (is_buy[1:] != is_buy[:-1]) | (signed[1:] != signed[:-1])
+    ])
+    return {
+        'type_id': type_ids[starts],
+        'is_buy': is_buy[starts],
+        'price': np.abs(signed[starts]),
+        'volume': np.add.reduceat(volumes, starts) if len(starts) else volumes[:0],
+    }
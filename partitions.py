@@ -0,0 +1,146 @@
+import os
+from datetime import datetime
+from sqlalchemy import text
+import logging
+
+logger = logging.getLogger(__name__)
+
+# "monthly" turns market_data into a range-partitioned table on PostgreSQL
+MARKET_DATA_PARTITIONING = os.getenv("MARKET_DATA_PARTITIONING", "").lower()
+# Months of market_data snapshots to keep; unset keeps everything
+MARKET_DATA_RETENTION_MONTHS = int(os.getenv("MARKET_DATA_RETENTION_MONTHS", "0"))
+# Partitions created ahead of the current month
+PARTITION_MONTHS_AHEAD = 2
+
+def month_start(value):
+    return datetime(value.year, value.month, 1)
+
+def add_months(value, months):
+    month = value.month - 1 + months
+    return datetime(value.year + month // 12, month % 12 + 1, 1)
+
+def partition_name(start):
+    return f"market_data_y{start.year}m{start.month:02d}"
+
+def partitioning_enabled(bind):
+    return bind.dialect.name == "postgresql" and MARKET_DATA_PARTITIONING == "monthly"
+
+def is_partitioned(conn):
+    """True if market_data is a partitioned PostgreSQL table"""
+    if conn.dialect.name != "postgresql":
+        return False
+    return conn.execute(text(
+        "SELECT 1 FROM pg_partitioned_table pt "
+        "JOIN pg_class c ON c.oid = pt.partrelid WHERE c.relname = 'market_data'"
+    )).first() is not None
+
+def create_month_partition(conn, start):
+    end = add_months(start, 1)
+    conn.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {partition_name(start)} PARTITION OF market_data "
+        f"FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"
+    ))
+
+def ensure_partitions(conn, since=None, months_ahead=PARTITION_MONTHS_AHEAD):
+    """Create monthly partitions from `since` (default: this month) through months_ahead"""
+    current = month_start(datetime.utcnow())
+    start = month_start(since) if since else current
+    last = add_months(current, months_ahead)
+    while start <= last:
+        create_month_partition(conn, start)
+        start = add_months(start, 1)
+
+def expired_partitions(conn, cutoff):
+    """Names of monthly partitions whose whole range lies before cutoff"""
+    rows = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = 'market_data'"
+    ))
+    expired = []
+    for (name,) in rows:
+        try:
+            start = datetime.strptime(name, "market_data_y%Ym%m")
+        except ValueError:
+            continue  # default partition
+        if add_months(start, 1) <= cutoff:
+            expired.append(name)
+    return sorted(expired)
+
+def apply_retention(engine, retention_months=MARKET_DATA_RETENTION_MONTHS):
+    """Keep partitions current and drop market_data older than the retention window.
+
+    Partitioned tables drop whole monthly partitions, which is instant and
+    leaves no dead tuples behind; other databases fall back to a DELETE.
+    Runs after every ingest.
+    """
+    with engine.begin() as conn:
+        partitioned = is_partitioned(conn)
+        if partitioned:
+            ensure_partitions(conn)
+        if not retention_months:
+            return
+        cutoff = add_months(month_start(datetime.utcnow()), -retention_months)
+        if partitioned:
+            for name in expired_partitions(conn, cutoff):
+                conn.execute(text(f"DROP TABLE {name}"))
+                logger.info(f"Dropped expired partition {name}")
+        else:
+            result = conn.execute(text("DELETE FROM market_data WHERE timestamp < :cutoff"), {"cutoff": cutoff})
+            logger.info(f"Deleted {result.rowcount} market_data rows older than {cutoff:%Y-%m-%d}")
+
+def partition_market_data(conn):
+    """Rebuild market_data as a table range-partitioned by month on timestamp.
+
+    PostgreSQL requires the partition key in every unique index, so the
+    primary key becomes (id, timestamp); the (type_id, region_id, timestamp)
+    upsert key already includes it. Rows are copied into monthly partitions
+    and a default partition catches anything outside the created ranges.
+    """
+    conn.execute(text("ALTER TABLE market_data RENAME TO market_data_unpartitioned"))
+    conn.execute(text("ALTER INDEX IF EXISTS uq_market_data_type_region_timestamp RENAME TO uq_market_data_unpartitioned"))
+    conn.execute(text("ALTER INDEX IF EXISTS ix_market_data_timestamp RENAME TO ix_market_data_unpartitioned_timestamp"))
+    conn.execute(text("""
+        CREATE TABLE market_data (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY,
+            type_id INTEGER NOT NULL REFERENCES items (type_id),
+            region_id INTEGER NOT NULL REFERENCES regions (region_id),
+            buy_max DOUBLE PRECISION,
+            buy_min DOUBLE PRECISION,
+            buy_avg DOUBLE PRECISION,
+            buy_volume INTEGER,
+            buy_orders INTEGER,
+            sell_max DOUBLE PRECISION,
+            sell_min DOUBLE PRECISION,
+            sell_avg DOUBLE PRECISION,
+            sell_volume INTEGER,
+            sell_orders INTEGER,
+            timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            created_at TIMESTAMP WITHOUT TIME ZONE,
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp)
+    """))
+    conn.execute(text("CREATE TABLE market_data_default PARTITION OF market_data DEFAULT"))
+
+    oldest = conn.execute(text("SELECT min(timestamp) FROM market_data_unpartitioned")).scalar()
+    ensure_partitions(conn, since=oldest)
+
+    conn.execute(text("""
+        INSERT INTO market_data
+        SELECT id, type_id, region_id, buy_max, buy_min, buy_avg, buy_volume, buy_orders,
+               sell_max, sell_min, sell_avg, sell_volume, sell_orders,
+               COALESCE(timestamp, created_at, now()), created_at
+        FROM market_data_unpartitioned
+    """))
+    conn.execute(text(
+        "SELECT setval(pg_get_serial_sequence('market_data', 'id'), "
+        "COALESCE((SELECT max(id) FROM market_data), 0) + 1, false)"
+    ))
+    conn.execute(text("DROP TABLE market_data_unpartitioned"))
+
+    # Indexes on the parent cascade to every partition
+    conn.execute(text(
+        "CREATE UNIQUE INDEX uq_market_data_type_region_timestamp "
+        "ON market_data (type_id, region_id, timestamp)"
+    ))
+    conn.execute(text("CREATE INDEX ix_market_data_timestamp ON market_data (timestamp)"))
@@ -0,0 +1,276 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+import numpy as np
+
+from metrics import pipeline_busy_seconds, pipeline_queue_depth, pipeline_units
+from order_book import book_rows
+from order_stats import aggregate_orders, market_data_row, orders_to_columns, process_orders, stats_by_type
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# Processes decoding and aggregating ESI responses; 0 decodes in one thread instead
+INGEST_PARSE_WORKERS = int(os.getenv("INGEST_PARSE_WORKERS", str(os.cpu_count() or 1)))
+
+# Jobs waiting for a parse worker, and (model, rows) batches waiting for the writer
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "64"))
+
+# Unit each stage's throughput is counted in
+STAGE_UNITS = {"fetch": "bytes", "parse": "rows", "aggregate": "rows", "write": "rows"}
+
+def loads(body):
+    return orjson.loads(body) if orjson else json.loads(body)
+
+# Parse jobs. They run in worker processes, so they take and return only
+# picklable values and must stay importable from this module.
+
+def parse_order_page(body):
+    """Decode one page of ESI orders into columnar arrays"""
+    return orders_to_columns(loads(body))
+
+def region_snapshot_rows(parts, region_id, timestamp, known_type_ids, with_books):
+    """Aggregate a region's decoded order pages into market_data and order book rows"""
+    parts = [part for part in parts if order_count(part)]
+    if not parts:
+        return [], []
+    columns = tuple(np.concatenate(part) for part in zip(*parts))
+    stats = stats_by_type(aggregate_orders(*columns))
+    snapshots = [
+        market_data_row(type_id, region_id, order_stats, timestamp)
+        for type_id, order_stats in stats.items()
+        if type_id in known_type_ids
+    ]
+    books = book_rows(*columns, region_id, timestamp, known_type_ids) if with_books else []
+    return snapshots, books
+
+def item_snapshot_rows(body, type_id, region_id, timestamp, with_books):
+    """Decode one type's orders in a region into its snapshot row (or None) and order book rows"""
+    orders = loads(body)
+    order_stats = process_orders(orders)
+    if not order_stats:
+        return None, []
+    books = book_rows(*orders_to_columns(orders), region_id, timestamp) if with_books else []
+    return market_data_row(type_id, region_id, order_stats, timestamp), books
+
+def history_row(type_id, region_id, hist_entry):
+    """Build an OrderHistory insert row from an ESI history entry"""
+    return {
+        'type_id': type_id,
+        'region_id': region_id,
+        'date': datetime.fromisoformat(hist_entry['date']),
+        'average': hist_entry.get('average'),
+        'highest': hist_entry.get('highest'),
+        'lowest': hist_entry.get('lowest'),
+        'order_count': hist_entry.get('order_count'),
+        'volume': hist_entry.get('volume')
+    }
+
+def history_rows(body, type_id, region_id, last_date, backfill_days):
+    """Decode a history response into rows newer than last_date, or the last backfill_days without one"""
+    entries = loads(body)
+    if last_date is None:
+        entries = entries[-backfill_days:]
+    else:
+        entries = [entry for entry in entries if datetime.fromisoformat(entry['date']) > last_date]
+    return [history_row(type_id, region_id, entry) for entry in entries]
+
+def order_count(columns):
+    return len(columns[0])
+
+def snapshot_count(result):
+    return len(result[0]) + len(result[1])
+
+def parse_pool(workers):
+    """Executor for the parse stage: worker processes, or one thread with workers <= 0.
+
+    Workers fork from a server process that has only this module
+    preloaded, not from the calling process, whose threads' locks a plain
+    fork would copy. Like spawn, every worker still imports the calling
+    process's main script (as __mp_main__) before it runs a job, unless it
+    was started with -m (uvicorn app:app, python -m ...). Scripts that
+    can start an ingest therefore keep their entry point under
+    `if __name__ == "__main__":` and do no work at import; app.py,
+    fetch_market.py and benchmark.py do.
+    """
+    if workers <= 0:
+        return ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingest-parse")
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+    if "forkserver" in methods:
+        context.set_forkserver_preload([__name__])
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context)
+
+class StageStats:
+    """Units one pipeline stage handled, when, and the time its jobs took"""
+
+    def __init__(self, name):
+        self.name = name
+        self.jobs = 0
+        self.units = 0
+        self.busy = 0.0
+        self.first = None
+        self.last = None
+
+    def record(self, units, started, finished):
+        self.jobs += 1
+        self.units += units
+        self.busy += finished - started
+        self.first = started if self.first is None else min(self.first, started)
+        self.last = finished if self.last is None else max(self.last, finished)
+        pipeline_units.inc(units, stage=self.name)
+        pipeline_busy_seconds.inc(finished - started, stage=self.name)
+
+    @property
+    def per_second(self):
+        elapsed = (self.last - self.first) if self.jobs else 0
+        return self.units / elapsed if elapsed > 0 else 0.0
+
+class IngestPipeline:
+    """fetch -> parse -> write stages of the ingest, connected by bounded queues.
+
+    Fetch coroutines hand raw response bodies to submit(), which queues a
+    job for the parse pool; decoding and aggregation run in worker
+    processes, off the event loop. Results go to write(), which queues row
+    batches for a single writer task that owns the BulkWriter and its
+    session on one thread. Both queues are bounded, so a slow writer stalls
+    the parsers and slow parsers stall the fetchers instead of buffering
+    responses without limit.
+    """
+
+    def __init__(self, writer, workers=INGEST_PARSE_WORKERS, queue_size=INGEST_QUEUE_SIZE):
+        self.writer = writer
+        self.workers = workers
+        self.queue_size = queue_size
+        self.stats = {name: StageStats(name) for name in STAGE_UNITS}
+        self.error = None
+
+    async def __aenter__(self):
+        self.loop = asyncio.get_running_loop()
+        self.pool = parse_pool(self.workers)
+        # The session is used from this thread only while the pipeline runs
+        self.db_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingest-write")
+        self.parse_queue = asyncio.Queue(self.queue_size)
+        self.write_queue = asyncio.Queue(self.queue_size)
+        self.parsers = [asyncio.ensure_future(self.parse_loop()) for _ in range(max(self.workers, 1))]
+        self.writer_task = asyncio.ensure_future(self.write_loop())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None:
+                await self.write_queue.put(None)
+                await self.writer_task
+                self.check()
+        finally:
+            for task in self.parsers + [self.writer_task]:
+                task.cancel()
+            await asyncio.gather(*self.parsers, self.writer_task, return_exceptions=True)
+            # Let a batch already handed to the writer thread finish before the caller rolls back
+            await self.loop.run_in_executor(None, self.db_thread.shutdown)
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def fetched(self, body):
+        """Count a response body handed over by a fetcher"""
+        now = time.monotonic()
+        self.stats["fetch"].record(len(body), now, now)
+
+    async def submit(self, stage, fn, *args, size=len):
+        """Queue fn(*args) for the parse pool and return a future for its result.
+
+        Waits while the parse queue is full. size(result) is the number of
+        units counted for the stage.
+        """
+        self.check()
+        future = self.loop.create_future()
+        await self.parse_queue.put((stage, fn, args, size, future))
+        pipeline_queue_depth.set(self.parse_queue.qsize(), queue="parse")
+        return future
+
+    async def parse(self, stage, fn, *args, size=len):
+        return await (await self.submit(stage, fn, *args, size=size))
+
+    async def parse_loop(self):
+        while True:
+            stage, fn, args, size, future = await self.parse_queue.get()
+            started = time.monotonic()
+            try:
+                result = await self.loop.run_in_executor(self.pool, fn, *args)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            self.stats[stage].record(size(result), started, time.monotonic())
+            if not future.done():
+                future.set_result(result)
+
+    async def write(self, *batches):
+        """Queue (model, rows) batches for the writer, in order; waits while the write queue is full"""
+        self.check()
+        await self.write_queue.put(("rows", batches, None))
+        pipeline_queue_depth.set(self.write_queue.qsize(), queue="write")
+
+    async def call(self, fn, *args):
+        """Run fn(*args) on the writer's thread after everything queued before it and return its result"""
+        self.check()
+        future = self.loop.create_future()
+        await self.write_queue.put(("call", (fn, args), future))
+        return await future
+
+    def add_rows(self, batches):
+        for model, rows in batches:
+            self.writer.add_all(model, rows)
+
+    async def write_loop(self):
+        while True:
+            job = await self.write_queue.get()
+            if job is None:
+                return
+            kind, payload, future = job
+            if self.error is not None:
+                # Nothing is written after a failed batch
+                if future is not None and not future.done():
+                    future.set_exception(self.error)
+                continue
+            started = time.monotonic()
+            try:
+                if kind == "rows":
+                    await self.loop.run_in_executor(self.db_thread, self.add_rows, payload)
+                    self.stats["write"].record(sum(len(rows) for _, rows in payload), started, time.monotonic())
+                else:
+                    fn, args = payload
+                    future.set_result(await self.loop.run_in_executor(self.db_thread, fn, *args))
+            except Exception as e:
+                # Surfaces on the next submit/write/call or on exit instead of being lost
+                self.error = e
+                if future is not None and not future.done():
+                    future.set_exception(e)
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def report(self, progress, stage):
+        """Publish per-stage throughput since the last report to progress and the log, then reset"""
+        parts = []
+        for name, stats in self.stats.items():
+            if not stats.jobs:
+                continue
+            unit = STAGE_UNITS[name]
+            progress.set(f"{name}_{unit}", stats.units)
+            progress.set(f"{name}_{unit}_per_second", round(stats.per_second))
+            if name != "fetch":
+                progress.set(f"{name}_busy_seconds", round(stats.busy, 3))
+            parts.append(f"{name} {stats.units:,} {unit} at {stats.per_second:,.0f}/s")
+        if parts:
+            logger.info(f"{stage} pipeline: " + ", ".join(parts))
+        self.stats = {name: StageStats(name) for name in STAGE_UNITS}
@@ -0,0 +1,79 @@
+import threading
+from datetime import datetime
+
+from metrics import ingest_rows, ingest_stage_seconds
+
+# Counters mirrored into ingest_rows_total as its "kind" label
+ROW_COUNTERS = ("rows_processed", "rows_written")
+
+class IngestProgress:
+    """Per-stage counters for one ingest run.
+
+    The ingest updates it from its own thread while the API reads
+    snapshot(), so every access goes through a lock. Stage durations and
+    row counters are also published to /metrics. on_write callbacks run
+    on the ingest's thread whenever committed rows are published.
+    """
+
+    def __init__(self, on_write=()):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.current = None
+        self.on_write = list(on_write)
+
+    def close_stage(self, now):
+        if self.current:
+            stage = self.stages[self.current]
+            stage['finished_at'] = now
+            ingest_stage_seconds.set((now - stage['started_at']).total_seconds(), stage=self.current)
+
+    def stage(self, name):
+        """Close the running stage and start counting a new one"""
+        with self.lock:
+            now = datetime.utcnow()
+            self.close_stage(now)
+            self.stages[name] = {'started_at': now, 'finished_at': None, 'counters': {}}
+            self.current = name
+
+    def finish(self):
+        with self.lock:
+            self.close_stage(datetime.utcnow())
+            self.current = None
+
+    def add(self, counter, amount=1):
+        with self.lock:
+            if self.current:
+                counters = self.stages[self.current]['counters']
+                counters[counter] = counters.get(counter, 0) + amount
+                if counter in ROW_COUNTERS:
+                    ingest_rows.inc(amount, stage=self.current, kind=counter)
+
+    def published(self):
+        """Tell listeners a new data generation is visible"""
+        for callback in self.on_write:
+            callback()
+
+    def set(self, counter, value):
+        with self.lock:
+            if self.current:
+                self.stages[self.current]['counters'][counter] = value
+
+    def request_sent(self):
+        self.add('requests')
+
+    def snapshot(self):
+        with self.lock:
+            now = datetime.utcnow()
+            stages = []
+            for name, stage in self.stages.items():
+                elapsed = ((stage['finished_at'] or now) - stage['started_at']).total_seconds()
+                counters = dict(stage['counters'])
+                stages.append({
+                    'name': name,
+                    'started_at': stage['started_at'],
+                    'finished_at': stage['finished_at'],
+                    'elapsed_seconds': round(elapsed, 3),
+                    'counters': counters,
+                    'requests_per_second': round(counters.get('requests', 0) / elapsed, 1) if elapsed > 0 else 0.0,
+                })
+            return {'current_stage': self.current, 'stages': stages}
@@ -0,0 +1,244 @@
+import argparse
+import logging
+from datetime import datetime, timedelta
+import numpy as np
+from sqlalchemy import select
+
+from bulk_write import BulkWriter
+from indicators import compute_indicators
+from models import MarketData, OrderHistory, PriceRollup
+
+logger = logging.getLogger(__name__)
+
+RESOLUTIONS = ("hour", "day", "week")
+BUCKET_LENGTHS = {"hour": timedelta(hours=1), "day": timedelta(days=1), "week": timedelta(weeks=1)}
+
+# Columns replaced when a bucket is rebuilt
+ROLLUP_FIELDS = ("open", "high", "low", "close", "volume", "turnover", "order_count", "samples")
+
+# Type IDs per source query when rebuilding
+ROLLUP_TYPE_CHUNK = 500
+
+def bucket_starts(times, resolution):
+    """Floor datetime64 values to the start of their hour, day or week (Monday)"""
+    if resolution == "hour":
+        return times.astype("datetime64[h]")
+    days = times.astype("datetime64[D]")
+    if resolution == "day":
+        return days
+    # 1970-01-01 was a Thursday
+    return days - ((days.astype(np.int64) + 3) % 7).astype("timedelta64[D]")
+
+def bucket_start(moment, resolution):
+    return bucket_starts(np.array([moment], dtype="datetime64[us]"), resolution).astype("datetime64[us]")[0].item()
+
+def rollup_columns(source, resolution):
+    """Group price samples into OHLC buckets per item/region in one sorted pass.
+
+    source holds aligned arrays: type_id, region_id, time, price, high, low
+    and optionally volume and order_count. Open and close are the first and
+    last price in time order.
+    """
+    times = source['time']
+    buckets = bucket_starts(times, resolution)
+    order = np.lexsort((times, buckets, source['region_id'], source['type_id']))
+    type_ids = source['type_id'][order]
+    region_ids = source['region_id'][order]
+    buckets = buckets[order]
+    prices = source['price'][order]
+
+    starts = np.flatnonzero(np.r_[
+        True,
+        (type_ids[1:] != type_ids[:-1]) | (region_ids[1:] != region_ids[:-1]) | (buckets[1:] != buckets[:-1])
+    ])
+    ends = np.r_[starts[1:], len(order)]
+
+    result = {
+        'type_id': type_ids[starts],
+        'region_id': region_ids[starts],
+        'bucket': buckets[starts].astype("datetime64[us]"),
+        'open': prices[starts],
+        'close': prices[ends - 1],
+        'high': np.fmax.reduceat(source['high'][order], starts),
+        'low': np.fmin.reduceat(source['low'][order], starts),
+        'samples': ends - starts,
+    }
+    if 'volume' in source:
+        volumes = source['volume'][order]
+        result['volume'] = np.add.reduceat(volumes, starts)
+        result['turnover'] = np.add.reduceat(prices * volumes, starts)
+        result['order_count'] = np.add.reduceat(source['order_count'][order], starts)
+    return result
+
+def rollup_rows(columns, resolution):
+    """Turn rollup_columns output into PriceRollup insert rows"""
+    lists = {key: values.tolist() for key, values in columns.items()}
+    rows = []
+    for i in range(len(lists['type_id'])):
+        row = {'resolution': resolution}
+        for key, values in lists.items():
+            value = values[i]
+            row[key] = None if value != value else value  # NaN -> None
+        for field in ('volume', 'turnover', 'order_count'):
+            row.setdefault(field, None)
+        rows.append(row)
+    return rows
+
+def snapshot_source(rows):
+    """Price samples from (type_id, region_id, timestamp, buy_max, sell_min) snapshot rows.
+
+    A snapshot is sampled at its mid price, or at whichever side exists.
+    """
+    type_ids, region_ids, times, buy_max, sell_min = zip(*rows)
+    buy = np.array(buy_max, dtype=np.float64)
+    sell = np.array(sell_min, dtype=np.float64)
+    price = np.where(np.isnan(buy), sell, np.where(np.isnan(sell), buy, (buy + sell) / 2))
+    keep = ~np.isnan(price)
+    return {
+        'type_id': np.array(type_ids, dtype=np.int64)[keep],
+        'region_id': np.array(region_ids, dtype=np.int64)[keep],
+        'time': np.array(times, dtype="datetime64[us]")[keep],
+        'price': price[keep],
+        'high': price[keep],
+        'low': price[keep],
+    }
+
+def history_source(rows):
+    """Price samples from (type_id, region_id, date, average, highest, lowest, volume, order_count) rows"""
+    type_ids, region_ids, dates, average, highest, lowest, volume, order_count = zip(*rows)
+    price = np.array(average, dtype=np.float64)
+    keep = ~np.isnan(price)
+    return {
+        'type_id': np.array(type_ids, dtype=np.int64)[keep],
+        'region_id': np.array(region_ids, dtype=np.int64)[keep],
+        'time': np.array(dates, dtype="datetime64[us]")[keep],
+        'price': price[keep],
+        'high': np.array(highest, dtype=np.float64)[keep],
+        'low': np.array(lowest, dtype=np.float64)[keep],
+        'volume': np.array([v or 0 for v in volume], dtype=np.int64)[keep],
+        'order_count': np.array([c or 0 for c in order_count], dtype=np.int64)[keep],
+    }
+
+def snapshot_query(*conditions):
+    return select(
+        MarketData.type_id, MarketData.region_id, MarketData.timestamp, MarketData.buy_max, MarketData.sell_min
+    ).where(*conditions)
+
+def history_query(*conditions):
+    return select(
+        OrderHistory.type_id, OrderHistory.region_id, OrderHistory.date, OrderHistory.average,
+        OrderHistory.highest, OrderHistory.lowest, OrderHistory.volume, OrderHistory.order_count
+    ).where(*conditions)
+
+def write_rollups(writer, rows, source, resolutions):
+    if not rows:
+        return 0
+    samples = source(rows)
+    written = 0
+    for resolution in resolutions:
+        buckets = rollup_rows(rollup_columns(samples, resolution), resolution)
+        writer.add_all(PriceRollup, buckets)
+        written += len(buckets)
+    return written
+
+def refresh_rollups(db, writer, history_since, snapshot_time=None):
+    """Rebuild only the rollup buckets an ingest run touched.
+
+    history_since maps (type_id, region_id) to the oldest history date
+    written; day and week buckets of those types are rebuilt from the start
+    of that week. The hour bucket holding snapshot_time is rebuilt from all
+    snapshots taken in that hour. Rows go through the ingest's writer.
+    """
+    written = 0
+    if snapshot_time is not None:
+        hour = bucket_start(snapshot_time, "hour")
+        rows = db.execute(snapshot_query(
+            MarketData.timestamp >= hour,
+            MarketData.timestamp < hour + BUCKET_LENGTHS["hour"]
+        )).all()
+        written += write_rollups(writer, rows, snapshot_source, ("hour",))
+
+    if history_since:
+        since = bucket_start(min(history_since.values()), "week")
+        type_ids = sorted({type_id for type_id, _ in history_since})
+        for start in range(0, len(type_ids), ROLLUP_TYPE_CHUNK):
+            rows = db.execute(history_query(
+                OrderHistory.type_id.in_(type_ids[start:start + ROLLUP_TYPE_CHUNK]),
+                OrderHistory.date >= since
+            )).all()
+            written += write_rollups(writer, rows, history_source, ("day", "week"))
+    return written
+
+def rebuild_rollups(db, writer):
+    """Recompute every rollup bucket from market_data and order_history"""
+    written = 0
+    type_ids = sorted(set(db.scalars(select(MarketData.type_id).distinct())) | set(db.scalars(select(OrderHistory.type_id).distinct())))
+    for start in range(0, len(type_ids), ROLLUP_TYPE_CHUNK):
+        chunk = type_ids[start:start + ROLLUP_TYPE_CHUNK]
+        written += write_rollups(writer, db.execute(snapshot_query(MarketData.type_id.in_(chunk))).all(), snapshot_source, ("hour",))
+        written += write_rollups(writer, db.execute(history_query(OrderHistory.type_id.in_(chunk))).all(), history_source, ("day", "week"))
+    writer.publish()
+    logger.info(f"Rebuilt {written} rollup buckets")
+    return written
+
+def backfill_rollups(db):
+    """Fill an empty price_rollups table from the stored history and snapshots"""
+    if db.query(PriceRollup.type_id).first() is not None:
+        return
+    rebuild_rollups(db, BulkWriter(db, update_columns={PriceRollup: ROLLUP_FIELDS}))
+
+async def ohlc_series(db, type_id, region_id, resolution, days, indicators=(), window=20, width=2.0):
+    """Columnar OHLC buckets for a window plus the requested rolling indicators.
+
+    window - 1 extra buckets before the window are read so the indicators
+    are defined from its first bucket on.
+    """
+    since = bucket_start(datetime.utcnow() - timedelta(days=days), resolution)
+    warmup = since - BUCKET_LENGTHS[resolution] * (window - 1) if indicators else since
+    rows = (await db.execute(
+        select(
+            PriceRollup.bucket, PriceRollup.open, PriceRollup.high, PriceRollup.low, PriceRollup.close,
+            PriceRollup.volume, PriceRollup.turnover, PriceRollup.order_count
+        ).where(
+            PriceRollup.type_id == type_id,
+            PriceRollup.region_id == region_id,
+            PriceRollup.resolution == resolution,
+            PriceRollup.bucket >= warmup
+        ).order_by(PriceRollup.bucket)
+    )).all()
+
+    names = ('bucket', 'open', 'high', 'low', 'close', 'volume', 'turnover', 'order_count')
+    values = list(zip(*rows)) if rows else [()] * len(names)
+    buckets = list(values[0])
+    columns = {name: np.array(column, dtype=np.float64) for name, column in zip(names[1:], values[1:])}
+    derived = compute_indicators(columns, indicators, window, width)
+
+    # Drop the warm-up buckets
+    first = next((i for i, bucket in enumerate(buckets) if bucket >= since), len(buckets))
+    series = {'bucket': buckets[first:]}
+    for name in ('open', 'high', 'low', 'close', 'volume', 'order_count'):
+        series[name] = list(values[names.index(name)][first:])
+    for name, column in derived.items():
+        series[name] = [None if value != value else value for value in column[first:].tolist()]
+
+    return {
+        'type_id': type_id,
+        'region_id': region_id,
+        'resolution': resolution,
+        'window': window,
+        'series': series
+    }
+
+if __name__ == "__main__":
+    from database import SessionLocal
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Price rollup maintenance")
+    parser.add_argument("command", choices=["rebuild"])
+    parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        rebuild_rollups(db, BulkWriter(db, update_columns={PriceRollup: ROLLUP_FIELDS}))
+    finally:
+        db.close()
@@ -0,0 +1,310 @@
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from sqlalchemy import and_, or_, select, update
+
+from database import SessionLocal
+from models import IngestRun, IngestShard, Item
+
+logger = logging.getLogger(__name__)
+
+# Split the history sync into one shard per region ("region") or into
+# type_id hash buckets across all regions ("type")
+INGEST_SHARD_BY = os.getenv("INGEST_SHARD_BY", "region")
+# type_id hash buckets when sharding by type
+INGEST_TYPE_SHARDS = int(os.getenv("INGEST_TYPE_SHARDS", "16"))
+# Seconds a claimed shard stays leased without a heartbeat from its worker
+INGEST_LEASE_SECONDS = int(os.getenv("INGEST_LEASE_SECONDS", "300"))
+# Claims of one shard before it is given up as failed
+INGEST_SHARD_ATTEMPTS = int(os.getenv("INGEST_SHARD_ATTEMPTS", "3"))
+# Minutes after which an unfinished run is closed instead of joined, so
+# late workers do not sync against a stale snapshot time; 0 keeps runs open
+INGEST_RUN_MAX_AGE_MINUTES = int(os.getenv("INGEST_RUN_MAX_AGE_MINUTES", "120"))
+# Name this worker's leases are recorded under
+INGEST_WORKER_ID = os.getenv("INGEST_WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+
+# Claimable shards read per claim attempt; the others race for the same rows
+CLAIM_CANDIDATES = 8
+
+def split_ids(value):
+    return [int(part) for part in (value or "").split(",") if part.strip()]
+
+def join_ids(ids):
+    return ",".join(str(id_) for id_ in ids)
+
+def shard_row(run_id, shard, phase, region_id=None, bucket=None, buckets=None):
+    return {'run_id': run_id, 'shard': shard, 'phase': phase, 'region_id': region_id, 'bucket': bucket, 'buckets': buckets}
+
+def shard_rows(run_id, regions, bulk_orders, shard_by, buckets):
+    """Shards of a new run: region order books first, then history"""
+    rows = []
+    if bulk_orders:
+        # A region's order book is one paged listing, so it never splits by type
+        rows += [shard_row(run_id, f"orders:{region_id}", "orders", region_id=region_id) for region_id in regions]
+    if shard_by == "type":
+        rows += [
+            shard_row(run_id, f"history:type:{bucket}/{buckets}", "history", bucket=bucket, buckets=buckets)
+            for bucket in range(buckets)
+        ]
+    else:
+        rows += [shard_row(run_id, f"history:region:{region_id}", "history", region_id=region_id) for region_id in regions]
+    return rows
+
+def plan_run(db, regions, bulk_orders, type_ids=None, type_limit=0, shard_by=INGEST_SHARD_BY, buckets=INGEST_TYPE_SHARDS):
+    """Record a new run and its pending shards"""
+    if shard_by not in ("region", "type"):
+        raise ValueError(f"INGEST_SHARD_BY must be region or type, not {shard_by!r}")
+    run = IngestRun(
+        id=uuid.uuid4().hex,
+        snapshot_time=datetime.utcnow(),
+        regions=join_ids(regions),
+        type_ids=join_ids(type_ids) if type_ids else None,
+        type_limit=type_limit,
+        bulk_orders=bulk_orders,
+        shard_by=shard_by
+    )
+    db.add(run)
+    db.flush()
+    rows = shard_rows(run.id, list(regions), bulk_orders, shard_by, buckets)
+    db.execute(IngestShard.__table__.insert(), rows)
+    db.commit()
+    db.refresh(run)
+    logger.info(f"Planned ingest run {run.id} with {len(rows)} shards")
+    return run
+
+def expire_run(db, run_id):
+    """Give up a run's unfinished shards and close it"""
+    now = datetime.utcnow()
+    db.execute(update(IngestShard).where(
+        IngestShard.run_id == run_id,
+        IngestShard.status.in_(("pending", "leased"))
+    ).values(status="failed", lease_expires=None, error="run expired", finished_at=now))
+    db.execute(update(IngestRun).where(
+        IngestRun.id == run_id,
+        IngestRun.finished_at.is_(None)
+    ).values(finished_at=now))
+    db.commit()
+
+def open_run(db, max_age_minutes=INGEST_RUN_MAX_AGE_MINUTES):
+    """The newest unfinished run that still has shards to work on, if any.
+
+    Runs with nothing pending or leased left are marked finished on the
+    way, so a run whose last worker died after its last shard is closed.
+    Runs older than max_age_minutes are expired rather than joined; the
+    caller plans a fresh one.
+    """
+    runs = db.scalars(select(IngestRun).where(IngestRun.finished_at.is_(None)).order_by(IngestRun.created_at.desc())).all()
+    cutoff = datetime.utcnow() - timedelta(minutes=max_age_minutes)
+    for run in runs:
+        if finish_run(run.id, db):
+            continue
+        if max_age_minutes and run.created_at < cutoff:
+            expire_run(db, run.id)
+            logger.warning(f"Ingest run {run.id} from {run.created_at} is older than {max_age_minutes} minutes, closed unfinished")
+            continue
+        db.refresh(run)
+        return run
+    return None
+
+def claimable(now):
+    return or_(
+        IngestShard.status == "pending",
+        and_(IngestShard.status == "leased", IngestShard.lease_expires < now)
+    )
+
+def has_claimable_shards(db, run_id):
+    """True if run has shards that are pending or whose lease expired"""
+    return db.scalar(select(IngestShard.shard).where(
+        IngestShard.run_id == run_id,
+        claimable(datetime.utcnow())
+    ).limit(1)) is not None
+
+def claim_shard(run_id, phase, worker=INGEST_WORKER_ID):
+    """Lease one pending (or abandoned) shard of a phase to worker, or return None.
+
+    The lease is taken with a conditional UPDATE, so of several workers
+    reading the same candidate exactly one sees its row change. Works the
+    same on PostgreSQL and SQLite, without SELECT ... FOR UPDATE.
+    """
+    now = datetime.utcnow()
+    with SessionLocal() as db:
+        # Leases that expired once too often are not handed out again
+        db.execute(update(IngestShard).where(
+            IngestShard.run_id == run_id,
+            IngestShard.status == "leased",
+            IngestShard.lease_expires < now,
+            IngestShard.attempts >= INGEST_SHARD_ATTEMPTS
+        ).values(status="failed", error="lease expired", finished_at=now))
+        db.commit()
+        while True:
+            candidates = db.scalars(select(IngestShard.shard).where(
+                IngestShard.run_id == run_id,
+                IngestShard.phase == phase,
+                claimable(now)
+            ).order_by(IngestShard.shard).limit(CLAIM_CANDIDATES)).all()
+            if not candidates:
+                return None
+            for shard in candidates:
+                result = db.execute(update(IngestShard).where(
+                    IngestShard.run_id == run_id,
+                    IngestShard.shard == shard,
+                    claimable(now)
+                ).values(
+                    status="leased",
+                    worker=worker,
+                    lease_expires=now + timedelta(seconds=INGEST_LEASE_SECONDS),
+                    attempts=IngestShard.attempts + 1,
+                    started_at=now
+                ))
+                db.commit()
+                if result.rowcount == 1:
+                    return db.get(IngestShard, (run_id, shard))
+
+def renew_lease(shard, worker=INGEST_WORKER_ID):
+    """Extend worker's lease on shard; False if it expired and was taken over"""
+    with SessionLocal() as db:
+        result = db.execute(update(IngestShard).where(
+            IngestShard.run_id == shard.run_id,
+            IngestShard.shard == shard.shard,
+            IngestShard.status == "leased",
+            IngestShard.worker == worker
+        ).values(lease_expires=datetime.utcnow() + timedelta(seconds=INGEST_LEASE_SECONDS)))
+        db.commit()
+        return result.rowcount == 1
+
+def finish_shard(shard, worker=INGEST_WORKER_ID, rows_processed=0):
+    """Report shard as done; False if worker no longer holds the lease it was claimed with.
+
+    A shard whose lease expired may have been taken over or failed along
+    with its run, and must keep that state rather than be marked done by
+    a worker that outlived its lease.
+    """
+    with SessionLocal() as db:
+        result = db.execute(update(IngestShard).where(
+            IngestShard.run_id == shard.run_id,
+            IngestShard.shard == shard.shard,
+            IngestShard.status == "leased",
+            IngestShard.worker == worker,
+            IngestShard.attempts == shard.attempts
+        ).values(status="done", lease_expires=None, rows_processed=rows_processed,
+                 error=None, finished_at=datetime.utcnow()))
+        db.commit()
+        return result.rowcount == 1
+
+def fail_shard(shard, worker, error):
+    """Release shard for another attempt, or mark it failed once it used up its attempts"""
+    with SessionLocal() as db:
+        db.execute(update(IngestShard).where(
+            IngestShard.run_id == shard.run_id,
+            IngestShard.shard == shard.shard,
+            IngestShard.status == "leased",
+            IngestShard.worker == worker,
+            IngestShard.attempts == shard.attempts
+        ).values(
+            status="failed" if shard.attempts >= INGEST_SHARD_ATTEMPTS else "pending",
+            lease_expires=None,
+            error=str(error)[:1000],
+            finished_at=datetime.utcnow()
+        ))
+        db.commit()
+
+def finish_run(run_id, db=None):
+    """Mark run finished once no shard is pending or leased.
+
+    True only for the one caller whose UPDATE closed the run, which then
+    does the run-wide work (hour rollups, retention).
+    """
+    session = db or SessionLocal()
+    try:
+        unfinished = select(IngestShard.shard).where(
+            IngestShard.run_id == run_id,
+            IngestShard.status.in_(("pending", "leased"))
+        ).exists()
+        result = session.execute(update(IngestRun).where(
+            IngestRun.id == run_id,
+            IngestRun.finished_at.is_(None),
+            ~unfinished
+        ).values(finished_at=datetime.utcnow()))
+        session.commit()
+        return result.rowcount == 1
+    finally:
+        if db is None:
+            session.close()
+
+async def keep_lease(shard, worker):
+    while True:
+        await asyncio.sleep(INGEST_LEASE_SECONDS / 3)
+        try:
+            if not await asyncio.to_thread(renew_lease, shard, worker):
+                logger.warning(f"Lease on shard {shard.shard} was lost, another worker may repeat it")
+                return
+        except Exception as e:
+            logger.error(f"Error renewing lease on shard {shard.shard}: {e}")
+
+@asynccontextmanager
+async def holding_lease(shard, worker=INGEST_WORKER_ID):
+    """Heartbeat the lease on shard while the block runs"""
+    heartbeat = asyncio.ensure_future(keep_lease(shard, worker))
+    try:
+        yield
+    finally:
+        heartbeat.cancel()
+
+def run_type_ids(db, run):
+    """Type IDs a run syncs history for, in ascending order"""
+    query = select(Item.type_id).where(Item.market_group_id.isnot(None)).order_by(Item.type_id)
+    if run.type_ids:
+        query = query.where(Item.type_id.in_(split_ids(run.type_ids)))
+    if run.type_limit:
+        query = query.limit(run.type_limit)
+    return list(db.scalars(query))
+
+def shard_pairs(shard, run, type_ids):
+    """(type_id, region_id) pairs whose history shard covers"""
+    if shard.region_id is not None:
+        return [(type_id, shard.region_id) for type_id in type_ids]
+    regions = split_ids(run.regions)
+    return [
+        (type_id, region_id)
+        for type_id in type_ids if type_id % shard.buckets == shard.bucket
+        for region_id in regions
+    ]
+
+async def latest_run(db):
+    """The newest run with its shard counts per status and every shard's state, or None"""
+    run = (await db.execute(select(IngestRun).order_by(IngestRun.created_at.desc()).limit(1))).scalar_one_or_none()
+    if run is None:
+        return None
+    shards = (await db.execute(
+        select(IngestShard).where(IngestShard.run_id == run.id).order_by(IngestShard.shard)
+    )).scalars().all()
+    counts = {}
+    for shard in shards:
+        counts[shard.status] = counts.get(shard.status, 0) + 1
+    return {
+        'id': run.id,
+        'snapshot_time': run.snapshot_time,
+        'created_at': run.created_at,
+        'finished_at': run.finished_at,
+        'regions': len(split_ids(run.regions)),
+        'shard_by': run.shard_by,
+        'shards': counts,
+        'shard_states': [
+            {
+                'shard': shard.shard,
+                'status': shard.status,
+                'worker': shard.worker,
+                'attempts': shard.attempts,
+                'lease_expires': shard.lease_expires,
+                'rows_processed': shard.rows_processed,
+                'error': shard.error,
+                'started_at': shard.started_at,
+                'finished_at': shard.finished_at
+            }
+            for shard in shards
+        ]
+    }
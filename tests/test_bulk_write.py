@@ -0,0 +1,33 @@
+from datetime import datetime, timedelta
+from sqlalchemy import delete
+
+from bulk_write import BulkWriter
+from database import SessionLocal, engine
+from fetch_market import LATEST_FIELDS
+from migrations import upgrade
+from models import MarketLatest
+
+def latest_row(timestamp, sell_min):
+    row = dict.fromkeys(LATEST_FIELDS)
+    row.update(type_id=34, region_id=10000002, timestamp=timestamp, sell_min=sell_min)
+    return row
+
+def test_older_snapshot_does_not_replace_latest():
+    upgrade(engine)
+    now = datetime.utcnow().replace(microsecond=0)
+    with SessionLocal() as db:
+        writer = BulkWriter(db, update_columns={MarketLatest: LATEST_FIELDS})
+        writer.add(MarketLatest, latest_row(now, 5.0))
+        writer.flush()
+        # A late worker from an earlier run
+        writer.add(MarketLatest, latest_row(now - timedelta(hours=1), 4.0))
+        writer.flush()
+        assert db.get(MarketLatest, (34, 10000002)).sell_min == 5.0
+
+        writer.add(MarketLatest, latest_row(now + timedelta(hours=1), 6.0))
+        writer.flush()
+        db.expire_all()
+        latest = db.get(MarketLatest, (34, 10000002))
+        assert (latest.timestamp, latest.sell_min) == (now + timedelta(hours=1), 6.0)
+        db.execute(delete(MarketLatest))
+        db.commit()
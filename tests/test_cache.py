@@ -0,0 +1,47 @@
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import delete, select
+
+from bulk_write import BulkWriter
+from cache import response_cache
+from database import SessionLocal, engine
+from migrations import upgrade
+from models import DataGeneration, Item
+
+def generation(db):
+    return db.scalar(select(DataGeneration.generation).where(DataGeneration.id == 1))
+
+@pytest.fixture(scope="module")
+def client():
+    upgrade(engine)
+    from app import app
+    with TestClient(app) as client:
+        yield client
+    response_cache.clear()
+
+def test_generation_moves_once_per_publish():
+    upgrade(engine)
+    published = []
+    with SessionLocal() as db:
+        start = generation(db)
+        writer = BulkWriter(db, batch_size=2, on_publish=lambda: published.append(True))
+        writer.add_all(Item, [{"type_id": type_id, "name": f"Cache {type_id}"} for type_id in range(900, 907)])
+        writer.flush()
+        assert writer.rows_written == 7
+        assert generation(db) == start
+        writer.publish()
+        assert generation(db) == start + 1
+        writer.publish()
+        assert generation(db) == start + 1
+        assert published == [True]
+        db.execute(delete(Item).where(Item.type_id.between(900, 906)))
+        db.commit()
+
+def test_etag_is_scoped_to_the_request(client):
+    items = client.get("/items", params={"limit": 2})
+    more_items = client.get("/items", params={"limit": 3})
+    regions = client.get("/regions")
+    tags = {items.headers["etag"], more_items.headers["etag"], regions.headers["etag"]}
+    assert len(tags) == 3
+    assert client.get("/items", params={"limit": 2}, headers={"If-None-Match": items.headers["etag"]}).status_code == 304
+    assert client.get("/regions", headers={"If-None-Match": items.headers["etag"]}).status_code == 200
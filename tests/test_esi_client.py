@@ -0,0 +1,109 @@
+import asyncio
+import time
+from aiohttp.test_utils import TestServer
+
+from esi_client import FetchScheduler
+from esi_stub import SyntheticUniverse, build_app
+
+# Backoff short enough that the tests measure the limits, not the jitter
+FAST_BACKOFF = 0.001
+
+def run_against_stub(client, **stub_options):
+    """Run client(scheduler, base_url) against a fresh stub; returns (result, stub stats)"""
+
+    async def run():
+        server = TestServer(build_app(SyntheticUniverse(types=20), **stub_options))
+        await server.start_server()
+        try:
+            base_url = str(server.make_url("")).rstrip("/")
+            result = await client(base_url)
+            async with FetchScheduler(max_retries=0) as scheduler:
+                stats = (await scheduler.get(f"{base_url}/_stub/stats")).data
+            return result, stats
+        finally:
+            await server.close()
+
+    return asyncio.run(run())
+
+def test_retries_stop_after_max_retries():
+    async def client(base_url):
+        async with FetchScheduler(max_retries=2, backoff_base=FAST_BACKOFF) as scheduler:
+            return await scheduler.get(f"{base_url}/universe/types/")
+
+    result, stats = run_against_stub(client, error_rate=1.0)
+    assert result.status == 502
+    assert stats['requests'] == 3
+
+def test_retry_recovers_from_transient_errors():
+    async def client(base_url):
+        async with FetchScheduler(max_retries=10, backoff_base=FAST_BACKOFF) as scheduler:
+            return await scheduler.get(f"{base_url}/universe/types/")
+
+    result, stats = run_against_stub(client, error_rate=0.5)
+    assert result.status == 200
+    assert stats['by_status']['200'] == 1
+
+def test_guard_pauses_when_budget_runs_low():
+    async def client(base_url):
+        async with FetchScheduler(max_retries=0, error_limit_margin=2) as scheduler:
+            answered = []
+            for _ in range(4):
+                # Unknown types are 404s and use up the error budget
+                await scheduler.get(f"{base_url}/universe/types/1/")
+                answered.append(time.monotonic())
+            return answered
+
+    answered, stats = run_against_stub(client, error_budget=5, error_window=1)
+    # Three errors leave 2 = margin, so the fourth waits for the window to reset
+    assert answered[2] - answered[0] < 0.5
+    assert answered[3] - answered[2] >= 0.9
+    assert '420' not in stats['by_status']
+
+def test_420_blocks_until_reset():
+    async def client(base_url):
+        # Another client uses up the budget, so this one learns of it from the 420
+        async with FetchScheduler(max_retries=0) as other:
+            await other.get(f"{base_url}/universe/types/1/")
+        async with FetchScheduler(max_retries=3, backoff_base=FAST_BACKOFF) as scheduler:
+            started = time.monotonic()
+            result = await scheduler.get(f"{base_url}/universe/types/")
+            return result, time.monotonic() - started
+
+    (result, elapsed), stats = run_against_stub(client, error_budget=1, error_window=1)
+    assert result.status == 200
+    assert stats['by_status']['420'] == 1
+    assert elapsed >= 0.9
+
+def test_token_bucket_paces_request_starts():
+    async def client(base_url):
+        async with FetchScheduler(requests_per_second=20) as scheduler:
+            started = time.monotonic()
+            await asyncio.gather(*(scheduler.get(f"{base_url}/universe/regions/") for _ in range(30)))
+            return time.monotonic() - started
+
+    elapsed, stats = run_against_stub(client)
+    # A full bucket lets 20 start at once, the other 10 follow at 20/s
+    assert elapsed >= 0.45
+    assert stats['by_status']['200'] == 30
+
+def test_in_flight_limit_under_latency():
+    async def client(base_url):
+        async with FetchScheduler(max_in_flight=5, requests_per_second=1000) as scheduler:
+            started = time.monotonic()
+            await asyncio.gather(*(scheduler.get(f"{base_url}/universe/regions/") for _ in range(10)))
+            return time.monotonic() - started
+
+    elapsed, _ = run_against_stub(client, latency=0.2)
+    # Ten requests through five slots take two rounds of latency
+    assert 0.4 <= elapsed < 1.5
+
+def test_concurrent_requests_stay_within_budget():
+    async def client(base_url):
+        async with FetchScheduler(max_in_flight=2, max_retries=0, error_limit_margin=5) as scheduler:
+            # Unknown types are 404s; all of them queue behind two slots at once
+            return await asyncio.gather(*(scheduler.get(f"{base_url}/universe/types/{n}/") for n in range(1, 30)))
+
+    results, stats = run_against_stub(client, error_budget=10, error_window=1, latency=0.02)
+    assert {result.status for result in results} == {404}
+    assert '420' not in stats['by_status']
+    assert stats['by_status']['404'] == 29
@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+
+from hauling import find_hauls, missing_routes, walk_books
+from order_book import decode_book, encode_book
+
+SALES_TAX = 0.036
+
+def book(sell, buy):
+    """(sell, buy) BookSides from [price, volume] levels, best first"""
+    return decode_book(encode_book(
+        [price for price, _ in sell], [volume for _, volume in sell],
+        [price for price, _ in buy], [volume for _, volume in buy]
+    ))
+
+def brute_force(sell_levels, buy_levels, cargo_units, capital):
+    """Unit-by-unit walk of both books"""
+    sells = [price for price, volume in sell_levels for _ in range(volume)]
+    buys = [price for price, volume in buy_levels for _ in range(volume)]
+    units, cost, revenue = 0, 0.0, 0.0
+    for sell_price, buy_price in zip(sells, buys):
+        if units >= cargo_units or buy_price * (1 - SALES_TAX) < sell_price or cost + sell_price > capital:
+            break
+        units += 1
+        cost += sell_price
+        revenue += buy_price * (1 - SALES_TAX)
+    return units, cost, revenue
+
+@pytest.mark.parametrize("seed", range(20))
+def test_walk_books_matches_unit_walk(seed):
+    rng = np.random.default_rng(seed)
+    # Books are stored best level first: sells ascending, buys descending
+    sell_prices = np.round(100 + np.cumsum(rng.uniform(0.5, 5, size=int(rng.integers(1, 8)))), 2)
+    buy_prices = np.round(130 - np.cumsum(rng.uniform(0.5, 5, size=int(rng.integers(1, 8)))), 2)
+    sell_levels = [[price, int(rng.integers(1, 40))] for price in sell_prices.tolist()]
+    buy_levels = [[price, int(rng.integers(1, 40))] for price in buy_prices.tolist()]
+    cargo_units = int(rng.integers(1, 200))
+    capital = float(rng.uniform(500, 20000))
+    sell, _ = book(sell_levels, [])
+    _, buy = book([], buy_levels)
+
+    units, cost, revenue, limited_by = walk_books(sell, buy, cargo_units, capital, SALES_TAX)
+    expected_units, expected_cost, expected_revenue = brute_force(sell_levels, buy_levels, cargo_units, capital)
+    assert units == expected_units
+    assert cost == pytest.approx(expected_cost)
+    assert revenue == pytest.approx(expected_revenue)
+    assert limited_by in ("cargo", "depth", "capital", "spread")
+
+def snapshot(rows):
+    """Hauling columns from (type_id, region_id, sell_min, sell_max, sell_volume, buy_max, buy_min, buy_volume) rows"""
+    rows = sorted(rows)
+    columns = {name: np.array([row[i] for row in rows], dtype=np.float64) for i, name in enumerate((
+        'type_id', 'region_id', 'sell_min', 'sell_max', 'sell_volume', 'buy_max', 'buy_min', 'buy_volume'
+    ))}
+    columns['type_id'] = columns['type_id'].astype(np.int64)
+    columns['region_id'] = columns['region_id'].astype(np.int64)
+    columns['sell_avg'] = (columns['sell_min'] + columns['sell_max']) / 2
+    columns['buy_avg'] = (columns['buy_min'] + columns['buy_max']) / 2
+    columns['item_volume'] = np.ones(len(rows))
+    return columns
+
+def test_find_hauls_walks_stored_books():
+    columns = snapshot([
+        (34, 1, 10.0, 20.0, 200, 9.0, 5.0, 100),
+        (34, 2, 30.0, 40.0, 100, 15.0, 11.0, 150),
+    ])
+    books = {
+        (34, 1): book([[10.0, 100], [20.0, 100]], [[9.0, 50], [5.0, 50]]),
+        (34, 2): book([[30.0, 50], [40.0, 50]], [[15.0, 100], [11.0, 50]]),
+    }
+    hauls = find_hauls(columns, 1e6, 1e9, SALES_TAX, "profit", jumps={(1, 2): 5, (2, 1): 5},
+                       books=lambda keys: {key: books[key] for key in keys if key in books})
+    assert len(hauls) == 1
+    haul = hauls[0]
+    assert haul['depth'] == "book"
+    # 100 units at 10 into the 15 bids; the next unit would cost 20
+    assert haul['quantity'] == 100
+    assert haul['cost'] == pytest.approx(1000.0)
+    assert haul['limited_by'] == "spread"
+
+def test_find_hauls_without_books_estimates():
+    columns = snapshot([
+        (34, 1, 10.0, 20.0, 200, 9.0, 5.0, 100),
+        (34, 2, 30.0, 40.0, 100, 15.0, 11.0, 150),
+    ])
+    hauls = find_hauls(columns, 1e6, 1e9, SALES_TAX, "profit", jumps={(1, 2): 5, (2, 1): 5})
+    assert hauls[0]['depth'] == "estimated"
+
+def test_unrouted_pairs_are_reported():
+    columns = snapshot([
+        (34, 1, 10.0, 20.0, 200, 9.0, 5.0, 100),
+        (34, 2, 30.0, 40.0, 100, 15.0, 11.0, 150),
+        (34, 3, 30.0, 40.0, 100, 15.0, 11.0, 150),
+    ])
+    jumps = {(1, 2): 5, (2, 1): 5}
+    assert missing_routes(columns, jumps) == [[1, 3], [2, 3]]
+    assert all(haul['to_region_id'] != 3 for haul in find_hauls(columns, 1e6, 1e9, SALES_TAX, "profit", jumps=jumps))
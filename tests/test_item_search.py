@@ -0,0 +1,106 @@
+import asyncio
+import base64
+import json
+import pytest
+from aiohttp.test_utils import TestServer
+from fastapi.testclient import TestClient
+from sqlalchemy import delete, select, text
+
+import fetch_market
+from bulk_write import BulkWriter
+from database import SessionLocal, engine
+from esi_stub import SyntheticUniverse, build_app
+from item_search import decode_cursor, encode_cursor
+from migrations import upgrade
+from models import Item
+
+def forge(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip("=")
+
+@pytest.fixture(scope="module")
+def client():
+    upgrade(engine)
+    with SessionLocal() as db:
+        for type_id in (34, 35, 36):
+            db.merge(Item(type_id=type_id, name=f"Mineral {type_id}", market_group_id=1))
+        db.commit()
+    from app import app
+    with TestClient(app) as client:
+        yield client
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor(["Tritanium", 34]), (str, int)) == ["Tritanium", 34]
+
+@pytest.mark.parametrize("key, types", [
+    ([{}], (int,)),
+    ([None], (int,)),
+    ([True], (int,)),
+    (["34"], (int,)),
+    ([34], (str, int)),
+    ([34, "Tritanium"], (str, int)),
+    ({"type_id": 34}, (int,)),
+])
+def test_forged_cursor_is_rejected(key, types):
+    with pytest.raises(ValueError):
+        decode_cursor(forge(key), types)
+
+def test_garbage_cursor_is_rejected():
+    with pytest.raises(ValueError):
+        decode_cursor("not base64 json!", (int,))
+
+@pytest.mark.parametrize("value", [2 ** 63, -2 ** 63 - 1, 10 ** 30])
+def test_out_of_range_cursor_is_rejected(value):
+    with pytest.raises(ValueError):
+        decode_cursor(forge([value]), (int,))
+    with pytest.raises(ValueError):
+        decode_cursor(forge(["Tritanium", value]), (str, int))
+
+def test_out_of_range_cursor_is_a_400(client):
+    assert client.get("/items", params={"cursor": forge([10 ** 30])}).status_code == 400
+    assert client.get("/items", params={"cursor": forge(["Mineral", 10 ** 30]), "search": "Mineral"}).status_code == 400
+
+def test_forged_cursor_is_a_400(client):
+    assert client.get("/items", params={"cursor": forge([{}])}).status_code == 400
+    assert client.get("/items", params={"cursor": forge([1, 2]), "search": "Mineral"}).status_code == 400
+
+def test_cursor_pages_through_items(client):
+    first = client.get("/items", params={"limit": 2}).json()
+    assert [item['type_id'] for item in first['items']] == [34, 35]
+    second = client.get("/items", params={"limit": 2, "cursor": first['next_cursor']}).json()
+    assert [item['type_id'] for item in second['items']] == [36]
+
+def search_rows(db, term):
+    return db.scalars(text("SELECT rowid FROM items_fts WHERE items_fts MATCH :term"), {"term": f'"{term}"'}).all()
+
+def test_catalog_synced_twice_is_indexed_once(monkeypatch):
+    async def sync_twice():
+        server = TestServer(build_app(SyntheticUniverse(types=20)))
+        await server.start_server()
+        try:
+            monkeypatch.setattr(fetch_market, "ESI_BASE_URL", str(server.make_url("")).rstrip("/"))
+            await fetch_market.update_items_database()
+            await fetch_market.update_items_database()
+        finally:
+            await server.close()
+
+    asyncio.run(sync_twice())
+    with SessionLocal() as db:
+        try:
+            type_ids = search_rows(db, "Synthetic Item")
+            assert sorted(type_ids) == list(range(1000, 1020))
+
+            # A second sync racing the first inserts nothing, so indexes nothing
+            indexed = []
+            writer = BulkWriter(db, on_insert={Item: indexed.extend})
+            writer.add(Item, {"type_id": 1000, "name": "Synthetic Item 1000"})
+            writer.flush()
+            assert indexed == []
+            assert search_rows(db, "Synthetic Item 1000") == [1000]
+        finally:
+            names = db.execute(select(Item.type_id, Item.name).where(Item.type_id.between(1000, 1019))).all()
+            db.execute(
+                text("INSERT INTO items_fts(items_fts, rowid, name) VALUES ('delete', :type_id, :name)"),
+                [{"type_id": type_id, "name": name} for type_id, name in names]
+            )
+            db.execute(delete(Item).where(Item.type_id.between(1000, 1019)))
+            db.commit()
@@ -0,0 +1,38 @@
+import asyncio
+from datetime import datetime
+from aiohttp.test_utils import TestServer
+
+from bulk_write import BulkWriter
+from database import SessionLocal, engine
+from esi_stub import SyntheticUniverse, build_app
+from fetch_market import MarketDataFetcher, ingest_region_orders
+from migrations import upgrade
+from order_book import book_rows
+from order_stats import aggregate_orders, orders_to_columns, stats_by_type
+from pipeline import IngestPipeline, region_snapshot_rows
+
+REGION = 10000002
+
+def test_empty_orders_aggregate_to_nothing():
+    columns = orders_to_columns([])
+    assert stats_by_type(aggregate_orders(*columns)) == {}
+    assert book_rows(*columns, REGION, datetime.utcnow()) == []
+    assert region_snapshot_rows([columns, columns], REGION, datetime.utcnow(), set(), True) == ([], [])
+
+def test_region_without_orders_is_ingested():
+    upgrade(engine)
+
+    async def run():
+        server = TestServer(build_app(SyntheticUniverse(types=20, regions=(REGION,), orders_per_type=0)))
+        await server.start_server()
+        db = SessionLocal()
+        try:
+            base_url = str(server.make_url("")).rstrip("/")
+            async with MarketDataFetcher(base_url=base_url) as fetcher:
+                async with IngestPipeline(BulkWriter(db), workers=0) as pipeline:
+                    return await ingest_region_orders(fetcher, pipeline, REGION, datetime.utcnow(), {1001})
+        finally:
+            db.close()
+            await server.close()
+
+    assert asyncio.run(run()) == (0, 0, 0)
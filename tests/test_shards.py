@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import delete, select, update
+
+from database import SessionLocal, engine
+from migrations import upgrade
+from models import IngestRun, IngestShard
+from shards import claim_shard, expire_run, finish_shard, open_run, plan_run
+
+REGIONS = [10000002, 10000043]
+
+@pytest.fixture
+def db():
+    upgrade(engine)
+    session = SessionLocal()
+    session.execute(delete(IngestShard))
+    session.execute(delete(IngestRun))
+    session.commit()
+    try:
+        yield session
+    finally:
+        session.close()
+
+def test_open_run_is_joined(db):
+    run = plan_run(db, REGIONS, bulk_orders=True)
+    assert open_run(db).id == run.id
+
+def test_old_run_is_expired_instead_of_joined(db):
+    run = plan_run(db, REGIONS, bulk_orders=True)
+    leased = claim_shard(run.id, "orders", "worker-a")
+    db.execute(update(IngestRun).where(IngestRun.id == run.id).values(created_at=datetime.utcnow() - timedelta(hours=3)))
+    db.commit()
+
+    assert open_run(db, max_age_minutes=120) is None
+    db.expire_all()
+    assert db.get(IngestRun, run.id).finished_at is not None
+    shards = db.scalars(select(IngestShard).where(IngestShard.run_id == run.id)).all()
+    assert {shard.status for shard in shards} == {"failed"}
+    assert db.get(IngestShard, (run.id, leased.shard)).error == "run expired"
+    assert claim_shard(run.id, "history", "worker-b") is None
+
+def test_max_age_zero_keeps_runs_open(db):
+    run = plan_run(db, REGIONS, bulk_orders=False)
+    db.execute(update(IngestRun).where(IngestRun.id == run.id).values(created_at=datetime.utcnow() - timedelta(days=2)))
+    db.commit()
+    assert open_run(db, max_age_minutes=0).id == run.id
+
+def test_late_worker_cannot_finish_expired_run(db):
+    run = plan_run(db, REGIONS, bulk_orders=True)
+    leased = claim_shard(run.id, "orders", "worker-a")
+    expire_run(db, run.id)
+
+    assert not finish_shard(leased, "worker-a", rows_processed=10)
+    db.expire_all()
+    assert db.get(IngestShard, (run.id, leased.shard)).status == "failed"
+
+def test_taken_over_shard_is_finished_by_its_new_holder(db):
+    run = plan_run(db, REGIONS[:1], bulk_orders=True)
+    first = claim_shard(run.id, "orders", "worker-a")
+    db.execute(update(IngestShard).where(IngestShard.run_id == run.id).values(lease_expires=datetime.utcnow() - timedelta(seconds=1)))
+    db.commit()
+    second = claim_shard(run.id, "orders", "worker-b")
+    assert second.shard == first.shard
+
+    assert not finish_shard(first, "worker-a")
+    assert finish_shard(second, "worker-b", rows_processed=5)
+    db.expire_all()
+    shard = db.get(IngestShard, (run.id, first.shard))
+    assert (shard.status, shard.worker, shard.rows_processed) == ("done", "worker-b", 5)